@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the per-sample text writing loop used by writeDataFile with the
+block formatting of daq_recording.textRecorder, and checks that both produce
+the same bytes.
+
+    python benchmark_text_export.py
+"""
+
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from daq_recording import textRecorder
+
+
+def writeLoop(filename, vals, sampleCount):
+    # the original writeDataFile
+    chan1 = vals[0]
+    chan2 = vals[1]
+
+    with open(filename, 'a') as f:
+        for count, (val1, val2) in enumerate(zip(chan1, chan2)):
+            line_num = sampleCount + count
+            f.write('{:g}, {:10.6f}, {:10.6f} \n'.format(line_num, val1, val2))
+
+
+def timeBlocks(write, blocks):
+    start = time.perf_counter()
+    for count, vals in enumerate(blocks):
+        write(vals, count * vals.shape[1])
+    return time.perf_counter() - start
+
+
+def run(blockSizes=(1000, 10000, 100000), totalSamples=1000000):
+    rng = np.random.default_rng(0)
+
+    # the text files run to a few hundred MB, removed again afterwards
+    with tempfile.TemporaryDirectory() as directory:
+        print('{:>10s} {:>12s} {:>12s} {:>9s} {:>10s}'.format(
+            'block', 'loop (s)', 'block (s)', 'speedup', 'identical'))
+
+        for blockSize in blockSizes:
+            nBlocks = max(totalSamples // blockSize, 1)
+            blocks = [rng.normal(scale=5, size=(2, blockSize)) for count in range(nBlocks)]
+
+            loopFile = os.path.join(directory, 'loop_{}.txt'.format(blockSize))
+            loopTime = timeBlocks(lambda vals, first: writeLoop(loopFile, vals.tolist(), first),
+                                  blocks)
+
+            blockFile = os.path.join(directory, 'block_{}.txt'.format(blockSize))
+            recorder = textRecorder(blockFile, 2)
+            blockTime = timeBlocks(recorder.write, blocks)
+            recorder.close()
+
+            with open(loopFile, 'rb') as f:
+                loopBytes = f.read()
+            with open(blockFile, 'rb') as f:
+                blockBytes = f.read()
+
+            print('{:>10d} {:>12.3f} {:>12.3f} {:>8.1f}x {:>10s}'.format(
+                blockSize, loopTime, blockTime, loopTime / blockTime, str(loopBytes == blockBytes)))
+
+
+if __name__ == '__main__':
+    run()
@@ -4,6 +4,8 @@ import nidaqmx
 import numpy as np
 from nidaqmx.stream_writers import AnalogSingleChannelWriter
 
+from daq_stats import streamingStats
+
 import tkinter as tk
 from tkinter import ttk
 import time
@@ -39,6 +41,9 @@ class voltageContinuousInput(tk.Frame):
         self.pack()
         self.run = False
 
+        # seconds of data behind the moving values
+        self.averageWindow = 1.0
+
     def create_widgets(self):
         """ create widgets - each widget is defined as a seperate class """
         self.channelSettingsFrame = channelSettings(
@@ -71,14 +76,17 @@ class voltageContinuousInput(tk.Frame):
     def averageData(self, vals):
         """ Update average, max, and min values in gui """
         
+        # moving values over the last averageWindow seconds, updated per block
+        self.stats.update(vals)
+        
         self.channelAverageFrame.channelAverageValue.delete(0, 'end')
-        self.channelAverageFrame.channelAverageValue.insert(0, '{:4.3f}'.format(np.mean(vals)))
+        self.channelAverageFrame.channelAverageValue.insert(0, '{:4.3f}'.format(self.stats.windowMean()[0]))
         
         self.channelAverageFrame.channelMaxValue.delete(0, 'end')
-        self.channelAverageFrame.channelMaxValue.insert(0, '{:4.3f}'.format(max(vals)))
+        self.channelAverageFrame.channelMaxValue.insert(0, '{:4.3f}'.format(self.stats.windowMax()[0]))
             
         self.channelAverageFrame.channelMinValue.delete(0, 'end')
-        self.channelAverageFrame.channelMinValue.insert(0, '{:4.3f}'.format(min(vals)))
+        self.channelAverageFrame.channelMinValue.insert(0, '{:4.3f}'.format(self.stats.windowMin()[0]))
             
                 
     def cameraTriggerStart(self):
@@ -139,6 +147,9 @@ class voltageContinuousInput(tk.Frame):
         
         # Initialize scale
         self.channelScale()
+        
+        # statistics behind the moving values panel
+        self.stats = streamingStats(1, max(int(self.averageWindow * sampleRate), 1))
 
         # Create and start task
         self.task = nidaqmx.Task()
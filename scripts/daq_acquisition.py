@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+Acquisition engine shared by the continuous input scripts.
+
+Reads from the nidaqmx task happen on a dedicated thread and land in a
+preallocated (channels x samples) ring buffer. The GUI, the file writer and
+the statistics each hold their own reader on the ring and consume it at their
+own pace, so a slow redraw or disk stall no longer delays the next read.
+
+Tasks made with createTask(..., simulate=True) come from daq_simulated
+instead of the driver, and nidaqmx is only needed for real hardware.
+
+Every block is numbered by its position in the acquisition, from the
+driver's sample clock rather than a count of blocks read. With
+createTask(..., overwrite=True) an overrun no longer stops the session: the
+reads skip past the overwritten samples and the positions handed to the
+consumers jump, which the recorders write down as gaps.
+
+With raw=True the reads return the converter's int16 codes instead of
+scaled float64 values, a quarter of the bytes per sample through the ring
+and onto disk. deviceScaling() gives the polynomial from code to volts of
+each channel, to be applied only where values are needed.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from daq_simulated import simulatedTask, simulatedScale, simulatedReader, simulatedOverrun
+
+try:
+    import nidaqmx
+    from nidaqmx.stream_readers import AnalogMultiChannelReader, AnalogUnscaledReader
+except ImportError:
+    # no NI driver stack, only simulated tasks are available
+    nidaqmx = None
+
+
+class channelConfig:
+    # One analog input channel: where it is wired, its voltage range and the
+    # linear sensor scale DAQmx applies to it. A session is a list of these,
+    # channel i being row i of every (channels x samples) block.
+
+    def __init__(self, physicalChannel, minVoltage, maxVoltage, minSensor, maxSensor,
+                 units, name=None):
+        self.physicalChannel = physicalChannel
+        self.minVoltage = minVoltage
+        self.maxVoltage = maxVoltage
+        self.minSensor = minSensor
+        self.maxSensor = maxSensor
+        self.units = units
+        self.name = name if name else physicalChannel
+
+    def slope(self):
+        return (self.maxSensor - self.minSensor) / (self.maxVoltage - self.minVoltage)
+
+
+def createTask(channels, sampleRate, bufferSize, simulate=False, realTime=True,
+               overwrite=False):
+    # one continuous task reading the whole channel list, each channel
+    # scaled by the driver through its own linear scale. simulate=True gives
+    # a daq_simulated task, paced by the sample clock unless realTime=False.
+    # overwrite=True lets the driver overwrite unread samples on an overrun
+    # instead of failing the next read.
+    if simulate:
+        task = simulatedTask(realTime=realTime)
+        createScale = simulatedScale.create_lin_scale
+        channelOptions = {}
+        timingOptions = {}
+    else:
+        assert nidaqmx is not None, 'Error, nidaqmx is not installed, use simulate=True'
+        task = nidaqmx.Task()
+        createScale = nidaqmx.scale.Scale.create_lin_scale
+        channelOptions = {'units': nidaqmx.constants.VoltageUnits(10065)}
+        timingOptions = {'sample_mode': nidaqmx.constants.AcquisitionType.CONTINUOUS}
+
+    for i, channel in enumerate(channels):
+        scaleName = 'scaleChan{}'.format(i + 1)
+        createScale(scaleName, channel.slope(), y_intercept=0.0, scaled_units=channel.units)
+        task.ai_channels.add_ai_voltage_chan(
+            channel.physicalChannel, min_val=channel.minVoltage, max_val=channel.maxVoltage,
+            custom_scale_name=scaleName, **channelOptions)
+
+    # in continuous mode samps_per_chan is the buffer size
+    task.timing.cfg_samp_clk_timing(sampleRate, samps_per_chan=bufferSize, **timingOptions)
+
+    if overwrite:
+        task.in_stream.over_write = ('OVERWRITE_UNREAD_SAMPLES' if simulate else
+                                     nidaqmx.constants.OverwriteMode.OVERWRITE_UNREAD_SAMPLES)
+    return task
+
+
+def isOverrun(error):
+    # DAQmx -200279: the application did not read fast enough and the input
+    # buffer was overwritten
+    return isinstance(error, simulatedOverrun) or getattr(error, 'error_code', None) == -200279
+
+
+def streamReader(task, raw=False):
+    # multi channel reader for a real or a simulated task, raw=True reads
+    # the unscaled int16 codes with read_int16
+    if isinstance(task, simulatedTask):
+        return simulatedReader(task.in_stream)
+    if raw:
+        return AnalogUnscaledReader(task.in_stream)
+    return AnalogMultiChannelReader(task.in_stream)
+
+
+def deviceScaling(task):
+    # per channel coefficients of the polynomial from int16 code to volts,
+    # the custom scales are not applied to raw reads
+    return [[float(c) for c in channel.ai_dev_scaling_coeff] for channel in task.ai_channels]
+
+
+class ringBuffer:
+    # Fixed capacity (channels x samples) buffer with a single producer and
+    # any number of readers. The producer only publishes a block by advancing
+    # writeCount after the copy, so readers never need a lock.
+
+    def __init__(self, nChannels, capacity, dtype=np.float64):
+        self.nChannels = nChannels
+        self.capacity = int(capacity)
+        self.data = np.zeros((nChannels, self.capacity), dtype=dtype)
+
+        # total samples ever written and the largest block written so far
+        self.writeCount = 0
+        self.maxWrite = 0
+
+    def write(self, block):
+        block = np.asarray(block)
+        if block.ndim == 1:
+            block = block.reshape(self.nChannels, -1)
+
+        n = block.shape[1]
+        skipped = 0
+        if n > self.capacity:
+            # only the newest capacity samples can be kept
+            skipped = n - self.capacity
+            block = block[:, skipped:]
+            n = self.capacity
+
+        self.maxWrite = max(self.maxWrite, n)
+        start = (self.writeCount + skipped) % self.capacity
+        first = min(n, self.capacity - start)
+        self.data[:, start:start + first] = block[:, :first]
+        self.data[:, :n - first] = block[:, first:]
+
+        # publish the block
+        self.writeCount = self.writeCount + skipped + n
+
+    def oldestValid(self):
+        # samples older than this may be overwritten by a block in progress
+        return self.writeCount + self.maxWrite - self.capacity
+
+    def copy(self, startCount, n, out=None):
+        if out is None:
+            out = np.empty((self.nChannels, n), dtype=self.data.dtype)
+        start = startCount % self.capacity
+        first = min(n, self.capacity - start)
+        out[:, :first] = self.data[:, start:start + first]
+        out[:, first:n] = self.data[:, :n - first]
+        return out
+
+    def latest(self, n):
+        end = self.writeCount
+        n = min(n, end, self.capacity - self.maxWrite)
+        return self.copy(end - n, n)
+
+    def reader(self):
+        return ringReader(self)
+
+
+class ringReader:
+    # Independent read cursor on a ringBuffer. A reader that falls more than
+    # one buffer behind skips ahead and counts the samples it missed.
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.readCount = ring.writeCount
+        self.samplesLost = 0
+
+        # reused between reads, grown when a larger read is needed
+        self.scratch = np.empty((ring.nChannels, 0), dtype=ring.data.dtype)
+
+    def available(self):
+        return self.ring.writeCount - self.readCount
+
+    def read(self, maxSamples=None):
+        # returns (block, index of the first sample in block). The block is a
+        # view of this reader's scratch buffer, valid until the next read.
+        end = self.ring.writeCount
+        start = max(self.readCount, self.ring.oldestValid())
+        if maxSamples is not None:
+            end = min(end, start + maxSamples)
+        n = max(end - start, 0)
+
+        if n > self.scratch.shape[1]:
+            self.scratch = np.empty((self.ring.nChannels, max(n, 2 * self.scratch.shape[1])),
+                                    dtype=self.ring.data.dtype)
+        block = self.ring.copy(start, n, out=self.scratch[:, :n])
+
+        # the producer may have lapped us while copying
+        overwritten = self.ring.oldestValid() - start
+        if overwritten > 0:
+            overwritten = min(overwritten, n)
+            block = block[:, overwritten:]
+            start = start + overwritten
+
+        self.samplesLost += start - self.readCount
+        self.readCount = start + block.shape[1]
+        return block, start
+
+    def skipTo(self, count):
+        # drop everything older than count without copying it
+        self.readCount = max(self.readCount, count)
+
+
+class blockLatency:
+    # Delivery latency of each block: time between the last sample of the
+    # block being acquired (from the sample clock) and the block reaching us.
+
+    def __init__(self, history=4096):
+        self.history = np.zeros(history)
+        self.count = 0
+        self.last = 0.0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        self.history[self.count % len(self.history)] = latency
+        self.count = self.count + 1
+        self.last = latency
+        self.total = self.total + latency
+        self.max = max(self.max, latency)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        n = min(self.count, len(self.history))
+        return float(np.percentile(self.history[:n], q)) if n else 0.0
+
+
+class blockSource:
+    # Common part of the two acquisition modes: every block read from the task
+    # is written to the ring buffer and then handed to each consumer in the
+    # callback chain as consumer(block, firstSample), on the acquisition side.
+    # Reads go through the stream reader into a preallocated buffer, so a
+    # consumer's block is a view that is only valid during the call.
+    #
+    # position is the acquisition index of the next sample to read. Before
+    # each read it is checked against the driver's total acquired count: the
+    # difference is the backlog still in the DAQmx buffer, and in overwrite
+    # mode anything older than the buffer is skipped and counted in
+    # samplesLost.
+    #
+    # raw=True reads int16 codes, for a ring made with dtype=np.int16.
+
+    def __init__(self, task, ring, numberOfSamples, sampleRate, raw=False):
+        self.task = task
+        self.ring = ring
+        self.numberOfSamples = numberOfSamples
+        self.sampleRate = sampleRate
+
+        self.raw = raw
+        self.reader = streamReader(task, raw)
+        self.read = self.reader.read_int16 if raw else self.reader.read_many_sample
+        self.dtype = np.int16 if raw else np.float64
+        self.readBuffer = np.zeros((ring.nChannels, numberOfSamples), dtype=self.dtype)
+
+        self.consumers = []
+        self.error = None
+        self.blocksRead = 0
+        self.samplesRead = 0
+        self.latency = blockLatency()
+
+        self.position = 0
+        self.samplesLost = 0
+        self.gaps = 0
+        self.backlog = 0
+        self.maxBacklog = 0
+        self.bufferSize = None
+        self.overwrite = getattr(task.in_stream.over_write, 'name',
+                                 task.in_stream.over_write) == 'OVERWRITE_UNREAD_SAMPLES'
+
+        # daq_diagnostics.diagnostics for stage timing, if attached
+        self.diagnostics = None
+
+        self.startTime = time.perf_counter()
+        self.cpuStart = time.process_time()
+
+    def addConsumer(self, consumer):
+        self.consumers.append(consumer)
+
+    def begin(self):
+        # call right after task.start(), block latency is measured from here
+        self.startTime = time.perf_counter()
+        self.cpuStart = time.process_time()
+        self.bufferSize = self.task.in_stream.input_buf_size
+
+    def readBlock(self, n, timeout):
+        if n != self.readBuffer.shape[1]:
+            self.readBuffer = np.zeros((self.ring.nChannels, n), dtype=self.dtype)
+        start = time.perf_counter_ns()
+        skip = self.checkBacklog(n)
+        try:
+            self.read(self.readBuffer, number_of_samples_per_channel=n, timeout=timeout)
+        except Exception as e:
+            if not (self.overwrite and isOverrun(e)):
+                raise
+            # overwritten while we were reading, move further on and retry
+            skip = self.checkBacklog(n)
+            self.read(self.readBuffer, number_of_samples_per_channel=n, timeout=timeout)
+        if skip:
+            self.task.in_stream.offset = 0
+            self.skipped(skip)
+        # with blocking reads this includes waiting for the samples to arrive
+        if self.diagnostics is not None:
+            self.diagnostics.record('read', time.perf_counter_ns() - start)
+        return self.readBuffer
+
+    def checkBacklog(self, n):
+        # returns how many samples the next read has to skip, always 0 unless
+        # the task overwrites unread samples
+        acquired = self.task.in_stream.total_samp_per_chan_acquired
+        self.backlog = acquired - self.position
+        self.maxBacklog = max(self.maxBacklog, self.backlog)
+        if not self.overwrite or self.bufferSize is None:
+            return 0
+
+        # samples older than the buffer are gone, keep a block of margin
+        # for the ones arriving during the read
+        skip = max(acquired - self.bufferSize + n - self.position, 0)
+        if skip:
+            self.task.in_stream.offset = skip
+        return skip
+
+    def skipped(self, n):
+        self.position = self.position + n
+        self.samplesLost = self.samplesLost + n
+        self.gaps = self.gaps + 1
+        if self.diagnostics is not None:
+            self.diagnostics.count('overruns')
+            self.diagnostics.count('samplesLost', n)
+
+    def deliver(self, block):
+        start = time.perf_counter_ns()
+        firstSample = self.position
+        self.ring.write(block)
+        self.position = self.position + block.shape[1]
+        self.samplesRead = self.samplesRead + block.shape[1]
+        self.blocksRead = self.blocksRead + 1
+
+        acquiredAt = self.startTime + self.position / self.sampleRate
+        self.latency.record(time.perf_counter() - acquiredAt)
+
+        for consumer in self.consumers:
+            consumer(block, firstSample)
+
+        if self.diagnostics is not None:
+            self.diagnostics.record('deliver', time.perf_counter_ns() - start)
+            self.diagnostics.count('blocks')
+            self.diagnostics.count('samples', block.shape[1])
+
+    def unregister(self):
+        # call after task.stop(), releases whatever the source registered
+        # with the task
+        pass
+
+    def fail(self, error):
+        # surfaced to the GUI, which owns the task
+        self.error = error
+        if self.diagnostics is not None:
+            self.diagnostics.count('overruns' if isOverrun(error) else 'readErrors')
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.startTime
+        cpu = time.process_time() - self.cpuStart
+        return {
+            'blocks': self.blocksRead,
+            'samples': self.samplesRead,
+            'samplesLost': self.samplesLost,
+            'gaps': self.gaps,
+            'maxBacklog': self.maxBacklog,
+            'latencyLastMs': self.latency.last * 1e3,
+            'latencyMeanMs': self.latency.mean() * 1e3,
+            'latencyP99Ms': self.latency.percentile(99) * 1e3,
+            'latencyMaxMs': self.latency.max * 1e3,
+            'cpuPercent': 100 * cpu / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class acquisitionThread(blockSource, threading.Thread):
+    # Blocking reads of numberOfSamples per channel on a dedicated thread.
+
+    def __init__(self, task, ring, numberOfSamples, sampleRate, timeout=10.0, raw=False):
+        blockSource.__init__(self, task, ring, numberOfSamples, sampleRate, raw)
+        threading.Thread.__init__(self, daemon=True)
+        self.timeout = timeout
+        self.stopEvent = threading.Event()
+
+    def start(self):
+        self.begin()
+        threading.Thread.start(self)
+
+    def run(self):
+        try:
+            while not self.stopEvent.is_set():
+                self.deliver(self.readBlock(self.numberOfSamples, self.timeout))
+        except Exception as e:
+            if not self.stopEvent.is_set():
+                self.fail(e)
+
+    def stop(self, timeout=None):
+        self.stopEvent.set()
+        self.join(timeout)
+
+
+class eventAcquisition(blockSource):
+    # Reads driven by the DAQmx every-N-samples-acquired event, so each block
+    # is read as soon as the driver has it instead of on the next poll. The
+    # callback runs on a driver thread. Construct before task.start().
+
+    def __init__(self, task, ring, numberOfSamples, sampleRate, raw=False):
+        blockSource.__init__(self, task, ring, numberOfSamples, sampleRate, raw)
+        self.running = False
+        self.task.register_every_n_samples_acquired_into_buffer_event(
+            numberOfSamples, self.everyNSamples)
+
+    def start(self):
+        self.begin()
+        self.running = True
+
+    def everyNSamples(self, task_handle, every_n_samples_event_type,
+                      number_of_samples, callback_data):
+        if not self.running or self.error is not None:
+            return 0
+        try:
+            # after an overrun skip the position runs ahead of the events
+            # still queued, which then fire for samples already read
+            acquired = self.task.in_stream.total_samp_per_chan_acquired
+            if acquired - self.position < number_of_samples:
+                return 0
+            self.deliver(self.readBlock(number_of_samples, 0))
+        except Exception as e:
+            self.fail(e)
+        return 0
+
+    def stop(self, timeout=None):
+        # a callback already in flight may still deliver its block. DAQmx
+        # only takes a change of event registration on a stopped task, so
+        # the callback is unregistered by unregister() after task.stop()
+        self.running = False
+
+    def unregister(self):
+        self.task.register_every_n_samples_acquired_into_buffer_event(
+            self.numberOfSamples, None)
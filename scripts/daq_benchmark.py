@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the acquisition, statistics, plotting and recording path
+against a simulated device, no NI hardware or display needed.
+
+Every combination of sample rate, channel count and numberOfSamples is run
+for a few seconds with the same pieces as the wLight GUI: an acquisition
+thread feeding the ring buffer and the recording writer, the moving average
+drained every refresh interval and the plots redrawn at the GUI frame rate
+(rendered off screen with Agg unless --no-render). Each run reports
+
+  - time per block of every stage: read (the same blocking read as the
+    GUI, so it includes waiting for the samples), deliver (ring write and
+    the writer queue), write (disk, on the writer thread), stats and
+    plot/draw, the draw being the GUI's own stackedPlot on an Agg canvas
+  - delivery latency (sample clock to ring) and display latency (sample clock
+    to plotted) percentiles
+  - whether it kept up: no buffer overrun, no dropped or skipped samples
+  - the peak RSS of the process running it
+
+and the highest passing rate of each channel count x numberOfSamples is
+given as its max sustainable rate. Results are written as JSON:
+
+    python daq_benchmark.py --rates 1000 10000 100000 --channels 2 8 16 \
+        --samples 100 1000 --output benchmark.json
+
+--overrun-check instead stalls a consumer past the end of the DAQ buffer in
+both read modes, with the task overwriting unread samples, and checks that
+the acquisition logs the gap and carries on reading.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from daq_acquisition import (channelConfig, createTask, ringBuffer, acquisitionThread,
+                             eventAcquisition, blockLatency)
+from daq_recording import binaryRecorder, textRecorder, recordingWriter
+from daq_compressed import compressedRecorder
+from daq_headless import fileExtensions
+from daq_stats import streamingStats
+from daq_display import displayBuffer, stackedPlot
+
+try:
+    import resource
+except ImportError:
+    # not on Windows, peak RSS is left out there
+    resource = None
+
+
+class stageTimer:
+    # durations per stage, appended from whichever thread runs the stage
+
+    def __init__(self):
+        self.times = {}
+
+    def record(self, stage, seconds):
+        self.times.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        summary = {}
+        for stage, times in self.times.items():
+            times = np.array(times) * 1e6
+            summary[stage] = {
+                'count': len(times),
+                'meanUs': float(times.mean()),
+                'p50Us': float(np.percentile(times, 50)),
+                'p99Us': float(np.percentile(times, 99)),
+                'maxUs': float(times.max()),
+            }
+        return summary
+
+
+class timedAcquisition(acquisitionThread):
+
+    def __init__(self, timer, *args, **kwargs):
+        acquisitionThread.__init__(self, *args, **kwargs)
+        self.timer = timer
+
+    def readBlock(self, n, timeout):
+        start = time.perf_counter()
+        block = acquisitionThread.readBlock(self, n, timeout)
+        self.timer.record('read', time.perf_counter() - start)
+        return block
+
+    def deliver(self, block):
+        start = time.perf_counter()
+        acquisitionThread.deliver(self, block)
+        self.timer.record('deliver', time.perf_counter() - start)
+
+
+class timedWriter(recordingWriter):
+
+    def __init__(self, timer, *args, **kwargs):
+        recordingWriter.__init__(self, *args, **kwargs)
+        self.timer = timer
+
+    def writeItems(self, items):
+        start = time.perf_counter()
+        recordingWriter.writeItems(self, items)
+        # a coalesced write is shared out over the blocks it wrote
+        for item in items:
+            self.timer.record('write', (time.perf_counter() - start) / len(items))
+
+
+def offscreenPlot(nChannels, maxPoints):
+    # the wLight graph, rendered with Agg instead of into a Tk window
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(6, 6), dpi=100, tight_layout=True)
+    plot = stackedPlot(fig, FigureCanvasAgg(fig), maxPoints)
+    plot.setChannels(['ai{}'.format(i) for i in range(nChannels)])
+    return plot
+
+
+def peakRss():
+    # bytes, ru_maxrss is in kilobytes on Linux and bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+def runOnce(sampleRate, nChannels, numberOfSamples, duration=3.0, fileFormat='binary',
+            render=True, maxPoints=1000, fps=30, refreshInterval=0.05, directory=None):
+    timer = stageTimer()
+    channels = [channelConfig('Sim1/ai{}'.format(i), -5.0, 5.0, -5.0, 5.0, 'V')
+                for i in range(nChannels)]
+
+    task = createTask(channels, sampleRate, numberOfSamples * 3, simulate=True)
+    ring = ringBuffer(nChannels, max(sampleRate * 10, numberOfSamples * 20))
+    plotReader = ring.reader()
+    averageReader = ring.reader()
+    stats = streamingStats(nChannels, sampleRate)
+    plot = offscreenPlot(nChannels, maxPoints) if render else None
+    # without rendering only the display buffers are fed
+    buffers = plot.buffers if render else [displayBuffer(maxPoints) for i in range(nChannels)]
+    displayLatency = blockLatency()
+
+    filename = os.path.join(directory, 'benchmark' + fileExtensions[fileFormat])
+    if fileFormat == 'binary':
+        recorder = binaryRecorder(filename, [channel.physicalChannel for channel in channels],
+                                  [1.0] * nChannels, ['V'] * nChannels, sampleRate)
+    elif fileFormat == 'compressed':
+        recorder = compressedRecorder(filename, [channel.physicalChannel for channel in channels],
+                                      [1.0] * nChannels, ['V'] * nChannels, sampleRate)
+    else:
+        recorder = textRecorder(filename, nChannels)
+    writer = timedWriter(timer, recorder, policy='drop')
+
+    acquisition = timedAcquisition(timer, task, ring, numberOfSamples, sampleRate)
+    acquisition.addConsumer(writer.put)
+    writer.start()
+    task.start()
+    acquisition.start()
+
+    # the GUI side: runTask every refreshInterval, drawPlots every frame
+    start = time.perf_counter()
+    nextRefresh = start + refreshInterval
+    nextFrame = start + 1.0 / fps
+    while acquisition.error is None:
+        now = time.perf_counter()
+        if now - start >= duration:
+            break
+        time.sleep(max(min(nextRefresh, nextFrame) - now, 0))
+
+        now = time.perf_counter()
+        if now >= nextRefresh:
+            nextRefresh = nextRefresh + refreshInterval
+            vals, firstSample = averageReader.read()
+            if vals.shape[1] > 0:
+                stageStart = time.perf_counter()
+                stats.update(vals)
+                stats.windowMean()
+                timer.record('stats', time.perf_counter() - stageStart)
+
+        if now >= nextFrame:
+            nextFrame = nextFrame + 1.0 / fps
+            plotReader.skipTo(ring.writeCount - maxPoints)
+            vals, firstSample = plotReader.read()
+            if vals.shape[1] > 0:
+                stageStart = time.perf_counter()
+                for buffer, values in zip(buffers, vals):
+                    buffer.append(values)
+                timer.record('plot', time.perf_counter() - stageStart)
+
+                if plot is not None:
+                    # decimation, limits and the blit or full draw, as in drawPlots
+                    stageStart = time.perf_counter()
+                    plot.draw(idle=False)
+                    timer.record('draw', time.perf_counter() - stageStart)
+
+                shownAt = acquisition.startTime + (firstSample + vals.shape[1]) / sampleRate
+                displayLatency.record(time.perf_counter() - shownAt)
+
+    acquisition.stop(timeout=numberOfSamples / sampleRate + 1)
+    task.stop()
+    acquisition.unregister()
+    elapsed = time.perf_counter() - start
+    overrun = acquisition.error
+    task.close()
+    writer.close()
+
+    summary = acquisition.summary()
+    writerStats = writer.stats()
+    # samples skipped by the acquisition or by a reader that fell behind the ring
+    samplesLost = acquisition.samplesLost + averageReader.samplesLost
+    expected = elapsed * sampleRate
+    kept = (overrun is None and writerStats['droppedSamples'] == 0 and samplesLost == 0
+            and summary['samples'] >= 0.9 * expected - 2 * numberOfSamples)
+
+    return {
+        'sampleRate': sampleRate,
+        'channels': nChannels,
+        'numberOfSamples': numberOfSamples,
+        'duration': elapsed,
+        'samples': summary['samples'],
+        'blocks': summary['blocks'],
+        'sustained': bool(kept),
+        'overrun': None if overrun is None else str(overrun),
+        'overruns': task.in_stream.overruns,
+        'droppedSamples': writerStats['droppedSamples'],
+        'samplesLost': samplesLost,
+        'cpuPercent': summary['cpuPercent'],
+        'stages': timer.summary(),
+        'deliveryLatencyMs': {
+            'p50': acquisition.latency.percentile(50) * 1e3,
+            'p99': acquisition.latency.percentile(99) * 1e3,
+            'p999': acquisition.latency.percentile(99.9) * 1e3,
+            'max': acquisition.latency.max * 1e3,
+        },
+        'displayLatencyMs': {
+            'p50': displayLatency.percentile(50) * 1e3,
+            'p99': displayLatency.percentile(99) * 1e3,
+            'max': displayLatency.max * 1e3,
+        },
+        'writer': writerStats,
+        'peakRssBytes': peakRss(),
+    }
+
+
+def isolatedRun(options):
+    # each run in a fresh process, so the peak RSS belongs to that run
+    directory = tempfile.mkdtemp(prefix='pydaq_benchmark_')
+    try:
+        return runOnce(directory=directory, **options)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def sweep(rates, channelCounts, sampleCounts, duration=3.0, fileFormat='binary', render=True):
+    runs = []
+    maxSustainable = {}
+    context = multiprocessing.get_context('spawn')
+    for nChannels in channelCounts:
+        for numberOfSamples in sampleCounts:
+            key = '{}x{}'.format(nChannels, numberOfSamples)
+            maxSustainable[key] = None
+            for sampleRate in sorted(rates):
+                # a run needs a few blocks to mean anything
+                if numberOfSamples / sampleRate > duration / 5:
+                    continue
+                options = {'sampleRate': sampleRate, 'nChannels': nChannels,
+                           'numberOfSamples': numberOfSamples, 'duration': duration,
+                           'fileFormat': fileFormat, 'render': render}
+                with context.Pool(1) as pool:
+                    result = pool.apply(isolatedRun, (options,))
+                runs.append(result)
+                print('{:>8d} Hz {:>3d} ch {:>7d} samples: {}'.format(
+                    sampleRate, nChannels, numberOfSamples,
+                    'ok' if result['sustained'] else 'FAILED'), flush=True)
+                if not result['sustained']:
+                    # higher rates would only fail the same way
+                    break
+                maxSustainable[key] = sampleRate
+    return runs, maxSustainable
+
+
+def overrunCheck(readMode, sampleRate=1000, numberOfSamples=100, stall=1.0, duration=3.0):
+    # one stall of a consumer longer than the DAQ buffer holds, the session
+    # has to skip the overwritten samples and keep reading after it
+    channels = [channelConfig('Sim1/ai0', -5.0, 5.0, -5.0, 5.0, 'V')]
+    task = createTask(channels, sampleRate, numberOfSamples * 3, simulate=True, overwrite=True)
+    ring = ringBuffer(len(channels), sampleRate * 10)
+    if readMode == 'event':
+        acquisition = eventAcquisition(task, ring, numberOfSamples, sampleRate)
+    else:
+        acquisition = acquisitionThread(task, ring, numberOfSamples, sampleRate)
+
+    stalled = []
+    def stallOnce(block, firstSample):
+        if not stalled and firstSample >= 5 * numberOfSamples:
+            stalled.append(firstSample)
+            time.sleep(stall)
+    acquisition.addConsumer(stallOnce)
+
+    task.start()
+    acquisition.start()
+    time.sleep(duration)
+    acquisition.stop(timeout=numberOfSamples / sampleRate + 1)
+    task.stop()
+    acquisition.unregister()
+    task.close()
+
+    acquired = task.in_stream.total_samp_per_chan_acquired
+    # read on after the stall, up to a few blocks still in the buffer
+    carriedOn = (acquisition.error is None and acquisition.gaps > 0
+                 and acquisition.position >= acquired - 3 * numberOfSamples)
+    return {
+        'readMode': readMode,
+        'passed': bool(carriedOn),
+        'error': None if acquisition.error is None else str(acquisition.error),
+        'position': acquisition.position,
+        'acquired': acquired,
+        'samplesLost': acquisition.samplesLost,
+        'gaps': acquisition.gaps,
+    }
+
+
+def version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pydaq pipeline on a simulated device')
+    parser.add_argument('--rates', type=int, nargs='+', default=[1000, 10000, 100000, 250000])
+    parser.add_argument('--channels', type=int, nargs='+', default=[2, 8, 16])
+    parser.add_argument('--samples', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds per run')
+    parser.add_argument('--format', choices=sorted(fileExtensions), default='binary')
+    parser.add_argument('--no-render', dest='render', action='store_false',
+                        help='skip the off screen matplotlib drawing')
+    parser.add_argument('--output', help='JSON file for the results, default stdout')
+    parser.add_argument('--overrun-check', action='store_true',
+                        help='check that both read modes carry on after an overrun')
+    args = parser.parse_args()
+
+    if args.overrun_check:
+        checks = [overrunCheck(readMode) for readMode in ('event', 'thread')]
+        for check in checks:
+            print('{readMode:>6s}: {result}, read to {position} of {acquired}, lost {samplesLost} '
+                  'samples in {gaps} gaps, error {error}'.format(
+                      result='ok' if check['passed'] else 'FAILED', **check))
+        raise SystemExit(0 if all(check['passed'] for check in checks) else 1)
+
+    started = time.strftime('%Y-%m-%dT%H:%M:%S')
+    runs, maxSustainable = sweep(args.rates, args.channels, args.samples,
+                                 args.duration, args.format, args.render)
+    results = {
+        'version': version(),
+        'started': started,
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'settings': vars(args),
+        'maxSustainableRate': maxSustainable,
+        'runs': runs,
+    }
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(args.output)
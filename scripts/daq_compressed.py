@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+Lossless compressed recordings ('.daqz').
+
+The samples of a session are cut into chunks of up to chunkSamples, each
+coded independently on the recordingWriter thread:
+
+    delta   along time per channel, arithmetic for integer samples (the raw
+            int16 codes), XOR of the bit patterns for floats, so a smooth
+            signal leaves mostly zero high bytes
+    shuffle the bytes of every sample into byte planes, so those zero bytes
+            sit next to each other
+    codec   zlib, or lz4 / zstd when the lz4 / zstandard packages are there
+
+The file is the 4096 byte header of a .daq recording (with magic PYDAQCMP
+and the codec in its JSON) followed by the chunks, each behind a 32 byte
+chunk header: magic, file index and acquisition index of its first sample,
+sample count, compressed size and CRC32. A chunk never spans a gap. Chunks
+can be found by hopping from header to header, so the file stays seekable,
+and compressedView decodes the chunks of a window on a thread pool.
+Gaps are logged in '<recording>.gaps' and a min/max pyramid is kept as for
+.daq recordings, so openRecording(), pyramidView and exportText work on
+either kind of file.
+
+A session that does not close cleanly loses only what came after its last
+sync(), which writes the chunk being filled as a short one. Compression
+ratio and CPU cost per codec and level can be compared on an existing
+recording with
+
+    python daq_compressed.py levels cannPressure_999999_20240101.daq
+"""
+
+import argparse
+import json
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from daq_recording import (HEADER_SIZE, headerStruct, gapLog, minMaxPyramid,
+                           recordingView, recordingScaling, openRecording)
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b'PYDAQCMP'
+VERSION = 1
+CHUNK_MAGIC = b'CHNK'
+chunkStruct = struct.Struct('<4sQqIII')  # magic, file index, first sample, samples, bytes, crc32
+
+
+def zlibCompress(data, level):
+    return zlib.compress(data, level)
+
+
+def lz4Compress(data, level):
+    return lz4.frame.compress(data, compression_level=level)
+
+
+def zstdCompress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def zstdDecompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# codec: (compress(data, level), decompress(data), default level)
+codecs = {'zlib': (zlibCompress, zlib.decompress, 6)}
+if lz4 is not None:
+    codecs['lz4'] = (lz4Compress, lz4.frame.decompress, 0)
+if zstandard is not None:
+    codecs['zstd'] = (zstdCompress, zstdDecompress, 3)
+
+
+def bitsType(dtype):
+    # unsigned integer of the same size, for the XOR delta of floats
+    return np.dtype('<u{}'.format(dtype.itemsize))
+
+
+def encodeChunk(block, codec, level):
+    # block is channels x samples in the recording dtype
+    block = np.ascontiguousarray(block)
+    if block.dtype.kind == 'f':
+        bits = block.view(bitsType(block.dtype))
+        delta = bits.copy()
+        delta[:, 1:] ^= bits[:, :-1]
+    else:
+        # integer differences wrap around, which cumsum undoes
+        delta = block.copy()
+        delta[:, 1:] -= block[:, :-1]
+    planes = np.ascontiguousarray(delta.reshape(-1).view(np.uint8)
+                                  .reshape(-1, block.dtype.itemsize).T)
+    return codecs[codec][0](planes.tobytes(), level)
+
+
+def decodeChunk(payload, codec, dtype, nChannels, n):
+    planes = np.frombuffer(codecs[codec][1](payload), dtype=np.uint8)
+    data = np.ascontiguousarray(planes.reshape(dtype.itemsize, -1).T)
+    if dtype.kind == 'f':
+        bits = data.view(bitsType(dtype)).reshape(nChannels, n)
+        return np.bitwise_xor.accumulate(bits, axis=1).view(dtype)
+    delta = data.view(dtype).reshape(nChannels, n)
+    return np.cumsum(delta, axis=1, dtype=dtype)
+
+
+class compressedRecorder:
+    # Drop-in for binaryRecorder writing a .daqz file. Blocks are collected
+    # until a chunk is full or the acquisition index jumps, and each chunk
+    # is compressed in write(), on the writer thread. scaling and
+    # firstSample are as for binaryRecorder.
+
+    def __init__(self, filename, channelNames, slopes, units, sampleRate,
+                 dtype='float32', startTime=None, codec='zlib', level=None,
+                 chunkSamples=65536, pyramidFactor=10, scaling=None, firstSample=0):
+        assert codec in codecs, 'Error, codec unavailable, recieved {:s}'.format(codec)
+        self.filename = filename
+        self.scaling = scaling
+        self.dtype = np.dtype('int16' if scaling is not None else dtype)
+        self.nChannels = len(channelNames)
+        self.codec = codec
+        self.level = codecs[codec][2] if level is None else level
+        self.chunkSamples = chunkSamples
+        self.sampleCount = 0
+
+        # samples waiting for a full chunk, and where they start
+        self.pending = []
+        self.pendingSamples = 0
+        self.pendingFirst = firstSample
+        self.pendingIndex = 0
+
+        # daq_diagnostics.diagnostics for stage timing, if attached
+        self.diagnostics = None
+
+        self.chunks = 0
+        self.bytesWritten = HEADER_SIZE
+        self.rawBytes = 0
+        self.compressedBytes = 0
+        self.compressSeconds = 0.0
+
+        if startTime is None:
+            startTime = time.time()
+
+        self.header = {
+            'channels': list(channelNames),
+            'slopes': [float(slope) for slope in slopes],
+            'units': list(units),
+            'sampleRate': float(sampleRate),
+            'startTime': startTime,
+            'startTimeISO': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(startTime)),
+            'dtype': self.dtype.str,
+            'codec': codec,
+            'level': self.level,
+            'chunkSamples': chunkSamples,
+            'firstSample': firstSample,
+        }
+        if scaling is not None:
+            self.header['scaling'] = scaling.description()
+
+        self.file = open(filename, 'wb')
+        self.writeHeader()
+        self.gapLog = gapLog(filename, firstSample)
+
+        self.pyramid = None
+        if pyramidFactor:
+            self.pyramid = minMaxPyramid(self.nChannels, factor=pyramidFactor, basename=filename)
+
+    def writeHeader(self):
+        description = json.dumps(self.header).encode('utf-8')
+        assert headerStruct.size + len(description) <= HEADER_SIZE, 'Error, recording header too large'
+
+        self.file.seek(0)
+        self.file.write(headerStruct.pack(MAGIC, VERSION, HEADER_SIZE, self.sampleCount))
+        self.file.write(description.ljust(HEADER_SIZE - headerStruct.size, b'\0'))
+
+    def setStartTime(self, startTime):
+        # the wall clock time the task started, known only once the
+        # recorder is open. Call before the first write.
+        self.header['startTime'] = startTime
+        self.header['startTimeISO'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(startTime))
+        self.writeHeader()
+
+    def write(self, block, firstSample=None):
+        n = block.shape[1]
+        self.gapLog.check(firstSample, n, self.sampleCount + self.pendingSamples)
+        nextSample = self.pendingFirst + self.pendingSamples
+        if firstSample is None:
+            firstSample = nextSample
+        if firstSample != nextSample:
+            # a chunk holds contiguous samples only
+            self.writeChunk()
+        if not self.pending:
+            self.pendingFirst = firstSample
+            self.pendingIndex = self.sampleCount
+
+        self.pending.append(np.asarray(block, dtype=self.dtype))
+        self.pendingSamples = self.pendingSamples + n
+        while self.pendingSamples >= self.chunkSamples:
+            self.writeChunk(self.chunkSamples)
+
+        if self.pyramid is not None:
+            if self.scaling is not None:
+                block = self.scaling.apply(block)
+            self.pyramid.update(block)
+
+    def writeChunk(self, n=None):
+        # compresses and writes the first n pending samples, all by default
+        if not self.pending:
+            return
+        pending = self.pending[0] if len(self.pending) == 1 else np.concatenate(self.pending, axis=1)
+        if n is None:
+            n = pending.shape[1]
+        chunk = pending[:, :n]
+        rest = pending[:, n:]
+
+        start = time.perf_counter_ns()
+        cpuStart = time.thread_time()
+        payload = encodeChunk(chunk, self.codec, self.level)
+        self.compressSeconds = self.compressSeconds + time.thread_time() - cpuStart
+        if self.diagnostics is not None:
+            self.diagnostics.record('compress', time.perf_counter_ns() - start)
+
+        self.file.write(chunkStruct.pack(CHUNK_MAGIC, self.pendingIndex, self.pendingFirst,
+                                         n, len(payload), zlib.crc32(payload)))
+        self.file.write(payload)
+        self.chunks = self.chunks + 1
+        self.rawBytes = self.rawBytes + chunk.nbytes
+        self.compressedBytes = self.compressedBytes + chunkStruct.size + len(payload)
+        self.bytesWritten = self.bytesWritten + chunkStruct.size + len(payload)
+        self.sampleCount = self.sampleCount + n
+
+        self.pending = [rest] if rest.shape[1] else []
+        self.pendingSamples = rest.shape[1]
+        self.pendingFirst = self.pendingFirst + n
+        self.pendingIndex = self.sampleCount
+
+    def flush(self):
+        # the chunk being filled stays pending, only whole chunks are written
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(headerStruct.pack(MAGIC, VERSION, HEADER_SIZE, self.sampleCount))
+        self.file.seek(position)
+        self.file.flush()
+        if self.pyramid is not None:
+            self.pyramid.flush()
+
+    def sync(self):
+        # the samples pending go out as a short chunk, so a recording synced
+        # every few seconds keeps them after a crash, however long a whole
+        # chunk takes at a low sample rate
+        self.writeChunk()
+        self.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.writeChunk()
+        self.flush()
+        self.file.close()
+        self.gapLog.close()
+        if self.pyramid is not None:
+            self.pyramid.close()
+
+    def stats(self):
+        return {
+            'codec': self.codec,
+            'level': self.level,
+            'chunks': self.chunks,
+            'rawBytes': self.rawBytes,
+            'compressedBytes': self.compressedBytes,
+            'ratio': self.rawBytes / self.compressedBytes if self.compressedBytes else 0.0,
+            'compressSeconds': self.compressSeconds,
+            'compressMBps': (self.rawBytes / 1e6 / self.compressSeconds
+                             if self.compressSeconds > 0 else 0.0),
+        }
+
+
+def readCompressedHeader(filename):
+    with open(filename, 'rb') as f:
+        magic, version, headerSize, sampleCount = headerStruct.unpack(f.read(headerStruct.size))
+        assert magic == MAGIC, 'Error, {:s} is not a compressed pydaq recording'.format(filename)
+        description = f.read(headerSize - headerStruct.size).rstrip(b'\0')
+
+    header = json.loads(description.decode('utf-8'))
+    header['version'] = version
+    header['headerSize'] = headerSize
+    return header
+
+
+def scanChunks(filename, headerSize):
+    # (payload offset, file index, first sample, samples, bytes, crc32) of
+    # every complete chunk, a torn chunk at the end is left out
+    chunks = []
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        offset = headerSize
+        while offset + chunkStruct.size <= size:
+            f.seek(offset)
+            magic, index, firstSample, n, nBytes, crc = chunkStruct.unpack(f.read(chunkStruct.size))
+            payloadOffset = offset + chunkStruct.size
+            if magic != CHUNK_MAGIC or payloadOffset + nBytes > size:
+                break
+            chunks.append((payloadOffset, index, firstSample, n, nBytes, crc))
+            offset = payloadOffset + nBytes
+    return chunks
+
+
+class compressedView(recordingView):
+    # recordingView of a .daqz recording. Nothing is decoded until a slice
+    # is asked for; the chunks it spans are then read and decoded on up to
+    # workers threads (zlib, lz4 and zstd release the GIL).
+
+    def __init__(self, filename, workers=None):
+        self.filename = filename
+        self.header = readCompressedHeader(filename)
+        self.channels = self.header['channels']
+        self.sampleRate = self.header['sampleRate']
+        self.scaling = recordingScaling(self.header)
+        self.dtype = np.dtype(self.header['dtype'])
+        self.codec = self.header['codec']
+        assert self.codec in codecs, 'Error, codec unavailable, recieved {:s}'.format(self.codec)
+        self.workers = workers if workers is not None else min(8, os.cpu_count() or 1)
+
+        self.chunks = scanChunks(filename, self.header['headerSize'])
+        self.chunkStart = np.array([chunk[1] for chunk in self.chunks], dtype=np.int64)
+        self.sampleCount = sum(chunk[3] for chunk in self.chunks)
+        self.header['sampleCount'] = self.sampleCount
+        self.data = None
+        self.loadGaps()
+
+    def decode(self, chunk):
+        payloadOffset, index, firstSample, n, nBytes, crc = chunk
+        with open(self.filename, 'rb') as f:
+            f.seek(payloadOffset)
+            payload = f.read(nBytes)
+        assert zlib.crc32(payload) == crc, 'Error, corrupt chunk at sample {:d}'.format(index)
+        return decodeChunk(payload, self.codec, self.dtype, len(self.channels), n)
+
+    def frames(self, start, stop, columns=None):
+        start, stop, _ = slice(start, stop).indices(self.sampleCount)
+        nChannels = len(self.channels) if columns is None else len(columns)
+        out = np.empty((max(stop - start, 0), nChannels), dtype=self.dtype)
+        if stop <= start:
+            return out
+
+        first = int(np.searchsorted(self.chunkStart, start, side='right')) - 1
+        last = int(np.searchsorted(self.chunkStart, stop, side='left'))
+        chunks = self.chunks[first:last]
+        if len(chunks) > 1 and self.workers > 1:
+            with ThreadPoolExecutor(self.workers) as pool:
+                blocks = list(pool.map(self.decode, chunks))
+        else:
+            blocks = [self.decode(chunk) for chunk in chunks]
+
+        for chunk, block in zip(chunks, blocks):
+            index = chunk[1]
+            lo = max(start, index)
+            hi = min(stop, index + chunk[3])
+            part = block[:, lo - index:hi - index]
+            out[lo - start:hi - start] = (part if columns is None else part[columns]).T
+        return out
+
+
+def readCompressed(filename, raw=False, workers=None):
+    # returns (header, channels x samples array) like readRecording
+    view = compressedView(filename, workers)
+    return view.header, view.values(0, len(view), raw=raw)
+
+
+def convert(filename, outFilename=None, codec='zlib', level=None, chunkSamples=65536):
+    # compresses a .daq recording, gaps and pyramid included
+    view = openRecording(filename)
+    header = view.header
+    if outFilename is None:
+        outFilename = os.path.splitext(filename)[0] + '.daqz'
+    recorder = compressedRecorder(outFilename, header['channels'], header['slopes'],
+                                  header['units'], header['sampleRate'], dtype=header['dtype'],
+                                  startTime=header['startTime'], codec=codec, level=level,
+                                  chunkSamples=chunkSamples, scaling=view.scaling)
+    for first, last, firstSample in view.segments(0, len(view)):
+        for start in range(first, last, chunkSamples):
+            stop = min(start + chunkSamples, last)
+            recorder.write(view.values(start, stop, raw=True), firstSample + start - first)
+    recorder.close()
+    view.close()
+    return outFilename, recorder.stats()
+
+
+def compareLevels(filename, seconds=60.0):
+    # ratio and speed of every codec and level on the start of a recording
+    view = openRecording(filename)
+    n = min(len(view), int(seconds * view.sampleRate))
+    data = view.values(0, n, raw=True).astype(view.header['dtype'], copy=False)
+    chunkSamples = 65536
+    levels = {'zlib': (1, 3, 6, 9), 'lz4': (0, 4, 9), 'zstd': (1, 3, 9, 19)}
+
+    results = []
+    for codec in codecs:
+        for level in levels[codec]:
+            compressedBytes = 0
+            cpuStart = time.process_time()
+            payloads = []
+            for start in range(0, n, chunkSamples):
+                payloads.append(encodeChunk(data[:, start:start + chunkSamples], codec, level))
+                compressedBytes = compressedBytes + chunkStruct.size + len(payloads[-1])
+            compressSeconds = time.process_time() - cpuStart
+            cpuStart = time.process_time()
+            for i, payload in enumerate(payloads):
+                block = data[:, i * chunkSamples:(i + 1) * chunkSamples]
+                decodeChunk(payload, codec, data.dtype, data.shape[0], block.shape[1])
+            decompressSeconds = time.process_time() - cpuStart
+            results.append({
+                'codec': codec, 'level': level,
+                'ratio': data.nbytes / compressedBytes,
+                'compressMBps': data.nbytes / 1e6 / max(compressSeconds, 1e-9),
+                'decompressMBps': data.nbytes / 1e6 / max(decompressSeconds, 1e-9),
+            })
+    view.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compressed pydaq recordings')
+    commands = parser.add_subparsers(dest='command')
+
+    convertParser = commands.add_parser('convert', help='compress a .daq recording')
+    convertParser.add_argument('filename')
+    convertParser.add_argument('outFilename', nargs='?')
+    convertParser.add_argument('--codec', default='zlib', choices=sorted(codecs))
+    convertParser.add_argument('--level', type=int)
+
+    levelsParser = commands.add_parser('levels', help='compare codecs and levels on a recording')
+    levelsParser.add_argument('filename')
+    levelsParser.add_argument('--seconds', type=float, default=60.0)
+
+    args = parser.parse_args()
+    if args.command == 'convert':
+        outFilename, stats = convert(args.filename, args.outFilename, args.codec, args.level)
+        print(outFilename)
+        print(json.dumps(stats, indent=2))
+    elif args.command == 'levels':
+        print('{:<6s} {:>5s} {:>7s} {:>12s} {:>14s}'.format(
+            'codec', 'level', 'ratio', 'comp MB/s', 'decomp MB/s'))
+        for result in compareLevels(args.filename, args.seconds):
+            print('{codec:<6s} {level:>5d} {ratio:>7.2f} {compressMBps:>12.1f} '
+                  '{decompressMBps:>14.1f}'.format(**result))
+    else:
+        parser.print_help()
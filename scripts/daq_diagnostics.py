@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Always-on stage timing for the continuous input scripts.
+
+Each stage (read, deliver, write, stats, plot, readouts...) is timed with two
+perf_counter_ns() calls around it and the duration goes into a log-linear
+histogram: 32 linear sub-buckets per power of two, so any duration from a
+nanosecond to hours is kept to within ~3% in a fixed 2k-entry table and a
+record costs a few list operations. Counters (blocks, samples, overruns...)
+sit next to them. A probe is
+
+    start = time.perf_counter_ns()
+    ...
+    diagnostics.record('plot', time.perf_counter_ns() - start)
+
+The engine classes take a diagnostics attribute that is None until one is
+attached, so the probes cost a single test when they are off.
+"""
+
+import json
+import threading
+import time
+
+
+class latencyHistogram:
+    # HDR style histogram of durations in ns. Values below 2 * subBuckets are
+    # exact, above that each power of two is split into subBuckets buckets.
+
+    def __init__(self, subBucketBits=5):
+        self.subBucketBits = subBucketBits
+        self.subBuckets = 1 << subBucketBits
+        self.counts = [0] * (64 * self.subBuckets)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, ns):
+        if ns < 0:
+            ns = 0
+        shift = ns.bit_length() - self.subBucketBits - 1
+        if shift < 0:
+            shift = 0
+        self.counts[shift * self.subBuckets + (ns >> shift)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+
+    def lowerBound(self, index):
+        # smallest value falling into bucket index
+        if index < 2 * self.subBuckets:
+            return index
+        shift = index // self.subBuckets - 1
+        return (index - shift * self.subBuckets) << shift
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0
+        target = q / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(self.lowerBound(index + 1) - 1, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'meanUs': self.mean() / 1e3,
+            'minUs': (self.min or 0) / 1e3,
+            'p50Us': self.percentile(50) / 1e3,
+            'p90Us': self.percentile(90) / 1e3,
+            'p99Us': self.percentile(99) / 1e3,
+            'p999Us': self.percentile(99.9) / 1e3,
+            'maxUs': self.max / 1e3,
+        }
+
+    def buckets(self):
+        # {lower bound in ns: count} of the non empty buckets
+        return {self.lowerBound(index): count
+                for index, count in enumerate(self.counts) if count}
+
+
+class diagnostics:
+    # Histograms per stage and counters for one session. Each stage is only
+    # recorded from one thread, so records need no lock. Counters are bumped
+    # from several threads (reader, consumers, writer), so the lock guards
+    # them as well as creating a stage.
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, latencyHistogram())
+        return histogram
+
+    def record(self, stage, ns):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histogram(stage)
+        histogram.record(ns)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            'startTime': self.startTime,
+            'elapsed': time.time() - self.startTime,
+            'counters': counters,
+            'stages': {stage: histogram.summary()
+                       for stage, histogram in list(self.histograms.items())},
+        }
+
+    def dump(self, filename):
+        results = self.snapshot()
+        results['histograms'] = {stage: histogram.buckets()
+                                 for stage, histogram in list(self.histograms.items())}
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=2)
+        return filename
+
+    def report(self):
+        # the snapshot as text lines, for the diagnostics panel and consoles
+        snapshot = self.snapshot()
+        lines = ['{:<12s} {:>8s} {:>9s} {:>9s} {:>9s}'.format('stage (us)', 'count', 'p50', 'p99', 'max')]
+        for stage, summary in sorted(snapshot['stages'].items()):
+            lines.append('{:<12s} {count:>8d} {p50Us:>9.1f} {p99Us:>9.1f} {maxUs:>9.1f}'.format(
+                stage, **summary))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('{:<12s} {:>8d}'.format(name, value))
+        return '\n'.join(lines)
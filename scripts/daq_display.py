@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+"""
+Live plot helpers for the graphData frames of the continuous input scripts.
+"""
+
+import time
+
+import numpy as np
+
+
+class displayBuffer:
+    # Circular buffer behind a scrolling line plot. New samples overwrite the
+    # oldest ones in place, so an update costs O(new samples) instead of the
+    # np.roll of the whole window. The window is drawn as two segments, the
+    # older one from the write index to the end and the newer one from the
+    # start to the write index; one extra slot mirrors slot 0 so the two
+    # segments join up. Min and max are kept per chunk of the buffer so
+    # autoscaling only rescans the chunks an update touched.
+
+    def __init__(self, maxPoints, chunk=64):
+        self.maxPoints = maxPoints
+        self.ydata = np.zeros(maxPoints + 1)
+        self.xdata = np.arange(maxPoints + 1)
+
+        # next slot to write, which is also the oldest sample
+        self.index = 0
+
+        self.chunk = chunk
+        nChunks = -(-maxPoints // chunk)
+        self.chunkMin = np.zeros(nChunks)
+        self.chunkMax = np.zeros(nChunks)
+
+    def append(self, new):
+        new = np.asarray(new)
+        n = len(new)
+        if n == 0:
+            return
+        if n >= self.maxPoints:
+            self.ydata[:self.maxPoints] = new[-self.maxPoints:]
+            self.index = 0
+            self.updateChunks(0, self.maxPoints)
+        else:
+            first = min(n, self.maxPoints - self.index)
+            self.ydata[self.index:self.index + first] = new[:first]
+            self.ydata[:n - first] = new[first:]
+            self.updateChunks(self.index, self.index + first)
+            if n > first:
+                self.updateChunks(0, n - first)
+            self.index = (self.index + n) % self.maxPoints
+        self.ydata[self.maxPoints] = self.ydata[0]
+
+    def updateChunks(self, start, stop):
+        first = start // self.chunk
+        last = -(-stop // self.chunk)
+        values = self.ydata[first * self.chunk:min(last * self.chunk, self.maxPoints)]
+        starts = np.arange(0, len(values), self.chunk)
+        self.chunkMin[first:last] = np.minimum.reduceat(values, starts)
+        self.chunkMax[first:last] = np.maximum.reduceat(values, starts)
+
+    def segments(self):
+        # ((x, y) of the older samples, (x, y) of the newer samples), as views
+        split = self.maxPoints - self.index
+        if self.index == 0:
+            older = (self.xdata[:self.maxPoints], self.ydata[:self.maxPoints])
+        else:
+            older = (self.xdata[:split + 1], self.ydata[self.index:])
+        newer = (self.xdata[split:self.maxPoints], self.ydata[:self.index])
+        return older, newer
+
+    def ordered(self):
+        # the window oldest to newest, as one array
+        return np.concatenate((self.ydata[self.index:self.maxPoints], self.ydata[:self.index]))
+
+    def limits(self):
+        return self.chunkMin.min(), self.chunkMax.max()
+
+
+class blitter:
+    # Redraws only the given artists over a cached background of their axes,
+    # or of the whole figure when ax is a Figure holding several axes.
+    # Any full draw of the canvas (first show, resize, new axis limits) goes
+    # through onDraw and refreshes the cache, so callers only need to fall
+    # back to draw_idle() when something outside the artists changes.
+
+    def __init__(self, canvas, ax, artists):
+        self.canvas = canvas
+        self.ax = ax
+        self.artists = artists
+        self.background = None
+        for artist in artists:
+            artist.set_animated(True)
+        self.drawId = canvas.mpl_connect('draw_event', self.onDraw)
+
+    def disconnect(self):
+        # call before replacing the artists, or a stale blitter keeps drawing them
+        self.canvas.mpl_disconnect(self.drawId)
+
+    def onDraw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.drawArtists()
+
+    def drawArtists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def update(self):
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.drawArtists()
+        self.canvas.blit(self.ax.bbox)
+
+
+class displayScheduler:
+    # Calls draw() from the Tk loop at a target frame rate, independent of the
+    # block size and sample rate. draw() gathers whatever arrived since the
+    # last frame and returns False if there was nothing to show. A draw that
+    # runs over the frame period means the frames it overlapped are skipped
+    # rather than queued, and they are counted in skippedFrames.
+
+    def __init__(self, master, fps, draw):
+        self.master = master
+        self.period = 1.0 / fps
+        self.draw = draw
+        self.running = False
+        self.afterId = None
+        self.due = 0.0
+
+        # daq_diagnostics.diagnostics for stage timing, if attached
+        self.diagnostics = None
+
+        self.frames = 0
+        self.skippedFrames = 0
+        self.drawTimeLast = 0.0
+        self.drawTimeMean = 0.0
+        self.drawTimeMax = 0.0
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.due = time.perf_counter()
+            self.afterId = self.master.after(0, self.tick)
+
+    def stop(self):
+        self.running = False
+        if self.afterId is not None:
+            self.master.after_cancel(self.afterId)
+            self.afterId = None
+
+    def tick(self):
+        if not self.running:
+            return
+
+        start = time.perf_counter()
+        drawn = self.draw()
+        elapsed = time.perf_counter() - start
+
+        if self.diagnostics is not None:
+            # how late Tk ran this frame, then how long it took
+            self.diagnostics.record('frameLate', int(max(start - self.due, 0) * 1e9))
+            if drawn:
+                self.diagnostics.record('draw', int(elapsed * 1e9))
+
+        if drawn:
+            self.frames = self.frames + 1
+            self.drawTimeLast = elapsed
+            self.drawTimeMax = max(self.drawTimeMax, elapsed)
+            # exponential moving average over roughly the last second
+            weight = min(1.0, self.period)
+            self.drawTimeMean = self.drawTimeMean + weight * (elapsed - self.drawTimeMean)
+            self.skippedFrames = self.skippedFrames + int(elapsed // self.period)
+
+        # next frame one period after this one started, or right away if late
+        delay = max(self.period - elapsed, 0.001)
+        self.due = start + elapsed + delay
+        self.afterId = self.master.after(int(delay * 1000), self.tick)
+
+    def stats(self):
+        return {
+            'fps': 1.0 / self.period,
+            'frames': self.frames,
+            'skippedFrames': self.skippedFrames,
+            'drawTimeLastMs': self.drawTimeLast * 1e3,
+            'drawTimeMeanMs': self.drawTimeMean * 1e3,
+            'drawTimeMaxMs': self.drawTimeMax * 1e3,
+        }
+
+
+class readoutUpdater:
+    # Numeric readouts bound to tk.StringVars and refreshed at a fixed, human
+    # readable rate. set() only stores the latest value, so it can be called
+    # per block at no Tcl cost; each tick formats the values and only touches
+    # the variables whose text actually changed.
+
+    def __init__(self, master, rate=5):
+        self.master = master
+        self.interval = int(1000 / rate)
+        self.readouts = {}
+        self.values = {}
+        self.running = False
+
+        # daq_diagnostics.diagnostics for stage timing, if attached
+        self.diagnostics = None
+
+    def bind(self, name, variable, format='{:4.3f}'):
+        self.readouts[name] = [variable, format, variable.get()]
+
+    def unbind(self, name):
+        self.readouts.pop(name, None)
+        self.values.pop(name, None)
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.master.after(self.interval, self.tick)
+
+    def stop(self):
+        self.running = False
+
+    def tick(self):
+        if not self.running:
+            return
+        self.refresh()
+        self.master.after(self.interval, self.tick)
+
+    def refresh(self):
+        start = time.perf_counter_ns()
+        for name, value in self.values.items():
+            readout = self.readouts[name]
+            text = readout[1].format(value)
+            if text != readout[2]:
+                readout[0].set(text)
+                readout[2] = text
+        if self.diagnostics is not None:
+            self.diagnostics.record('readouts', time.perf_counter_ns() - start)
+
+
+def minMaxDecimate(x, y, nBuckets):
+    # Keeps the smallest and largest sample of each of nBuckets equal buckets,
+    # in time order, so peaks survive however far the window is reduced.
+    n = len(y)
+    if nBuckets < 1 or n <= 2 * nBuckets:
+        return x, y
+
+    size = n // nBuckets
+    full = size * nBuckets
+    buckets = y[:full].reshape(nBuckets, size)
+    lowest = buckets.argmin(axis=1)
+    highest = buckets.argmax(axis=1)
+
+    starts = np.arange(0, full, size)
+    index = np.stack((np.minimum(lowest, highest), np.maximum(lowest, highest)), axis=1)
+    index = (index + starts[:, None]).ravel()
+
+    # the few samples left over after the last full bucket are kept as is
+    index = np.concatenate((index, np.arange(full, n)))
+    return x[index], y[index]
+
+
+def lttbDecimate(x, y, nOut):
+    # Largest-triangle-three-buckets: keeps the first and last points and, per
+    # bucket, the point making the largest triangle with the point kept from
+    # the previous bucket and the mean of the next one. Smoother looking than
+    # min/max, but each bucket keeps only one point.
+    n = len(y)
+    if nOut < 3 or n <= nOut:
+        return x, y
+
+    edges = np.linspace(1, n - 1, nOut - 1).astype(int)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # mean point of each bucket, the next bucket for the last one is the end point
+    counts = np.diff(edges)
+    meanX = np.append(np.add.reduceat(x[:-1], edges[:-1]) / counts, x[-1])
+    meanY = np.append(np.add.reduceat(y[:-1], edges[:-1]) / counts, y[-1])
+
+    index = np.empty(nOut, dtype=int)
+    index[0] = 0
+    index[-1] = n - 1
+    previous = 0
+    for bucket in range(nOut - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        area = np.abs((x[previous] - meanX[bucket + 1]) * (y[start:stop] - y[previous])
+                      - (x[previous] - x[start:stop]) * (meanY[bucket + 1] - y[previous]))
+        previous = start + int(area.argmax())
+        index[bucket + 1] = previous
+    return x[index], y[index]
+
+
+def decimate(x, y, pixels, method='minmax'):
+    # reduces (x, y) to about two points per pixel column
+    if method == 'minmax':
+        return minMaxDecimate(x, y, int(pixels))
+    if method == 'lttb':
+        return lttbDecimate(x, y, int(2 * pixels))
+    return x, y
+
+
+def niceStep(span, ticks=8):
+    # 1, 2 or 5 times a power of ten, at least span / ticks
+    if not span > 0:
+        return 1.0
+    rough = span / ticks
+    power = 10.0 ** np.floor(np.log10(rough))
+    for multiple in (1.0, 2.0, 5.0):
+        if rough <= multiple * power:
+            return multiple * power
+    return 10.0 * power
+
+
+def paddedLimits(low, high, margin=0.05):
+    # the same 5% padding autoscale_view would add, rounded outwards to a
+    # nice step, so a small change in the data range mostly gives the same
+    # limits back
+    if high == low:
+        pad = abs(low) * margin if low else 1.0
+    else:
+        pad = (high - low) * margin
+    low, high = low - pad, high + pad
+    step = niceStep(high - low)
+    return float(np.floor(low / step) * step), float(np.ceil(high / step) * step)
+
+
+class axisScaler:
+    # Y limits of one live axis, changed as rarely as possible, since every
+    # change costs a full redraw of the figure instead of a blit. update()
+    # returns the new limits, or None while they stay. They grow at once to
+    # take in data that leaves them, and shrink to the data only after
+    # shrinkFrames frames in which it fit smaller limits, or straight away
+    # once it needs less than shrinkFraction of them.
+
+    def __init__(self, shrinkFrames=30, shrinkFraction=0.25):
+        self.shrinkFrames = shrinkFrames
+        self.shrinkFraction = shrinkFraction
+        self.limits = None
+        self.smallerFrames = 0
+
+    def update(self, low, high):
+        target = paddedLimits(low, high)
+        if self.limits is None:
+            return self.set(target)
+        current = self.limits
+        if target[0] < current[0] or target[1] > current[1]:
+            return self.set((min(target[0], current[0]), max(target[1], current[1])))
+        if target == current:
+            self.smallerFrames = 0
+            return None
+
+        self.smallerFrames = self.smallerFrames + 1
+        fraction = (target[1] - target[0]) / (current[1] - current[0])
+        if self.smallerFrames >= self.shrinkFrames or fraction <= self.shrinkFraction:
+            return self.set(target)
+        return None
+
+    def set(self, limits):
+        self.limits = limits
+        self.smallerFrames = 0
+        return limits
+
+
+class stackedPlot:
+    # One scrolling axes per channel, stacked in a single figure so every
+    # channel is drawn by one canvas draw or one blit. The figure and its
+    # canvas come from the caller, a Tk canvas for the GUI or an Agg one to
+    # draw off screen. Lines are blitted over the cached background and the
+    # figure is only drawn in full when an axisScaler changes the limits.
+
+    def __init__(self, fig, canvas, maxPoints=1000, blit=True, decimation='minmax'):
+        self.fig = fig
+        self.canvas = canvas
+        self.maxPoints = maxPoints
+        self.blit = blit
+        self.decimation = decimation  # 'minmax', 'lttb' or None
+        self.blitter = None
+        self.titles = []
+
+    def setChannels(self, titles):
+        # rebuilds the axes, the plots start empty again
+        self.titles = list(titles)
+        n = len(self.titles)
+        if self.blitter is not None:
+            self.blitter.disconnect()
+            self.blitter = None
+        self.fig.clear()
+
+        self.axes = []
+        self.buffers = []
+        self.lines = []
+        self.scalers = [axisScaler() for title in self.titles]
+        for i, title in enumerate(self.titles):
+            ax = self.fig.add_subplot(n, 1, i + 1)
+            buffer = displayBuffer(self.maxPoints)
+            # older and newer part of the circular buffer, drawn end to end
+            (x0, y0), (x1, y1) = buffer.segments()
+            line, = ax.plot(x0, y0, color='blue')
+            lineNew, = ax.plot(x1, y1, color='blue')
+            ax.set_ylabel(title)
+            ax.set_xlim(0, self.maxPoints)
+            if i < n - 1:
+                ax.tick_params(labelbottom=False)
+            self.axes.append(ax)
+            self.buffers.append(buffer)
+            self.lines.append((line, lineNew))
+
+        if self.blit:
+            self.blitter = blitter(self.canvas, self.fig,
+                                   [line for pair in self.lines for line in pair])
+        self.canvas.draw()
+
+    def append(self, block):
+        # block is (channels x samples)
+        for buffer, values in zip(self.buffers, block):
+            buffer.append(values)
+
+    def draw(self, idle=True):
+        # idle=False renders now, so the caller can time the draw
+        # no point handing matplotlib more than ~2 points per pixel column
+        pixels = self.axes[0].bbox.width
+        rescaled = False
+        for i, buffer in enumerate(self.buffers):
+            (x0, y0), (x1, y1) = buffer.segments()
+            if self.decimation is not None and self.maxPoints > 2 * pixels:
+                x0, y0 = decimate(x0, y0, pixels * len(y0) / self.maxPoints, self.decimation)
+                x1, y1 = decimate(x1, y1, pixels * len(y1) / self.maxPoints, self.decimation)
+
+            line, lineNew = self.lines[i]
+            line.set_data(x0, y0)
+            lineNew.set_data(x1, y1)
+
+            # rescale only when the quantized limits have to change
+            yLimits = self.scalers[i].update(*buffer.limits())
+            if yLimits is not None:
+                self.axes[i].set_ylim(*yLimits)
+                rescaled = True
+
+        if self.blit and not rescaled:
+            self.blitter.update()
+        elif idle:
+            self.canvas.draw_idle()
+        else:
+            self.canvas.draw()
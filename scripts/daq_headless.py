@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Headless recording sessions: the task setup, acquisition engine and recording
+path of the GUI scripts, without Tk or matplotlib, for long unattended runs.
+
+    python daq_headless.py --rate 10000 --samples 1000 --duration 3600 \
+        --channel Dev1/ai0,5,0,5,0,PSI,Light --channel Dev1/ai1,5,-5,5,-5,cmH20
+
+Each --channel is 'physical channel, max voltage, min voltage, max sensor
+value, min sensor value, sensor units[, name]', the columns of the GUI channel
+table. Settings can also come from a JSON config file, with command line
+options taking precedence:
+
+    {"sampleRate": 10000, "numberOfSamples": 1000, "mrn": "999999",
+     "saveDir": "C://Users/mbarb1/pressure_can_data/",
+     "channels": [{"physicalChannel": "Dev1/ai0", "maxVoltage": 5,
+                   "minVoltage": 0, "maxSensor": 5, "minSensor": 0,
+                   "units": "PSI", "name": "Light"}]}
+
+A status line is printed every statusInterval seconds and the session stops
+after duration seconds, or on Ctrl-C. Stage timings are written next to the
+recording as '<recording>.diagnostics.json'. With --simulate the task comes from
+daq_simulated, so sessions can be load tested without NI hardware; add
+--fast to run the simulated clock as fast as the reads go. --raw reads and
+records the unscaled int16 codes, scaled only when the recording is read.
+--stream 127.0.0.1:5555 (or unix:path) also publishes every block to live
+subscribers through a daq_stream server. --format compressed records a
+daq_compressed '.daqz' file, coded with --codec at --level. With
+--segment-seconds or --segment-mb the recording is split into numbered
+segments listed in '<recording>.index.json'.
+"""
+
+import argparse
+import json
+import time
+from datetime import date
+
+import numpy as np
+
+from daq_acquisition import (channelConfig, createTask, deviceScaling, ringBuffer,
+                             acquisitionThread, eventAcquisition)
+from daq_recording import (binaryRecorder, textRecorder, rotatingRecorder, recordingWriter,
+                           channelScaling, uniqueFileName)
+from daq_compressed import compressedRecorder, codecs
+from daq_diagnostics import diagnostics
+from daq_stream import streamServer
+
+
+defaults = {
+    'sampleRate': 100,
+    'numberOfSamples': 25,
+    'mrn': '999999',
+    'saveDir': '',
+    'readMode': 'thread',
+    'fileFormat': 'binary',
+    'recordingDtype': 'float32',
+    'codec': 'zlib',
+    'level': None,
+    'segmentSeconds': None,
+    'segmentBytes': None,
+    'writerPolicy': 'spill',
+    'duration': None,
+    'statusInterval': 5.0,
+    'simulate': False,
+    'overwrite': True,
+    'realTime': True,
+    'raw': False,
+    'stream': None,
+    'streamPolicy': 'downsample',
+    'channels': [
+        {'physicalChannel': 'Dev1/ai0', 'maxVoltage': 5, 'minVoltage': 0,
+         'maxSensor': 5, 'minSensor': 0, 'units': 'PSI', 'name': 'Light'},
+        {'physicalChannel': 'Dev1/ai1', 'maxVoltage': 5, 'minVoltage': -5,
+         'maxSensor': 5, 'minSensor': -5, 'units': 'cmH20', 'name': 'Pressure'},
+    ],
+}
+
+
+def parseChannel(text):
+    # 'Dev1/ai0,5,0,5,0,PSI[,Light]' -> the settings of one channel
+    fields = [field.strip() for field in text.split(',')]
+    assert len(fields) in (6, 7), 'Error, channel needs 6 or 7 fields, recieved {:s}'.format(text)
+    channel = {'physicalChannel': fields[0], 'maxVoltage': float(fields[1]),
+               'minVoltage': float(fields[2]), 'maxSensor': float(fields[3]),
+               'minSensor': float(fields[4]), 'units': fields[5]}
+    if len(fields) == 7:
+        channel['name'] = fields[6]
+    return channel
+
+
+def channelDict(channel):
+    # channelConfig -> the settings of one channel, as parseChannel gives them
+    return {'physicalChannel': channel.physicalChannel, 'maxVoltage': channel.maxVoltage,
+            'minVoltage': channel.minVoltage, 'maxSensor': channel.maxSensor,
+            'minSensor': channel.minSensor, 'units': channel.units, 'name': channel.name}
+
+
+def channelConfigs(channels):
+    return [channelConfig(channel['physicalChannel'], float(channel['minVoltage']),
+                          float(channel['maxVoltage']), float(channel['minSensor']),
+                          float(channel['maxSensor']), channel['units'],
+                          name=channel.get('name'))
+            for channel in channels]
+
+
+fileExtensions = {'binary': '.daq', 'compressed': '.daqz', 'text': '.txt'}
+
+
+def sessionFileName(settings):
+    # same naming as the GUI sessions, never an existing recording
+    formatted_date = date.today().strftime("%Y%m%d")
+    extension = fileExtensions[settings['fileFormat']]
+    return uniqueFileName(settings['saveDir'] + "cannPressure_" + settings['mrn'] + "_"
+                          + formatted_date + extension)
+
+
+class headlessSession:
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.sampleRate = int(settings['sampleRate'])
+        self.numberOfSamples = int(settings['numberOfSamples'])
+        self.channels = channelConfigs(settings['channels'])
+        self.filename = settings.get('filename') or sessionFileName(settings)
+
+        readMode = settings['readMode']
+        fileFormat = settings['fileFormat']
+        assert (readMode == 'thread') or (readMode == 'event'), 'Error, read mode unknown, recieved {:s}'.format(readMode)
+        assert fileFormat in fileExtensions, 'Error, file format unknown, recieved {:s}'.format(fileFormat)
+
+    def start(self):
+        nChannels = len(self.channels)
+        self.bufferSize = self.numberOfSamples * 3
+        self.task = createTask(self.channels, self.sampleRate, self.bufferSize,
+                               simulate=self.settings['simulate'],
+                               realTime=self.settings['realTime'],
+                               overwrite=self.settings['overwrite'])
+
+        raw = self.settings['raw']
+        self.slopes = [channel.slope() for channel in self.channels]
+        self.scaling = channelScaling(deviceScaling(self.task), self.slopes) if raw else None
+        self.dtype = np.dtype(np.int16 if raw else np.float64)
+        self.ring = self.createRing(nChannels, self.dtype)
+
+        self.diagnostics = diagnostics()
+        if self.settings['readMode'] == 'event':
+            self.acquisition = eventAcquisition(
+                self.task, self.ring, self.numberOfSamples, self.sampleRate, raw=raw)
+        else:
+            self.acquisition = acquisitionThread(
+                self.task, self.ring, self.numberOfSamples, self.sampleRate, raw=raw)
+
+        segmentSeconds = self.settings['segmentSeconds']
+        segmentBytes = self.settings['segmentBytes']
+        if segmentSeconds or segmentBytes:
+            # segments are rolled on the writer thread
+            recorder = rotatingRecorder(self.filename, self.openRecorder, self.sampleRate,
+                                        segmentSeconds=segmentSeconds, segmentBytes=segmentBytes)
+            recorder.diagnostics = self.diagnostics
+        else:
+            recorder = self.openRecorder(self.filename)
+        self.recorder = recorder
+        self.writer = recordingWriter(recorder, policy=self.settings['writerPolicy'])
+        self.acquisition.diagnostics = self.diagnostics
+        self.writer.diagnostics = self.diagnostics
+        self.writer.start()
+        self.acquisition.addConsumer(self.writer.put)
+
+        self.server = None
+        if self.settings['stream']:
+            self.server = streamServer(self.settings['stream'], self.describe(),
+                                       policy=self.settings['streamPolicy'])
+            self.server.diagnostics = self.diagnostics
+            self.server.start()
+            self.acquisition.addConsumer(self.server.publish)
+
+        self.task.start()
+        # nothing reaches the writer before acquisition.start()
+        self.recorder.setStartTime(time.time())
+        self.acquisition.start()
+
+        self.startTime = time.perf_counter()
+        self.lastStatus = (self.startTime, 0)
+
+    def openRecorder(self, filename, firstSample=0, startTime=None, pyramidFactor=10):
+        # a recording of the session in the chosen format, or one segment of it
+        channelNames = [channel.name for channel in self.channels]
+        units = [channel.units for channel in self.channels]
+        if self.settings['fileFormat'] == 'binary':
+            return binaryRecorder(filename, channelNames, self.slopes, units, self.sampleRate,
+                                  dtype=self.settings['recordingDtype'], startTime=startTime,
+                                  pyramidFactor=pyramidFactor, scaling=self.scaling,
+                                  firstSample=firstSample)
+        if self.settings['fileFormat'] == 'compressed':
+            # chunks are compressed on the writer thread
+            recorder = compressedRecorder(filename, channelNames, self.slopes, units,
+                                          self.sampleRate, dtype=self.settings['recordingDtype'],
+                                          startTime=startTime, codec=self.settings['codec'],
+                                          level=self.settings['level'],
+                                          pyramidFactor=pyramidFactor, scaling=self.scaling,
+                                          firstSample=firstSample)
+            recorder.diagnostics = self.diagnostics
+            return recorder
+        return textRecorder(filename, len(self.channels), scaling=self.scaling,
+                            firstSample=firstSample)
+
+    def describe(self):
+        # what the blocks of this session hold, for anything reading them
+        # outside the session
+        description = {
+            'channels': [channel.name for channel in self.channels],
+            'units': [channel.units for channel in self.channels],
+            'slopes': self.slopes,
+            'sampleRate': self.sampleRate,
+            'numberOfSamples': self.numberOfSamples,
+            'dtype': self.dtype.str,
+        }
+        if self.scaling is not None:
+            description['scaling'] = self.scaling.description()
+        return description
+
+    def createRing(self, nChannels, dtype):
+        # nothing reads the ring here, it only has to hold the blocks in flight
+        return ringBuffer(nChannels, self.numberOfSamples * 4, dtype=dtype)
+
+    def status(self):
+        now = time.perf_counter()
+        samples = self.acquisition.samplesRead
+        lastTime, lastSamples = self.lastStatus
+        self.lastStatus = (now, samples)
+        writer = self.writer.stats()
+        return {
+            'elapsed': now - self.startTime,
+            'samples': samples,
+            'rate': (samples - lastSamples) / (now - lastTime) if now > lastTime else 0.0,
+            'bufferFill': 100 * self.task.in_stream.avail_samp_per_chan / self.bufferSize,
+            'queueDepth': writer['queueDepth'],
+            # bytes in the recording file (over all segments), not in the blocks queued for it
+            'fileBytes': self.recorder.bytesWritten,
+            'samplesLost': self.acquisition.samplesLost + writer['droppedSamples'],
+        }
+
+    def printStatus(self):
+        print('{elapsed:8.1f} s  {samples:12d} samples  {rate:10.1f} S/s  '
+              'buffer {bufferFill:5.1f}%  queue {queueDepth:4d}  '
+              'file {fileBytes:14d} B  lost {samplesLost}'.format(**self.status()),
+              flush=True)
+
+    def run(self):
+        duration = self.settings['duration']
+        interval = float(self.settings['statusInterval'])
+        print(self.filename)
+        self.start()
+        try:
+            while True:
+                if duration is None:
+                    time.sleep(interval)
+                else:
+                    remaining = duration - (time.perf_counter() - self.startTime)
+                    if remaining <= 0:
+                        break
+                    time.sleep(min(interval, remaining))
+                if self.acquisition.error is not None:
+                    print('Acquisition stopped: {}'.format(self.acquisition.error))
+                    break
+                if self.writer.error is not None:
+                    print('Recording stopped: {}'.format(self.writer.error))
+                    break
+                self.printStatus()
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stop(self):
+        self.acquisition.stop(timeout=self.numberOfSamples / self.sampleRate + 1)
+        self.task.stop()
+        self.acquisition.unregister()
+        if self.server is not None:
+            self.server.close()
+            print('Stream: {} blocks, subscribers {}'.format(
+                self.server.sequence, self.server.stats()['subscribers']))
+        print('Block latency (ms) last {latencyLastMs:.2f}, mean {latencyMeanMs:.2f}, '
+              'p99 {latencyP99Ms:.2f}, max {latencyMaxMs:.2f}; '
+              'CPU {cpuPercent:.1f}%; lost {samplesLost} samples in {gaps} gaps'.format(
+                  **self.acquisition.summary()))
+        self.task.close()
+        self.writer.close()
+        print('Writer: {bytesWritten} bytes at {bytesPerSecond:.0f} B/s, '
+              'max queue depth {maxQueueDepth}, worst stall {worstStall:.3f} s, '
+              'spilled {spilledBlocks} blocks, dropped {droppedSamples} samples'.format(
+                  **self.writer.stats()))
+        if isinstance(self.recorder, rotatingRecorder):
+            print('Segments: {} listed in {}'.format(len(self.recorder.index['segments']),
+                                                     self.recorder.indexFilename))
+        elif isinstance(self.recorder, compressedRecorder):
+            print('Compression: {codec} level {level}, ratio {ratio:.2f}, {compressSeconds:.2f} s CPU '
+                  'at {compressMBps:.1f} MB/s in {chunks} chunks'.format(**self.recorder.stats()))
+        print(self.diagnostics.report())
+        print(self.diagnostics.dump(self.filename + '.diagnostics.json'))
+
+
+def loadSettings(args):
+    settings = dict(defaults)
+    if args.config is not None:
+        with open(args.config) as f:
+            settings.update(json.load(f))
+
+    options = {'sampleRate': args.rate, 'numberOfSamples': args.samples, 'mrn': args.mrn,
+               'saveDir': args.dir, 'filename': args.filename, 'readMode': args.mode,
+               'fileFormat': args.format, 'codec': args.codec, 'level': args.level,
+               'writerPolicy': args.policy, 'segmentSeconds': args.segment_seconds,
+               'duration': args.duration, 'statusInterval': args.status}
+    settings.update({key: value for key, value in options.items() if value is not None})
+    if args.simulate:
+        settings['simulate'] = True
+    if args.no_overwrite:
+        settings['overwrite'] = False
+    if args.fast:
+        settings['realTime'] = False
+    if args.raw:
+        settings['raw'] = True
+    if args.stream:
+        settings['stream'] = args.stream
+    if args.segment_mb:
+        settings['segmentBytes'] = int(args.segment_mb * (1 << 20))
+    if args.channel:
+        settings['channels'] = [parseChannel(channel) for channel in args.channel]
+    return settings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record a pydaq session without the GUI')
+    parser.add_argument('--config', help='JSON file of session settings')
+    parser.add_argument('--channel', action='append',
+                        help='physical channel,max V,min V,max sensor,min sensor,units[,name]')
+    parser.add_argument('--rate', type=int, help='sample rate (Hz)')
+    parser.add_argument('--samples', type=int, help='samples per channel per read')
+    parser.add_argument('--mrn', help='patient MRN, used in the file name')
+    parser.add_argument('--dir', help='directory for the recording')
+    parser.add_argument('--filename', help='recording file name, overrides --mrn and --dir')
+    parser.add_argument('--mode', choices=('thread', 'event'), help='read mode')
+    parser.add_argument('--format', choices=sorted(fileExtensions), help='file format')
+    parser.add_argument('--codec', choices=sorted(codecs), help='codec of compressed recordings')
+    parser.add_argument('--level', type=int, help='compression level')
+    parser.add_argument('--policy', choices=recordingWriter.policies,
+                        help='what the writer does when its queue is full')
+    parser.add_argument('--duration', type=float, help='seconds to record, default until Ctrl-C')
+    parser.add_argument('--status', type=float, help='seconds between status lines')
+    parser.add_argument('--simulate', action='store_true', help='use a simulated task')
+    parser.add_argument('--no-overwrite', action='store_true',
+                        help='stop on a DAQ buffer overrun instead of logging a gap')
+    parser.add_argument('--fast', action='store_true',
+                        help='run the simulated clock as fast as possible')
+    parser.add_argument('--raw', action='store_true',
+                        help='record the unscaled int16 codes')
+    parser.add_argument('--stream', help='publish blocks on host:port or unix:path')
+    parser.add_argument('--segment-seconds', type=float,
+                        help='roll the recording over into a new segment every so many seconds')
+    parser.add_argument('--segment-mb', type=float,
+                        help='roll the recording over once a segment reaches this size')
+
+    headlessSession(loadSettings(parser.parse_args())).run()
@@ -0,0 +1,1153 @@
+# -*- coding: utf-8 -*-
+"""
+Binary session recordings for the continuous input scripts.
+
+A recording is a fixed size header followed by raw samples stored sample
+major (one frame of all channels per sample), so blocks are appended with a
+single write and the file stays open for the whole session. The header holds
+a small struct (magic, version, header size, sample count) and a JSON
+description of the channels, their scale slopes and units, the sample rate
+and the start time.
+
+The data section can be mapped with numpy.memmap, so openRecording() gives
+random access to any time window of a long session without reading the
+file. While recording, the file is grown in large preallocated steps and
+trimmed to its real length when the session closes.
+
+Alongside the data, a binaryRecorder can keep a min/max pyramid: level k
+holds the min and max of every factor**k samples, updated per block and
+written to '<recording>.pyramid<k>' files, so the history of a whole
+session can be drawn at screen resolution without touching the raw data.
+
+Sessions read with raw=True are stored as the converter's int16 codes, a
+quarter of the size of float64, with each channel's device scaling
+polynomial and sensor slope in the header ('scaling'). The codes are only
+turned into values where floats are needed: recordingView.window(), the
+pyramid, text export and readRecording() scale them with channelScaling.
+
+Samples missing from a session, skipped after a DAQ buffer overrun or
+dropped by the writer, are not padded out. Each run of them is logged as a
+gap in '<recording>.gaps', one JSON line per gap with the acquisition index
+of its first missing sample, how many were lost and the file index where
+the data carries on. recordingView maps times through the gaps, and text
+recordings keep the true sample number in their first column.
+
+daq_compressed writes the same recordings chunked and losslessly
+compressed ('.daqz'); openRecording() and readRecording() read either.
+A rotatingRecorder splits a session into segment recordings of a set
+duration or size, listed in '<recording>.index.json', with one pyramid for
+the whole session, and opening that index gives a segmentedView reading
+them back as one recording. Text segments are read through textView.
+
+Recorders are driven by a recordingWriter thread, which takes blocks from
+the acquisition side through a bounded queue so disk stalls never reach the
+DAQ reads.
+
+Text export to the old 'line_num, val1, val2' format is an offline step:
+
+    python daq_recording.py export cannPressure_999999_20240101.daq
+"""
+
+import argparse
+import json
+import os
+import queue
+import struct
+import tempfile
+import threading
+import time
+import warnings
+
+import numpy as np
+
+
+MAGIC = b'PYDAQREC'
+VERSION = 1
+HEADER_SIZE = 4096
+headerStruct = struct.Struct('<8sIIQ')  # magic, version, header size, sample count
+spillStruct = struct.Struct('<qII4s')  # first sample, channels, samples, dtype
+
+
+class minMaxPyramid:
+    # Incremental min/max decimation of a (channels x samples) stream. Each
+    # level reduces the one below it by factor, and only the samples that
+    # don't yet fill a bucket are carried over, so update is O(block).
+
+    def __init__(self, nChannels, factor=10, levels=6, basename=None):
+        self.nChannels = nChannels
+        self.factor = factor
+        self.levels = levels
+        self.basename = basename
+        self.counts = [0] * levels
+
+        # samples or buckets waiting for a full bucket at each level
+        self.pendingMin = [np.empty((nChannels, 0)) for level in range(levels)]
+        self.pendingMax = [np.empty((nChannels, 0)) for level in range(levels)]
+
+        self.files = []
+        if basename is not None:
+            with open(basename + '.pyramid.json', 'w') as f:
+                json.dump({'nChannels': nChannels, 'factor': factor,
+                           'levels': levels, 'dtype': '<f4'}, f)
+            self.files = [open(pyramidLevelName(basename, level + 1), 'wb')
+                          for level in range(levels)]
+
+    def update(self, block):
+        mins = block
+        maxs = block
+        for level in range(self.levels):
+            mins = np.concatenate((self.pendingMin[level], mins), axis=1)
+            maxs = np.concatenate((self.pendingMax[level], maxs), axis=1)
+
+            full = mins.shape[1] // self.factor * self.factor
+            self.pendingMin[level] = mins[:, full:]
+            self.pendingMax[level] = maxs[:, full:]
+            if full == 0:
+                break
+
+            shape = (self.nChannels, full // self.factor, self.factor)
+            mins = mins[:, :full].reshape(shape).min(axis=2)
+            maxs = maxs[:, :full].reshape(shape).max(axis=2)
+            self.counts[level] = self.counts[level] + mins.shape[1]
+
+            if self.files:
+                # stored as buckets x channels x (min, max)
+                self.files[level].write(np.ascontiguousarray(
+                    np.stack((mins.T, maxs.T), axis=2), dtype='<f4'))
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+class channelScaling:
+    # Turns (channels x samples) int16 codes into sensor values: each
+    # channel's device polynomial (code to volts, lowest order first, as
+    # ai_dev_scaling_coeff) followed by its sensor slope, evaluated by
+    # Horner's rule across all channels at once.
+
+    def __init__(self, coefficients, slopes):
+        order = max(len(c) for c in coefficients)
+        self.coefficients = np.zeros((len(coefficients), order))
+        for i, c in enumerate(coefficients):
+            self.coefficients[i, :len(c)] = c
+        self.slopes = np.asarray(slopes, dtype=np.float64)
+
+    def apply(self, block, channels=None):
+        # channels are the rows of block when it holds only some of them
+        coefficients = self.coefficients
+        slopes = self.slopes
+        if channels is not None:
+            coefficients = coefficients[channels]
+            slopes = slopes[channels]
+
+        codes = np.asarray(block, dtype=np.float64)
+        values = np.empty(codes.shape)
+        values[:] = coefficients[:, -1:]
+        for k in range(coefficients.shape[1] - 2, -1, -1):
+            values *= codes
+            values += coefficients[:, k:k + 1]
+        values *= slopes[:, None]
+        return values
+
+    def description(self):
+        return {'coefficients': self.coefficients.tolist()}
+
+
+def recordingScaling(header):
+    # channelScaling of a raw recording, None if it holds values
+    if 'scaling' not in header:
+        return None
+    return channelScaling(header['scaling']['coefficients'], header['slopes'])
+
+
+def pyramidLevelName(basename, level):
+    return '{}.pyramid{}'.format(basename, level)
+
+
+def gapsFileName(filename):
+    return filename + '.gaps'
+
+
+class gapLog:
+    # Follows the acquisition index of the blocks a recorder writes and logs
+    # every jump in it as a gap. The file is only created by the first gap,
+    # one left by an earlier recording of the same name is removed.
+    # firstSample is the acquisition index the recording starts at.
+
+    def __init__(self, filename, firstSample=0):
+        self.filename = gapsFileName(filename)
+        self.file = None
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+        self.nextSample = firstSample
+        self.samplesLost = 0
+        self.gaps = 0
+
+    def check(self, firstSample, n, index):
+        # index is the file index (or line) the block is written at
+        if firstSample is None:
+            firstSample = self.nextSample
+        elif firstSample > self.nextSample:
+            self.add(self.nextSample, firstSample - self.nextSample, index)
+        self.nextSample = firstSample + n
+
+    def add(self, firstSample, lost, index):
+        if self.file is None:
+            self.file = open(self.filename, 'w')
+        self.file.write(json.dumps({'sample': firstSample, 'lost': lost, 'index': index}) + '\n')
+        self.file.flush()
+        self.samplesLost = self.samplesLost + lost
+        self.gaps = self.gaps + 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def readGaps(filename):
+    # the gaps logged for a recording, oldest first
+    try:
+        with open(gapsFileName(filename)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+class binaryRecorder:
+    # growBytes is the preallocation step, 0 to let the file grow per write.
+    # pyramidFactor enables a min/max pyramid next to the recording.
+    # scaling is the channelScaling of raw int16 blocks, which are then
+    # stored as they are. firstSample is the acquisition index of the first
+    # sample, for recordings that start part way through a session.
+
+    def __init__(self, filename, channelNames, slopes, units, sampleRate,
+                 dtype='float32', startTime=None, growBytes=64 << 20, pyramidFactor=10,
+                 scaling=None, firstSample=0):
+        self.filename = filename
+        self.scaling = scaling
+        self.dtype = np.dtype('int16' if scaling is not None else dtype)
+        self.nChannels = len(channelNames)
+        self.sampleCount = 0
+        self.growBytes = growBytes
+        self.allocated = 0
+        # header and samples, what the file holds once it is closed
+        self.bytesWritten = HEADER_SIZE
+
+        if startTime is None:
+            startTime = time.time()
+
+        self.header = {
+            'channels': list(channelNames),
+            'slopes': [float(slope) for slope in slopes],
+            'units': list(units),
+            'sampleRate': float(sampleRate),
+            'startTime': startTime,
+            'startTimeISO': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(startTime)),
+            'dtype': self.dtype.str,
+            'preallocated': growBytes > 0,
+            'firstSample': firstSample,
+        }
+        if scaling is not None:
+            self.header['scaling'] = scaling.description()
+
+        self.file = open(filename, 'wb')
+        self.writeHeader()
+        self.gapLog = gapLog(filename, firstSample)
+
+        self.pyramid = None
+        if pyramidFactor:
+            self.pyramid = minMaxPyramid(self.nChannels, factor=pyramidFactor, basename=filename)
+
+    def writeHeader(self):
+        description = json.dumps(self.header).encode('utf-8')
+        assert headerStruct.size + len(description) <= HEADER_SIZE, 'Error, recording header too large'
+
+        self.file.seek(0)
+        self.file.write(headerStruct.pack(MAGIC, VERSION, HEADER_SIZE, self.sampleCount))
+        self.file.write(description.ljust(HEADER_SIZE - headerStruct.size, b'\0'))
+
+    def setStartTime(self, startTime):
+        # the wall clock time the task started, known only once the
+        # recorder is open. Call before the first write.
+        self.header['startTime'] = startTime
+        self.header['startTimeISO'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(startTime))
+        self.writeHeader()
+
+    def write(self, block, firstSample=None):
+        # block is channels x samples, stored as samples x channels
+        self.gapLog.check(firstSample, block.shape[1], self.sampleCount)
+        frames = np.ascontiguousarray(block.T, dtype=self.dtype)
+        end = self.file.tell() + frames.nbytes
+        if self.growBytes and end > self.allocated:
+            self.grow(end)
+        self.file.write(frames)
+        self.sampleCount = self.sampleCount + frames.shape[0]
+        self.bytesWritten = self.bytesWritten + frames.nbytes
+        if self.pyramid is not None:
+            if self.scaling is not None:
+                block = self.scaling.apply(block)
+            self.pyramid.update(block)
+
+    def grow(self, end):
+        # extend the file a whole step at a time so appends stay contiguous
+        self.allocated = (end // self.growBytes + 1) * self.growBytes
+        self.file.flush()
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.file.fileno(), 0, self.allocated)
+        else:
+            self.file.truncate(self.allocated)
+        # the header count is the only record of the real length now
+        self.flush()
+
+    def flush(self):
+        # keep the sample count in the header current
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(headerStruct.pack(MAGIC, VERSION, HEADER_SIZE, self.sampleCount))
+        self.file.seek(position)
+        self.file.flush()
+        if self.pyramid is not None:
+            self.pyramid.flush()
+
+    def sync(self):
+        self.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.truncate(HEADER_SIZE + self.sampleCount * self.nChannels * self.dtype.itemsize)
+        self.file.close()
+        self.gapLog.close()
+        if self.pyramid is not None:
+            self.pyramid.close()
+
+
+def textLineFormat(nChannels):
+    # printf style equivalent of '{:g}, {:10.6f}, {:10.6f} \n'
+    return '%g' + ', %10.6f' * nChannels + ' \n'
+
+
+def formatTextBlock(block, firstSample, lineFormat=None):
+    # formats a whole channels x samples block in one operation, producing
+    # the same bytes as formatting it line by line
+    nChannels, n = block.shape
+    if lineFormat is None:
+        lineFormat = textLineFormat(nChannels)
+
+    rows = np.empty((n, nChannels + 1))
+    rows[:, 0] = np.arange(firstSample, firstSample + n)
+    rows[:, 1:] = block.T
+    return (lineFormat * n) % tuple(rows.ravel().tolist())
+
+
+class textRecorder:
+    # The original 'line_num, val1, val2' text format, kept open for the
+    # session. Each block is formatted at once and written in a single call.
+
+    def __init__(self, filename, nChannels, scaling=None, firstSample=0):
+        self.filename = filename
+        self.scaling = scaling
+        self.lineFormat = textLineFormat(nChannels)
+        self.file = open(filename, 'a')
+        self.gapLog = gapLog(filename, firstSample)
+        self.lines = 0
+        self.bytesWritten = 0
+
+    def write(self, block, firstSample):
+        self.gapLog.check(firstSample, block.shape[1], self.lines)
+        if self.scaling is not None:
+            block = self.scaling.apply(block)
+        text = formatTextBlock(block, firstSample, self.lineFormat)
+        self.file.write(text)
+        # the text is all ascii, a character is a byte
+        self.bytesWritten = self.bytesWritten + len(text)
+        self.lines = self.lines + block.shape[1]
+
+    def setStartTime(self, startTime):
+        # the text format has no header
+        pass
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        self.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+        self.gapLog.close()
+
+
+def segmentFileName(filename, segment):
+    # cannPressure_999999_20240101.daq -> cannPressure_999999_20240101_0001.daq
+    base, extension = os.path.splitext(filename)
+    return '{}_{:04d}{}'.format(base, segment, extension)
+
+
+def indexFileName(filename):
+    return os.path.splitext(filename)[0] + '.index.json'
+
+
+def uniqueFileName(filename):
+    # filename, or filename with _2, _3, ... added if a recording of that
+    # name exists already, so a second session of the same patient on the
+    # same day leaves the first one alone
+    base, extension = os.path.splitext(filename)
+    candidate = filename
+    n = 1
+    while any(os.path.exists(name) for name in
+              (candidate, indexFileName(candidate), segmentFileName(candidate, 1))):
+        n = n + 1
+        candidate = '{}_{}{}'.format(base, n, extension)
+    return candidate
+
+
+def writeIndex(filename, index):
+    # written beside the index and swapped in, so a reader never sees a
+    # half written index
+    temporary = filename + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(index, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, filename)
+
+
+def readIndex(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+class rotatingRecorder:
+    # Splits a session into segment files, each a complete recording made
+    # by openSegment(filename, firstSample, startTime, pyramidFactor), and
+    # rolls over to the next one once a segment holds segmentSeconds of
+    # acquisition time or segmentBytes of file. Rolls happen between blocks,
+    # in write(), so on the writer thread. The segments are listed in
+    # '<recording>.index.json' with their file, first and last acquisition
+    # index and start time, rewritten on every roll. The min/max pyramid is
+    # kept here for the whole session, under the recording's name, so the
+    # segments are opened without one.
+
+    def __init__(self, filename, openSegment, sampleRate, segmentSeconds=None,
+                 segmentBytes=None, startTime=None, pyramidFactor=10):
+        self.filename = filename
+        self.openSegment = openSegment
+        self.sampleRate = float(sampleRate)
+        self.segmentSamples = int(segmentSeconds * sampleRate) if segmentSeconds else None
+        self.segmentBytes = segmentBytes
+        self.startTime = time.time() if startTime is None else startTime
+
+        self.indexFilename = indexFileName(filename)
+        self.index = {'recording': os.path.basename(filename), 'sampleRate': self.sampleRate,
+                      'startTime': self.startTime, 'segments': []}
+        self.recorder = None
+        self.segmentFirst = 0
+        self.nextSample = 0
+        self.closedBytes = 0
+        self.pyramidFactor = pyramidFactor
+        self.pyramid = None
+
+        # daq_diagnostics.diagnostics for stage timing, if attached
+        self.diagnostics = None
+
+    def write(self, block, firstSample=None):
+        if firstSample is None:
+            firstSample = self.nextSample
+        if self.recorder is not None and self.full(firstSample):
+            start = time.perf_counter_ns()
+            self.closeSegment()
+            if self.diagnostics is not None:
+                self.diagnostics.record('roll', time.perf_counter_ns() - start)
+        if self.recorder is None:
+            self.startSegment(firstSample)
+        self.recorder.write(block, firstSample)
+        self.nextSample = firstSample + block.shape[1]
+
+        if self.pyramidFactor:
+            if self.pyramid is None:
+                self.pyramid = minMaxPyramid(block.shape[0], factor=self.pyramidFactor,
+                                             basename=self.filename)
+            if self.recorder.scaling is not None:
+                block = self.recorder.scaling.apply(block)
+            self.pyramid.update(block)
+
+    def setStartTime(self, startTime):
+        # call before the first write, the segments are opened from it
+        self.startTime = startTime
+        self.index['startTime'] = startTime
+
+    def full(self, firstSample):
+        if self.segmentSamples is not None and firstSample - self.segmentFirst >= self.segmentSamples:
+            return True
+        return self.segmentBytes is not None and self.recorder.file.tell() >= self.segmentBytes
+
+    def startSegment(self, firstSample):
+        segment = len(self.index['segments']) + 1
+        filename = segmentFileName(self.filename, segment)
+        # start of the segment on the acquisition clock
+        startTime = self.startTime + firstSample / self.sampleRate
+        self.recorder = self.openSegment(filename, firstSample, startTime, pyramidFactor=0)
+        self.segmentFirst = firstSample
+        self.index['segments'].append({
+            'file': os.path.basename(filename),
+            'firstSample': firstSample,
+            'lastSample': None,
+            'startTime': startTime,
+        })
+        writeIndex(self.indexFilename, self.index)
+
+    @property
+    def bytesWritten(self):
+        # over all segments of the session
+        recorder = self.recorder
+        return self.closedBytes + (recorder.bytesWritten if recorder is not None else 0)
+
+    def closeSegment(self):
+        self.recorder.close()
+        self.closedBytes = self.closedBytes + self.recorder.bytesWritten
+        self.recorder = None
+        self.index['segments'][-1]['lastSample'] = self.nextSample - 1
+        writeIndex(self.indexFilename, self.index)
+
+    def flush(self):
+        if self.recorder is not None:
+            self.recorder.flush()
+        if self.pyramid is not None:
+            self.pyramid.flush()
+
+    def sync(self):
+        if self.recorder is not None:
+            self.recorder.sync()
+        if self.pyramid is not None:
+            self.pyramid.flush()
+
+    def close(self):
+        if self.recorder is not None:
+            self.closeSegment()
+        if self.pyramid is not None:
+            self.pyramid.close()
+
+
+class recordingWriter(threading.Thread):
+    # Writes blocks to a recorder on its own thread. put() is called from the
+    # acquisition side; queued blocks are coalesced into large sequential
+    # writes of up to coalesceBytes. fsyncInterval is the number of seconds
+    # between fsyncs (None to leave it to the OS, 0 to sync every write).
+    #
+    # When the queue is full the policy decides what happens to a new block:
+    #   'block' - put() waits for room, the DAQ buffer absorbs the delay
+    #   'spill' - blocks go to a temporary file on the local disk, and are
+    #             written out in order once the writer catches up
+    #   'drop'  - the block is discarded and counted in droppedSamples
+    #
+    # Once the writer thread has failed, error is set and put() raises it,
+    # so the acquisition stops instead of queueing, spilling or waiting for
+    # a writer that is gone.
+
+    policies = ('block', 'spill', 'drop')
+
+    def __init__(self, recorder, maxBlocks=256, policy='block',
+                 coalesceBytes=1 << 20, fsyncInterval=5.0, spillDir=None):
+        threading.Thread.__init__(self, daemon=True)
+        assert policy in self.policies, 'Error, writer policy unknown, recieved {:s}'.format(policy)
+
+        self.recorder = recorder
+        self.policy = policy
+        self.coalesceBytes = coalesceBytes
+        self.fsyncInterval = fsyncInterval
+        self.spillDir = spillDir
+        self.queue = queue.Queue(maxBlocks)
+
+        self.spillLock = threading.Lock()
+        self.spilling = False
+        self.spillFile = None
+
+        # counters, read from other threads
+        self.bytesWritten = 0
+        self.blocksWritten = 0
+        self.writes = 0
+        self.maxQueueDepth = 0
+        self.worstStall = 0.0
+        self.worstPutWait = 0.0
+        self.droppedBlocks = 0
+        self.droppedSamples = 0
+        self.spilledBlocks = 0
+        self.error = None
+
+        # daq_diagnostics.diagnostics for stage timing, if attached
+        self.diagnostics = None
+
+        self.startTime = time.perf_counter()
+        self.lastSync = self.startTime
+
+    def put(self, block, firstSample):
+        self.checkError()
+        # the block is usually a view of the reader's buffer, keep a copy
+        item = (np.array(block), firstSample)
+
+        if self.policy == 'block':
+            start = time.perf_counter()
+            while True:
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    # the writer may have failed while we waited
+                    self.checkError()
+            self.worstPutWait = max(self.worstPutWait, time.perf_counter() - start)
+        elif self.policy == 'drop':
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.droppedBlocks = self.droppedBlocks + 1
+                self.droppedSamples = self.droppedSamples + block.shape[1]
+        else:
+            with self.spillLock:
+                if not self.spilling:
+                    try:
+                        self.queue.put_nowait(item)
+                    except queue.Full:
+                        self.spilling = True
+                if self.spilling:
+                    # once spilling, every block goes to the spill file to keep order
+                    self.spill(item)
+
+        self.maxQueueDepth = max(self.maxQueueDepth, self.queue.qsize())
+
+    def checkError(self):
+        if self.error is not None:
+            raise RuntimeError('Recording writer failed: {}'.format(self.error))
+
+    def spill(self, item):
+        block, firstSample = item
+        if self.spillFile is None:
+            self.spillFile = tempfile.TemporaryFile(prefix='pydaq_spill_', dir=self.spillDir)
+        self.spillFile.write(spillStruct.pack(firstSample, block.shape[0], block.shape[1],
+                                              block.dtype.str.encode('ascii')))
+        self.spillFile.write(np.ascontiguousarray(block))
+        self.spilledBlocks = self.spilledBlocks + 1
+
+    def drainSpill(self):
+        # swap in a fresh spill file so put() is never held up by the disk
+        with self.spillLock:
+            spillFile = self.spillFile
+            self.spillFile = None
+            if spillFile is None:
+                self.spilling = False
+                return
+
+        spillFile.seek(0)
+        items = []
+        size = 0
+        while True:
+            itemHeader = spillFile.read(spillStruct.size)
+            if not itemHeader:
+                break
+            firstSample, nChannels, n, dtype = spillStruct.unpack(itemHeader)
+            dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+            block = np.frombuffer(spillFile.read(nChannels * n * dtype.itemsize),
+                                  dtype=dtype).reshape(nChannels, n)
+            items.append((block, firstSample))
+            size = size + block.nbytes
+            if size >= self.coalesceBytes:
+                self.writeItems(items)
+                items = []
+                size = 0
+        spillFile.close()
+        self.writeItems(items)
+
+    def writeItems(self, items):
+        # blocks are only coalesced while they follow on from each other, so
+        # the recorder sees every gap
+        run = 0
+        for i in range(1, len(items) + 1):
+            if i == len(items) or not self.follows(items[i - 1], items[i]):
+                self.writeRun(items[run:i])
+                run = i
+
+    @staticmethod
+    def follows(previous, item):
+        return (previous[1] is None or item[1] is None
+                or item[1] == previous[1] + previous[0].shape[1])
+
+    def writeRun(self, items):
+        if not items:
+            return
+        start = time.perf_counter()
+
+        block = items[0][0] if len(items) == 1 else np.concatenate([b for b, _ in items], axis=1)
+        self.recorder.write(block, items[0][1])
+        # what went to the file, not the size of the blocks in memory
+        self.bytesWritten = self.recorder.bytesWritten
+        self.blocksWritten = self.blocksWritten + len(items)
+        self.writes = self.writes + 1
+
+        if self.fsyncInterval is not None and start - self.lastSync >= self.fsyncInterval:
+            self.recorder.sync()
+            self.lastSync = time.perf_counter()
+
+        stall = time.perf_counter() - start
+        self.worstStall = max(self.worstStall, stall)
+        if self.diagnostics is not None:
+            self.diagnostics.record('write', int(stall * 1e9))
+
+    def run(self):
+        try:
+            finished = False
+            while not finished:
+                try:
+                    items = [self.queue.get(timeout=0.1)]
+                except queue.Empty:
+                    items = []
+
+                # coalesce whatever else is already waiting
+                size = sum(item[0].nbytes for item in items if item is not None)
+                while items and items[-1] is not None and size < self.coalesceBytes:
+                    try:
+                        items.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                    if items[-1] is not None:
+                        size = size + items[-1][0].nbytes
+
+                if items and items[-1] is None:
+                    items.pop()
+                    finished = True
+                self.writeItems(items)
+
+                # spilled blocks are newer than anything in the queue
+                if self.spilling and (finished or self.queue.empty()):
+                    self.drainSpill()
+                    while finished and self.spilling:
+                        self.drainSpill()
+        except Exception as e:
+            self.error = e
+        finally:
+            # a failed write still leaves a file that can be closed, and a
+            # failure to close is reported unless a write failed first
+            try:
+                self.recorder.close()
+                # closing can still write, the last chunk of a compressed recording
+                self.bytesWritten = self.recorder.bytesWritten
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+    def close(self):
+        # call once acquisition has stopped, writes everything still queued.
+        # A writer that failed takes nothing from a full queue any more.
+        while self.is_alive():
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.join()
+        if self.error is not None:
+            print('Recording writer failed: {}'.format(self.error))
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.startTime
+        return {
+            'queueDepth': self.queue.qsize(),
+            'maxQueueDepth': self.maxQueueDepth,
+            'bytesWritten': self.bytesWritten,
+            'bytesPerSecond': self.bytesWritten / elapsed if elapsed > 0 else 0.0,
+            'blocksWritten': self.blocksWritten,
+            'writes': self.writes,
+            'worstStall': self.worstStall,
+            'worstPutWait': self.worstPutWait,
+            'droppedBlocks': self.droppedBlocks,
+            'droppedSamples': self.droppedSamples,
+            'spilledBlocks': self.spilledBlocks,
+        }
+
+
+def readHeader(filename):
+    with open(filename, 'rb') as f:
+        magic, version, headerSize, sampleCount = headerStruct.unpack(f.read(headerStruct.size))
+        assert magic == MAGIC, 'Error, {:s} is not a pydaq recording'.format(filename)
+        description = f.read(headerSize - headerStruct.size).rstrip(b'\0')
+
+    header = json.loads(description.decode('utf-8'))
+    header['version'] = version
+    header['headerSize'] = headerSize
+
+    # a session that did not close cleanly has a stale count, so trust the
+    # file size unless the tail of the file is preallocated space
+    frameBytes = np.dtype(header['dtype']).itemsize * len(header['channels'])
+    sizeCount = (os.path.getsize(filename) - headerSize) // frameBytes
+    if header.get('preallocated'):
+        header['sampleCount'] = min(sampleCount, sizeCount)
+    else:
+        header['sampleCount'] = sizeCount
+    return header
+
+
+class recordingView:
+    # Memory mapped, read only view of a recording. data is samples x
+    # channels; nothing is read from disk until a slice is used. Times are
+    # acquisition times, so a window that spans a gap holds fewer samples.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.header = readHeader(filename)
+        self.channels = self.header['channels']
+        self.sampleRate = self.header['sampleRate']
+        self.sampleCount = self.header['sampleCount']
+        self.scaling = recordingScaling(self.header)
+
+        if self.sampleCount > 0:
+            self.data = np.memmap(filename, dtype=np.dtype(self.header['dtype']), mode='r',
+                                  offset=self.header['headerSize'],
+                                  shape=(self.sampleCount, len(self.channels)))
+        else:
+            self.data = np.zeros((0, len(self.channels)), dtype=np.dtype(self.header['dtype']))
+        self.loadGaps()
+
+    def loadGaps(self):
+        # file index where each gap's data carries on, and the samples lost
+        # before each stretch of the file
+        self.setGaps(readGaps(self.filename))
+
+    def setGaps(self, gaps):
+        self.gaps = gaps
+        self.gapIndex = np.array([gap['index'] for gap in self.gaps], dtype=np.int64)
+        self.lostBefore = np.cumsum([0] + [gap['lost'] for gap in self.gaps]).astype(np.int64)
+        self.gapStart = self.gapIndex + self.lostBefore[:-1]
+
+    def __len__(self):
+        return self.sampleCount
+
+    def duration(self):
+        return (self.sampleCount + int(self.lostBefore[-1])) / self.sampleRate
+
+    def sampleNumbers(self, indices):
+        # acquisition index of each file index
+        indices = np.asarray(indices)
+        return indices + self.lostBefore[np.searchsorted(self.gapIndex, indices, side='right')]
+
+    def fileIndex(self, sample):
+        # file index of the first recorded sample at or after acquisition index sample
+        k = int(np.searchsorted(self.gapStart, sample, side='right'))
+        index = sample - int(self.lostBefore[k])
+        if k:
+            index = max(index, int(self.gapIndex[k - 1]))
+        return min(max(index, 0), self.sampleCount)
+
+    def segments(self, start, stop):
+        # (file start, file stop, acquisition index of file start) of each
+        # gap free stretch of [start, stop) in file indices
+        edges = [start] + [int(index) for index in self.gapIndex if start < index < stop] + [stop]
+        for first, last in zip(edges[:-1], edges[1:]):
+            if last > first:
+                yield first, last, int(self.sampleNumbers(first))
+
+    def fileRange(self, t0, t1):
+        return (self.fileIndex(max(int(round(t0 * self.sampleRate)), 0)),
+                self.fileIndex(int(round(t1 * self.sampleRate))))
+
+    def channelIndex(self, channel):
+        if isinstance(channel, str):
+            return self.channels.index(channel)
+        return channel
+
+    def frames(self, start, stop, columns=None):
+        # samples x channels of file indices [start, stop), as stored
+        return self.data[start:stop] if columns is None else self.data[start:stop, columns]
+
+    def values(self, start, stop, columns=None, raw=False):
+        # channels x samples of file indices [start, stop), scaled unless
+        # raw=True gives the stored codes of a raw recording
+        data = self.frames(start, stop, columns)
+        if self.scaling is None or raw:
+            return np.array(data.T)
+        return self.scaling.apply(data.T, columns)
+
+    def window(self, t0, t1, channels=None, raw=False):
+        # channels x samples copy of [t0, t1) seconds from the session start
+        start, stop = self.fileRange(t0, t1)
+        columns = None
+        if channels is not None:
+            columns = [self.channelIndex(channel) for channel in channels]
+        return self.values(start, stop, columns, raw)
+
+    def times(self, t0, t1):
+        # acquisition time of each sample window(t0, t1) returns
+        start, stop = self.fileRange(t0, t1)
+        return self.sampleNumbers(np.arange(start, stop)) / self.sampleRate
+
+    def close(self):
+        # drops the mapping so the file can be moved or deleted
+        self.data = None
+
+
+class textView(recordingView):
+    # A text recording read into memory. Text files have no header, so the
+    # sample rate has to be given (a rotated session has it in its index)
+    # and the channels are only numbered; the values are already scaled.
+
+    def __init__(self, filename, sampleRate=None):
+        assert sampleRate is not None, \
+            'Error, text recording {:s} needs its sample rate'.format(filename)
+        self.filename = filename
+        with warnings.catch_warnings():
+            # an empty file is a recording without samples
+            warnings.simplefilter('ignore', UserWarning)
+            lines = np.loadtxt(filename, delimiter=',', ndmin=2)
+        self.data = lines[:, 1:]
+        self.sampleCount = self.data.shape[0]
+        self.sampleRate = float(sampleRate)
+        self.channels = ['channel{}'.format(i + 1) for i in range(self.data.shape[1])]
+        self.scaling = None
+        self.header = {
+            'channels': self.channels,
+            'slopes': [1.0] * len(self.channels),
+            'units': [''] * len(self.channels),
+            'sampleRate': self.sampleRate,
+            'dtype': self.data.dtype.str,
+            'sampleCount': self.sampleCount,
+            'firstSample': int(lines[0, 0]) if self.sampleCount else 0,
+        }
+        self.loadGaps()
+
+
+class segmentedView(recordingView):
+    # The segments of a rotated session read as one recording, from its
+    # index file. File indices run on through the segments, and the samples
+    # between two segments that follow on with a jump count as a gap.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = readIndex(filename)
+        directory = os.path.dirname(filename)
+        segments = self.index['segments']
+        self.views = [openRecording(os.path.join(directory, segment['file']),
+                                    sampleRate=self.index['sampleRate'])
+                      for segment in segments]
+        assert self.views, 'Error, {:s} lists no segments'.format(filename)
+
+        self.header = dict(self.views[0].header)
+        self.header.setdefault('startTime', self.index['startTime'])
+        self.channels = self.header['channels']
+        self.sampleRate = self.header['sampleRate']
+        self.scaling = recordingScaling(self.header)
+        self.starts = np.cumsum([0] + [len(view) for view in self.views]).astype(np.int64)
+        self.sampleCount = int(self.starts[-1])
+        self.header['sampleCount'] = self.sampleCount
+        self.data = None
+
+        gaps = []
+        nextSample = 0
+        for segment, view, start in zip(segments, self.views, self.starts):
+            if segment['firstSample'] > nextSample:
+                gaps.append({'sample': nextSample, 'lost': segment['firstSample'] - nextSample,
+                             'index': int(start)})
+            gaps.extend(dict(gap, index=gap['index'] + int(start)) for gap in view.gaps)
+            nextSample = segment['firstSample'] + len(view) + int(view.lostBefore[-1])
+        self.setGaps(gaps)
+
+    def frames(self, start, stop, columns=None):
+        start, stop, _ = slice(start, stop).indices(self.sampleCount)
+        parts = []
+        first = max(int(np.searchsorted(self.starts, start, side='right')) - 1, 0)
+        for segment in range(first, len(self.views)):
+            offset = int(self.starts[segment])
+            if offset >= stop:
+                break
+            parts.append(self.views[segment].frames(max(start - offset, 0), stop - offset, columns))
+        if not parts:
+            return self.views[0].frames(0, 0, columns)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def close(self):
+        for view in self.views:
+            view.close()
+
+
+def recordingFormat(filename):
+    # 'binary' or 'compressed' from the magic the file starts with, 'text'
+    # for a file without one
+    from daq_compressed import MAGIC as compressedMagic
+    with open(filename, 'rb') as f:
+        magic = f.read(len(MAGIC))
+    if magic == MAGIC:
+        return 'binary'
+    if magic == compressedMagic:
+        return 'compressed'
+    return 'text'
+
+
+def isCompressed(filename):
+    return recordingFormat(filename) == 'compressed'
+
+
+def openRecording(filename, sampleRate=None):
+    # recordingView of a .daq recording, compressedView of a .daqz one,
+    # textView of a text one (which needs sampleRate) and segmentedView of
+    # the index of a rotated session
+    if filename.endswith('.index.json'):
+        return segmentedView(filename)
+    fileFormat = recordingFormat(filename)
+    if fileFormat == 'compressed':
+        from daq_compressed import compressedView
+        return compressedView(filename)
+    if fileFormat == 'text':
+        return textView(filename, sampleRate)
+    return recordingView(filename)
+
+
+def readRecording(filename, raw=False):
+    # returns (header, channels x samples array), scaled unless raw=True
+    if filename.endswith('.index.json'):
+        view = segmentedView(filename)
+        return view.header, view.values(0, len(view), raw=raw)
+    if isCompressed(filename):
+        from daq_compressed import readCompressed
+        return readCompressed(filename, raw=raw)
+    header = readHeader(filename)
+    data = np.fromfile(filename, dtype=np.dtype(header['dtype']),
+                       count=header['sampleCount'] * len(header['channels']),
+                       offset=header['headerSize'])
+    data = data.reshape(-1, len(header['channels'])).T
+    scaling = recordingScaling(header)
+    if scaling is not None and not raw:
+        data = scaling.apply(data)
+    return header, data
+
+
+class pyramidView:
+    # Read side of a recording's min/max pyramid. span() picks the coarsest
+    # level that still gives at least one bucket per pixel, so the work is
+    # bounded by the screen width and not by the length of the session.
+
+    def __init__(self, filename):
+        self.recording = openRecording(filename)
+        self.sampleRate = self.recording.sampleRate
+        if filename.endswith('.index.json'):
+            # a rotated session has one pyramid, under the recording's name
+            filename = os.path.join(os.path.dirname(filename), self.recording.index['recording'])
+        with open(filename + '.pyramid.json') as f:
+            description = json.load(f)
+        self.factor = description['factor']
+        self.nChannels = description['nChannels']
+
+        self.levels = []
+        for level in range(1, description['levels'] + 1):
+            name = pyramidLevelName(filename, level)
+            buckets = os.path.getsize(name) // (self.nChannels * 2 * 4)
+            if buckets == 0:
+                break
+            self.levels.append(np.memmap(name, dtype='<f4', mode='r',
+                                         shape=(buckets, self.nChannels, 2)))
+
+    def span(self, t0, t1, pixels=600):
+        # returns (times, mins, maxs), mins and maxs are channels x buckets
+        start, stop = self.recording.fileRange(t0, t1)
+
+        # pick the level, level 0 being the raw samples
+        level = 0
+        while (level < len(self.levels)
+               and (stop - start) // self.factor ** (level + 1) >= pixels):
+            level = level + 1
+
+        size = self.factor ** level
+        first = start // size
+        last = -(-stop // size)
+        if level == 0:
+            mins = maxs = self.recording.values(first, last).astype(np.float64, copy=False)
+        else:
+            buckets = np.array(self.levels[level - 1][first:last])
+            mins = buckets[:, :, 0].T
+            maxs = buckets[:, :, 1].T
+
+        centres = np.arange(first, first + mins.shape[1]) * size + (size - 1) // 2
+        times = self.recording.sampleNumbers(centres) / self.sampleRate
+        return times, mins, maxs
+
+
+def openPyramid(filename):
+    return pyramidView(filename)
+
+
+def plotHistory(filename, t0=0.0, t1=None, pixels=1200):
+    import matplotlib.pyplot as plt
+
+    pyramid = openPyramid(filename)
+    if t1 is None:
+        t1 = pyramid.recording.duration()
+    times, mins, maxs = pyramid.span(t0, t1, pixels)
+    header = pyramid.recording.header
+
+    fig, axes = plt.subplots(pyramid.nChannels, 1, sharex=True, squeeze=False)
+    for channel, ax in enumerate(axes[:, 0]):
+        ax.fill_between(times, mins[channel], maxs[channel], color='blue', linewidth=0.5)
+        ax.set_ylabel('{} ({})'.format(header['channels'][channel], header['units'][channel]))
+    axes[-1, 0].set_xlabel('Time (s)')
+    plt.show()
+
+
+def exportText(filename, textFilename=None):
+    # writes the same 'line_num, val1, val2' lines as the old text recorder
+    if textFilename is None:
+        textFilename = os.path.splitext(filename.replace('.index.json', '.json'))[0] + '.txt'
+
+    view = openRecording(filename)
+    lineFormat = textLineFormat(len(view.channels))
+
+    # line numbers are acquisition indices, they jump over any gap
+    with open(textFilename, 'w') as f:
+        for first, last, firstSample in view.segments(0, len(view)):
+            for start in range(first, last, 100000):
+                stop = min(start + 100000, last)
+                f.write(formatTextBlock(view.values(start, stop), firstSample + start - first,
+                                        lineFormat))
+    view.close()
+
+    return textFilename
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tools for pydaq binary recordings')
+    commands = parser.add_subparsers(dest='command')
+
+    exportParser = commands.add_parser('export', help='convert a recording to text')
+    exportParser.add_argument('filename')
+    exportParser.add_argument('textFilename', nargs='?')
+
+    infoParser = commands.add_parser('info', help='print the recording header')
+    infoParser.add_argument('filename')
+
+    historyParser = commands.add_parser('history', help='plot the min/max history of a recording')
+    historyParser.add_argument('filename')
+    historyParser.add_argument('t0', type=float, nargs='?', default=0.0)
+    historyParser.add_argument('t1', type=float, nargs='?')
+
+    windowParser = commands.add_parser('window', help='print a time window as text')
+    windowParser.add_argument('filename')
+    windowParser.add_argument('t0', type=float, help='start, seconds from the session start')
+    windowParser.add_argument('t1', type=float, help='end, seconds from the session start')
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        print(exportText(args.filename, args.textFilename))
+    elif args.command == 'info':
+        view = openRecording(args.filename)
+        print(json.dumps(dict(view.header, gaps=view.gaps), indent=2))
+    elif args.command == 'history':
+        plotHistory(args.filename, args.t0, args.t1)
+    elif args.command == 'window':
+        view = openRecording(args.filename)
+        for first, last, firstSample in view.segments(*view.fileRange(args.t0, args.t1)):
+            print(formatTextBlock(view.values(first, last), firstSample), end='')
+    else:
+        parser.print_help()
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Acquisition in its own process, sharing its ring buffer with the GUI through
+multiprocessing.shared_memory.
+
+sharedAcquisition(settings) spawns a process that runs a sharedSession: the
+task, acquisition engine, writer thread and recording of a headlessSession,
+with the ring buffer in a named shared memory segment. The GUI attaches to
+the segment and reads it through ordinary ringReaders, without copying it
+and without sharing a GIL with the DAQ reads. The segment is laid out as
+
+    [4096 byte JSON description][control counters, int64][channels x capacity samples]
+
+The description holds the channels, units, slopes, sample rate, dtype,
+capacity and recording file name (and the scaling of raw sessions), the
+control block the ring's write count, the acquisition position, the lost
+samples, a heartbeat and a stop request.
+
+The acquisition process ignores Ctrl-C, logs to '<recording>.log' and does
+not need the GUI: if the GUI crashes or hangs the session records on until
+its duration runs out or it is stopped, by sharedAcquisition.stop() or with
+
+    python daq_shared.py status pydaq_1234_0
+    python daq_shared.py stop pydaq_1234_0
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from daq_acquisition import ringBuffer
+from daq_headless import headlessSession, defaults
+from daq_recording import channelScaling
+
+
+DESCRIPTION_SIZE = 4096
+controlFields = ('writeCount', 'maxWrite', 'position', 'samplesLost', 'gaps',
+                 'droppedSamples', 'state', 'stopRequested', 'heartbeat', 'pid')
+field = {name: index for index, name in enumerate(controlFields)}
+CONTROL_SIZE = 8 * len(controlFields)
+
+# session states
+STARTING, RUNNING, STOPPED, FAILED = range(4)
+stateNames = ('starting', 'running', 'stopped', 'failed')
+
+
+class sharedRing(ringBuffer):
+    # ringBuffer over a shared memory segment. The acquisition process makes
+    # it with createSharedRing(), other processes map it with attachRing();
+    # their view of the samples is read only. writeCount and maxWrite live
+    # in the control block, so a block is published to every process by
+    # the same store that publishes it to local readers.
+
+    def __init__(self, shm, description, writable):
+        self.shm = shm
+        self.description = description
+        self.nChannels = len(description['channels'])
+        self.capacity = int(description['capacity'])
+        self.control = np.ndarray((len(controlFields),), dtype=np.int64,
+                                  buffer=shm.buf, offset=DESCRIPTION_SIZE)
+        self.data = np.ndarray((self.nChannels, self.capacity),
+                               dtype=np.dtype(description['dtype']),
+                               buffer=shm.buf, offset=DESCRIPTION_SIZE + CONTROL_SIZE)
+        self.data.flags.writeable = writable
+
+    @property
+    def writeCount(self):
+        return int(self.control[field['writeCount']])
+
+    @writeCount.setter
+    def writeCount(self, value):
+        self.control[field['writeCount']] = value
+
+    @property
+    def maxWrite(self):
+        return int(self.control[field['maxWrite']])
+
+    @maxWrite.setter
+    def maxWrite(self, value):
+        self.control[field['maxWrite']] = value
+
+    def get(self, name):
+        return int(self.control[field[name]])
+
+    def set(self, name, value):
+        self.control[field[name]] = value
+
+    def close(self):
+        # the arrays have to go before the mapping can be closed
+        self.data = None
+        self.control = None
+        self.shm.close()
+
+
+def createSharedRing(name, description):
+    description = dict(description)
+    size = DESCRIPTION_SIZE + CONTROL_SIZE + (len(description['channels'])
+                                              * int(description['capacity'])
+                                              * np.dtype(description['dtype']).itemsize)
+    encoded = json.dumps(description).encode('utf-8')
+    assert len(encoded) <= DESCRIPTION_SIZE, 'Error, shared ring description too large'
+
+    shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    shm.buf[:len(encoded)] = encoded
+    shm.buf[len(encoded):DESCRIPTION_SIZE] = bytes(DESCRIPTION_SIZE - len(encoded))
+    ring = sharedRing(shm, description, writable=True)
+    ring.control[:] = 0
+    ring.set('pid', os.getpid())
+    return ring
+
+
+def attachRing(name, untrack=False):
+    shm = shared_memory.SharedMemory(name=name)
+    if untrack and os.name == 'posix':
+        # before 3.13 attaching registers the segment with this process'
+        # resource tracker, which unlinks it when the process exits. The
+        # GUI shares its tracker with the acquisition process it spawned
+        # and keeps the registration, other processes have to drop it.
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    try:
+        description = json.loads(bytes(shm.buf[:DESCRIPTION_SIZE]).rstrip(b'\0').decode('utf-8'))
+    except ValueError:
+        # the segment exists from the moment it is created, its description
+        # is written after that
+        shm.close()
+        raise
+    return sharedRing(shm, description, writable=False)
+
+
+class sharedSession(headlessSession):
+    # headlessSession of the acquisition process, with its ring in shared
+    # memory and its counters published to the control block
+
+    def __init__(self, settings, name):
+        headlessSession.__init__(self, settings)
+        self.name = name
+
+    def createRing(self, nChannels, dtype):
+        capacity = max(int(self.settings.get('ringSeconds', 10.0) * self.sampleRate),
+                       self.numberOfSamples * 20)
+        description = dict(self.describe(), capacity=capacity, filename=self.filename)
+        return createSharedRing(self.name, description)
+
+    def publish(self):
+        self.ring.set('position', self.acquisition.position)
+        self.ring.set('samplesLost', self.acquisition.samplesLost)
+        self.ring.set('gaps', self.acquisition.gaps)
+        self.ring.set('droppedSamples', self.writer.droppedSamples)
+        self.ring.set('heartbeat', time.time_ns())
+
+    def run(self):
+        duration = self.settings['duration']
+        interval = float(self.settings['statusInterval'])
+        print('{} {}'.format(self.name, self.filename), flush=True)
+        self.start()
+        self.ring.set('state', RUNNING)
+
+        state = STOPPED
+        nextStatus = self.startTime + interval
+        while not self.ring.get('stopRequested'):
+            self.publish()
+            now = time.perf_counter()
+            if self.acquisition.error is not None:
+                print('Acquisition stopped: {}'.format(self.acquisition.error))
+                state = FAILED
+                break
+            if self.writer.error is not None:
+                print('Recording stopped: {}'.format(self.writer.error))
+                state = FAILED
+                break
+            if duration is not None and now - self.startTime >= duration:
+                break
+            if now >= nextStatus:
+                nextStatus = now + interval
+                self.printStatus()
+            time.sleep(0.05)
+
+        self.stop()
+        self.publish()
+        self.ring.set('state', state)
+        self.closeRing()
+
+    def closeRing(self):
+        self.ring.close()
+        try:
+            self.ring.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def runSharedSession(settings, name):
+    # target of the acquisition process. Ctrl-C in the GUI's console must
+    # not reach it, and its output goes to a log next to the recording, as
+    # the console may close with the GUI.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    session = sharedSession(settings, name)
+    log = open(session.filename + '.log', 'a', buffering=1)
+    sys.stdout = log
+    sys.stderr = log
+    try:
+        session.run()
+    except Exception:
+        traceback.print_exc()
+        if getattr(session, 'ring', None) is not None and session.ring.control is not None:
+            session.ring.set('state', FAILED)
+            session.closeRing()
+        raise
+
+
+class sharedAcquisition:
+    # GUI side of a session in the acquisition process. ring is the shared
+    # ring, mapped read only; scaling is set for raw sessions. The process
+    # is not a daemon, so it outlives a GUI that crashes.
+
+    sessions = 0
+
+    def __init__(self, settings, name=None, startTimeout=30.0):
+        self.settings = dict(defaults, **settings)
+        if name is None:
+            name = 'pydaq_{}_{}'.format(os.getpid(), sharedAcquisition.sessions)
+            sharedAcquisition.sessions = sharedAcquisition.sessions + 1
+        self.name = name
+
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(target=runSharedSession, args=(self.settings, name),
+                                       name='pydaq acquisition')
+        self.process.start()
+        self.ring = self.attach(startTimeout)
+
+        self.description = self.ring.description
+        self.filename = self.description['filename']
+        self.scaling = None
+        if 'scaling' in self.description:
+            self.scaling = channelScaling(self.description['scaling']['coefficients'],
+                                          self.description['slopes'])
+
+    def attach(self, timeout):
+        # waits for the session to create its ring and start the task
+        deadline = time.perf_counter() + timeout
+        ring = None
+        while True:
+            if ring is None:
+                try:
+                    ring = attachRing(self.name)
+                except (FileNotFoundError, ValueError):
+                    # not created yet, or its description not written yet
+                    pass
+            if ring is not None and ring.get('state') != STARTING:
+                return ring
+            if not self.process.is_alive():
+                raise RuntimeError('Acquisition process exited with code {}'.format(
+                    self.process.exitcode))
+            assert time.perf_counter() < deadline, 'Error, acquisition process did not start'
+            time.sleep(0.05)
+
+    def state(self):
+        return self.ring.get('state')
+
+    @property
+    def position(self):
+        return self.ring.get('position')
+
+    @property
+    def samplesLost(self):
+        # skipped by the acquisition and dropped by the writer
+        return self.ring.get('samplesLost') + self.ring.get('droppedSamples')
+
+    @property
+    def gaps(self):
+        return self.ring.get('gaps')
+
+    @property
+    def error(self):
+        if self.state() == FAILED or (not self.process.is_alive() and self.state() != STOPPED):
+            return 'acquisition process failed, see {}.log'.format(self.filename)
+        return None
+
+    def heartbeatAge(self):
+        # seconds since the acquisition process last published its counters
+        return (time.time_ns() - self.ring.get('heartbeat')) / 1e9
+
+    def stop(self, timeout=None):
+        self.ring.set('stopRequested', 1)
+        self.process.join(timeout)
+
+    def close(self):
+        self.ring.close()
+
+
+def statusText(ring):
+    lines = ['{:<16s} {}'.format(key, ring.description[key])
+             for key in ('filename', 'channels', 'sampleRate', 'dtype', 'capacity')]
+    lines.append('{:<16s} {}'.format('state', stateNames[ring.get('state')]))
+    for name in ('pid', 'position', 'samplesLost', 'gaps', 'droppedSamples'):
+        lines.append('{:<16s} {}'.format(name, ring.get(name)))
+    lines.append('{:<16s} {:.1f} s'.format(
+        'heartbeat age', (time.time_ns() - ring.get('heartbeat')) / 1e9))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Control a pydaq acquisition process')
+    parser.add_argument('command', choices=('status', 'stop'))
+    parser.add_argument('name', help='shared memory name of the session, pydaq_<pid>_<n>')
+    args = parser.parse_args()
+
+    ring = attachRing(args.name, untrack=True)
+    if args.command == 'stop':
+        ring.set('stopRequested', 1)
+    print(statusText(ring))
+    ring.close()
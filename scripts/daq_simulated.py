@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated stand in for the parts of nidaqmx the pydaq scripts use, so the
+acquisition, plotting and recording paths can run on a machine without NI
+hardware or the DAQmx driver.
+
+simulatedTask takes the same calls as nidaqmx.Task for a continuous analog
+input session (ai_channels.add_ai_voltage_chan, timing.cfg_samp_clk_timing,
+in_stream / _in_stream, read, start, stop, close and the every-N-samples
+event), simulatedReader stands in for AnalogMultiChannelReader (and for
+AnalogUnscaledReader through read_int16, with the 16-bit codes of a +/-10 V
+range described by each channel's ai_dev_scaling_coeff) and simulatedWriter
+for AnalogSingleChannelWriter. Linear scales are registered
+through simulatedScale.create_lin_scale, like nidaqmx.scale.Scale.
+
+Every channel plays a deterministic signal computed from the sample index,
+cycling through sine, pressure, step and noise by channel unless set with
+setSignal(). With realTime=True samples become available as a sample clock
+at the configured rate would make them; with realTime=False they are made as
+fast as they are read, for load tests. The input buffer holds
+samps_per_chan samples like the DAQmx one: falling further behind than that
+is an overrun, counted in in_stream.overruns and raised from the next read
+as simulatedOverrun, as DAQmx reports error -200279. With in_stream.over_write
+set to OVERWRITE_UNREAD_SAMPLES the oldest samples are overwritten instead,
+and reads can be moved past them with in_stream.relative_to and offset;
+reading samples that are already overwritten raises simulatedOverrun.
+Modes are matched by name, so nidaqmx.constants members or plain strings
+both work.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+
+# slope of each scale registered with simulatedScale.create_lin_scale
+linScales = {}
+
+signalKinds = ('sine', 'pressure', 'step', 'noise')
+noiseChunk = 4096
+
+# volts per code of a 16-bit converter over +/-10 V, as ai_dev_scaling_coeff
+deviceScaling = [0.0, 20.0 / 65536]
+
+
+class simulatedOverrun(Exception):
+    pass
+
+
+def modeName(mode):
+    return getattr(mode, 'name', mode)
+
+
+class simulatedScale:
+
+    @staticmethod
+    def create_lin_scale(scale_name, slope, y_intercept=0.0, scaled_units=None, **kwargs):
+        linScales[scale_name] = (slope, y_intercept)
+
+
+class simulatedChannel:
+    # one analog input channel and the signal it plays, in volts
+
+    def __init__(self, physicalChannel, minVoltage, maxVoltage, scale, kind, index, seed):
+        self.physicalChannel = physicalChannel
+        self.minVoltage = minVoltage
+        self.maxVoltage = maxVoltage
+        self.slope, self.intercept = scale
+        self.index = index
+        self.ai_dev_scaling_coeff = list(deviceScaling)
+        self.setSignal(kind, seed=seed)
+
+    def setSignal(self, kind, frequency=None, seed=0):
+        assert kind in signalKinds, 'Error, signal unknown, recieved {:s}'.format(kind)
+        self.kind = kind
+        self.frequency = frequency if frequency is not None else 0.5 * (self.index + 1)
+        self.seed = seed
+        self.noiseCache = (None, None)
+
+    def noise(self, firstSample, n):
+        # generated in fixed chunks seeded by their position, so the samples
+        # don't depend on how the stream is split into reads
+        first = firstSample // noiseChunk
+        last = (firstSample + n - 1) // noiseChunk
+        chunks = []
+        for k in range(first, last + 1):
+            if self.noiseCache[0] != k:
+                rng = np.random.default_rng([self.seed, self.index, k])
+                self.noiseCache = (k, rng.standard_normal(noiseChunk))
+            chunks.append(self.noiseCache[1])
+        start = firstSample - first * noiseChunk
+        return np.concatenate(chunks)[start:start + n]
+
+    def volts(self, firstSample, n, sampleRate):
+        # samples [firstSample, firstSample + n) of the signal, inside the voltage range
+        t = np.arange(firstSample, firstSample + n) / sampleRate
+        middle = (self.maxVoltage + self.minVoltage) / 2
+        amplitude = 0.4 * (self.maxVoltage - self.minVoltage)
+
+        if self.kind == 'sine':
+            wave = np.sin(2 * np.pi * self.frequency * t)
+        elif self.kind == 'pressure':
+            # heart beats riding on a slower breathing swing
+            beat = np.maximum(np.sin(2 * np.pi * 1.2 * t), 0) ** 3
+            wave = 1.6 * beat + 0.3 * np.sin(2 * np.pi * 0.25 * t) - 0.8
+        elif self.kind == 'step':
+            wave = np.where((t * self.frequency) % 1.0 < 0.5, -1.0, 1.0)
+        else:
+            wave = np.clip(self.noise(firstSample, n) / 3, -1.0, 1.0) if n else np.zeros(0)
+        return middle + amplitude * wave
+
+    def values(self, firstSample, n, sampleRate):
+        return self.slope * self.volts(firstSample, n, sampleRate) + self.intercept
+
+    def codes(self, firstSample, n, sampleRate):
+        codes = np.round(self.volts(firstSample, n, sampleRate) / self.ai_dev_scaling_coeff[1])
+        return np.clip(codes, -32768, 32767).astype(np.int16)
+
+
+class simulatedChannels(list):
+
+    def __init__(self, task):
+        list.__init__(self)
+        self.task = task
+
+    def add_ai_voltage_chan(self, physical_channel, name_to_assign_to_channel='',
+                            terminal_config=None, min_val=-5.0, max_val=5.0,
+                            units=None, custom_scale_name='', **kwargs):
+        scale = linScales.get(custom_scale_name, (1.0, 0.0))
+        index = len(self)
+        kind = signalKinds[index % len(signalKinds)]
+        self.append(simulatedChannel(physical_channel, min_val, max_val, scale, kind,
+                                     index, self.task.seed))
+        return self[-1]
+
+    def add_ao_voltage_chan(self, physical_channel, name_to_assign_to_channel='',
+                            min_val=-10.0, max_val=10.0, units=None, **kwargs):
+        self.append(physical_channel)
+        return physical_channel
+
+
+class simulatedTiming:
+
+    def __init__(self, task):
+        self.task = task
+        self.samp_clk_rate = 1000.0
+        self.samp_quant_samp_per_chan = 1000
+
+    def cfg_samp_clk_timing(self, rate, source='', active_edge=None, sample_mode=None,
+                            samps_per_chan=1000):
+        # in continuous mode samps_per_chan is the input buffer size
+        self.samp_clk_rate = float(rate)
+        self.samp_quant_samp_per_chan = int(samps_per_chan)
+
+
+class simulatedInStream:
+    # Sample clock and input buffer of a simulated task. Only counts are kept,
+    # the samples themselves are computed when they are read.
+
+    def __init__(self, task):
+        self.task = task
+        self.readCount = 0
+        self.acquiredCount = 0
+        self.overruns = 0
+        self.startTime = None
+        self.startCount = 0
+        self.lock = threading.Lock()
+
+        self.over_write = 'DO_NOT_OVERWRITE_UNREAD_SAMPLES'
+        self.relative_to = 'CURRENT_READ_POSITION'
+        self.offset = 0
+
+    @property
+    def input_buf_size(self):
+        return self.task.timing.samp_quant_samp_per_chan
+
+    @property
+    def total_samp_per_chan_acquired(self):
+        return self.acquired()
+
+    @property
+    def avail_samp_per_chan(self):
+        return min(self.acquired() - self.readCount, self.input_buf_size)
+
+    @property
+    def curr_read_pos(self):
+        return self.readCount
+
+    def acquired(self):
+        if self.startTime is not None and self.task.realTime:
+            elapsed = time.perf_counter() - self.startTime
+            self.acquiredCount = self.startCount + int(elapsed * self.task.timing.samp_clk_rate)
+        return self.acquiredCount
+
+    def begin(self):
+        self.startCount = self.acquiredCount
+        self.startTime = time.perf_counter()
+
+    def end(self):
+        self.acquired()
+        self.startTime = None
+
+    def advance(self, count):
+        # as fast as possible mode: acquire up to count right away
+        if not self.task.realTime and self.startTime is not None:
+            self.acquiredCount = max(self.acquiredCount, count)
+
+    def waitFor(self, count, timeout):
+        # blocks until count samples have been acquired
+        self.advance(count)
+        rate = self.task.timing.samp_clk_rate
+        deadline = time.perf_counter() + timeout
+        while self.acquired() < count:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 and timeout >= 0:
+                raise TimeoutError('simulated read timed out waiting for {} samples'.format(
+                    count - self.acquired()))
+            time.sleep(min((count - self.acquired()) / rate, max(remaining, 0.001)))
+
+    def overwrites(self):
+        return modeName(self.over_write) == 'OVERWRITE_UNREAD_SAMPLES'
+
+    def readStart(self):
+        # first sample of the next read, from relative_to and offset
+        relativeTo = modeName(self.relative_to)
+        if relativeTo == 'FIRST_SAMPLE':
+            return self.offset
+        if relativeTo == 'MOST_RECENT_SAMPLE':
+            return self.acquired() + self.offset
+        return self.readCount + self.offset
+
+    def read(self, out, n, timeout, raw=False):
+        # fills out[:, :n] with n samples of every channel from the read
+        # position, scaled values or raw=True for the converter codes
+        with self.lock:
+            start = self.readStart()
+            if n < 0:
+                n = max(min(self.acquired() - start, self.input_buf_size), 0)
+            self.checkOverrun(start)
+            self.waitFor(start + n, timeout)
+            self.checkOverrun(start)
+            rate = self.task.timing.samp_clk_rate
+            for i, channel in enumerate(self.task.ai_channels):
+                out[i, :n] = channel.codes(start, n, rate) if raw else channel.values(start, n, rate)
+            self.readCount = start + n
+        return n
+
+    def checkOverrun(self, start):
+        if self.overwrites():
+            # only samples still in the buffer can be read
+            oldest = self.acquired() - self.input_buf_size
+            if start < oldest:
+                self.overruns = self.overruns + 1
+                raise simulatedOverrun(
+                    'simulated read of overwritten samples, {} samples no longer available'.format(
+                        oldest - start))
+            return
+        behind = self.acquired() - start
+        if behind > self.input_buf_size:
+            self.overruns = self.overruns + 1
+            raise simulatedOverrun(
+                'simulated buffer overrun, {} samples behind with a {} sample buffer'.format(
+                    behind, self.input_buf_size))
+
+
+class simulatedTask:
+
+    def __init__(self, new_task_name='', realTime=True, seed=0):
+        self.name = new_task_name
+        self.realTime = realTime
+        self.seed = seed
+        self.ai_channels = simulatedChannels(self)
+        self.ao_channels = simulatedChannels(self)
+        self.timing = simulatedTiming(self)
+        self.in_stream = simulatedInStream(self)
+        self.out_stream = simulatedOutStream(self)
+
+        self.eventInterval = None
+        self.eventCallback = None
+        self.eventThread = None
+        self.running = False
+
+    @property
+    def _in_stream(self):
+        return self.in_stream
+
+    @property
+    def number_of_channels(self):
+        return len(self.ai_channels)
+
+    def setSignal(self, index, kind, frequency=None):
+        self.ai_channels[index].setSignal(kind, frequency, seed=self.seed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        self.in_stream.begin()
+        self.running = True
+        if self.eventCallback is not None:
+            self.startEvents()
+
+    def stop(self):
+        self.running = False
+        if self.eventThread is not None and self.eventThread is not threading.current_thread():
+            self.eventThread.join()
+        self.eventThread = None
+        self.in_stream.end()
+
+    def close(self):
+        self.stop()
+
+    def read(self, number_of_samples_per_channel=1, timeout=10.0):
+        # same shapes as nidaqmx: a list per channel, or a single list for one channel
+        n = number_of_samples_per_channel
+        data = np.zeros((len(self.ai_channels), max(n, 0) or self.in_stream.avail_samp_per_chan))
+        n = self.in_stream.read(data, n, timeout)
+        if len(self.ai_channels) == 1:
+            return data[0, :n].tolist()
+        return data[:, :n].tolist()
+
+    def register_every_n_samples_acquired_into_buffer_event(self, sample_interval, callback_method):
+        self.eventInterval = sample_interval
+        self.eventCallback = callback_method
+        if callback_method is None:
+            # unregistering waits for a callback in progress, like DAQmx
+            thread = self.eventThread
+            self.eventThread = None
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+        elif self.running:
+            self.startEvents()
+
+    def startEvents(self):
+        self.eventThread = threading.Thread(target=self.runEvents, daemon=True)
+        self.eventThread.start()
+
+    def runEvents(self):
+        # fires the callback every time another sample_interval samples are in
+        # the buffer, on its own thread like the driver's callbacks
+        thread = threading.current_thread()
+        fired = 0
+        while self.running and self.eventThread is thread and self.eventCallback is not None:
+            if self.realTime:
+                target = (fired + 1) * self.eventInterval
+            else:
+                # as fast as possible still means no faster than the reads,
+                # an event nobody read is fired again
+                target = self.in_stream.readCount + self.eventInterval
+                if target <= self.in_stream.acquired():
+                    time.sleep(0.0005)
+            self.in_stream.advance(target)
+            try:
+                self.in_stream.waitFor(target, 1.0)
+            except TimeoutError:
+                continue
+            fired = fired + 1
+            callback = self.eventCallback
+            if callback is not None:
+                callback(0, 1, self.eventInterval, None)
+
+
+class simulatedOutStream:
+
+    def __init__(self, task):
+        self.task = task
+        self.samplesWritten = 0
+
+
+class simulatedReader:
+    # stands in for nidaqmx.stream_readers.AnalogMultiChannelReader and
+    # AnalogUnscaledReader
+
+    def __init__(self, in_stream):
+        self.in_stream = in_stream
+
+    def read_many_sample(self, data, number_of_samples_per_channel=-1, timeout=10.0):
+        return self.in_stream.read(data, number_of_samples_per_channel, timeout)
+
+    def read_int16(self, data, number_of_samples_per_channel=-1, timeout=10.0):
+        return self.in_stream.read(data, number_of_samples_per_channel, timeout, raw=True)
+
+
+class simulatedWriter:
+    # stands in for nidaqmx.stream_writers.AnalogSingleChannelWriter, the
+    # samples are only counted
+
+    def __init__(self, out_stream, auto_start=False):
+        self.out_stream = out_stream
+        self.auto_start = auto_start
+
+    def write_many_sample(self, data, timeout=10.0):
+        self.out_stream.samplesWritten = self.out_stream.samplesWritten + len(data)
+        if self.auto_start and not self.out_stream.task.running:
+            self.out_stream.task.start()
+        return len(data)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming statistics for the channel readouts of the continuous input scripts.
+"""
+
+import numpy as np
+
+
+class streamingStats:
+    # Vectorized statistics for N channels, updated one (channels x samples)
+    # block at a time in O(block):
+    #   - session mean and variance (Welford, merged a block at a time)
+    #   - session min and max
+    #   - mean, min and max over a sliding window of the last windowSamples
+    # The window is a ring of the last samples with a running sum, and min and
+    # max kept per chunk of the ring so only the chunks a block touches are
+    # rescanned.
+
+    def __init__(self, nChannels, windowSamples, chunk=256):
+        self.nChannels = nChannels
+
+        self.count = 0
+        self.mean = np.zeros(nChannels)
+        self.m2 = np.zeros(nChannels)
+        self.min = np.full(nChannels, np.inf)
+        self.max = np.full(nChannels, -np.inf)
+
+        self.windowSamples = int(windowSamples)
+        self.window = np.zeros((nChannels, self.windowSamples))
+        self.windowIndex = 0
+        self.windowFill = 0
+        self.windowSum = np.zeros(nChannels)
+        self.sinceResum = 0
+
+        self.chunk = chunk
+        nChunks = -(-self.windowSamples // chunk)
+        self.chunkMin = np.full((nChannels, nChunks), np.inf)
+        self.chunkMax = np.full((nChannels, nChunks), -np.inf)
+
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64).reshape(self.nChannels, -1)
+        n = block.shape[1]
+        if n == 0:
+            return
+
+        # Chan et al. parallel update of the running mean and M2
+        blockMean = block.mean(axis=1)
+        blockM2 = ((block - blockMean[:, None]) ** 2).sum(axis=1)
+        total = self.count + n
+        delta = blockMean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + blockM2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+        np.minimum(self.min, block.min(axis=1), out=self.min)
+        np.maximum(self.max, block.max(axis=1), out=self.max)
+
+        self.updateWindow(block)
+
+    def updateWindow(self, block):
+        n = block.shape[1]
+        W = self.windowSamples
+        if n >= W:
+            self.window[:] = block[:, -W:]
+            self.windowIndex = 0
+            self.windowFill = W
+            self.windowSum = self.window.sum(axis=1)
+            self.sinceResum = 0
+            self.updateChunks(0, W)
+            return
+
+        first = min(n, W - self.windowIndex)
+        start = self.windowIndex
+
+        # samples falling out of the window, the filled slots are [0, windowFill)
+        fill = self.windowFill
+        evicted = (self.window[:, start:min(start + first, fill)].sum(axis=1)
+                   + self.window[:, :min(n - first, fill)].sum(axis=1))
+
+        self.window[:, start:start + first] = block[:, :first]
+        self.window[:, :n - first] = block[:, first:]
+        self.windowSum = self.windowSum + block.sum(axis=1) - evicted
+        self.windowIndex = (start + n) % W
+        self.windowFill = min(self.windowFill + n, W)
+
+        self.updateChunks(start, start + first)
+        if n > first:
+            self.updateChunks(0, n - first)
+
+        # recompute the sum now and then so rounding errors can't build up
+        self.sinceResum = self.sinceResum + n
+        if self.sinceResum >= 100 * W:
+            self.windowSum = self.window[:, :self.windowFill].sum(axis=1)
+            self.sinceResum = 0
+
+    def updateChunks(self, start, stop):
+        first = start // self.chunk
+        last = -(-stop // self.chunk)
+        # unfilled slots must not count towards the window min and max
+        values = self.window[:, first * self.chunk:min(last * self.chunk, self.windowFill)]
+        starts = np.arange(0, values.shape[1], self.chunk)
+        if len(starts):
+            self.chunkMin[:, first:first + len(starts)] = np.minimum.reduceat(values, starts, axis=1)
+            self.chunkMax[:, first:first + len(starts)] = np.maximum.reduceat(values, starts, axis=1)
+
+    def variance(self):
+        if self.count < 2:
+            return np.zeros(self.nChannels)
+        return self.m2 / (self.count - 1)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def windowMean(self):
+        if self.windowFill == 0:
+            return np.zeros(self.nChannels)
+        return self.windowSum / self.windowFill
+
+    def windowMin(self):
+        return self.chunkMin.min(axis=1)
+
+    def windowMax(self):
+        return self.chunkMax.max(axis=1)
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+Live streaming of acquired blocks to local subscribers.
+
+streamServer listens on localhost TCP ('127.0.0.1:5555') or a Unix domain
+socket ('unix:/tmp/pydaq.sock') and is added to an acquisition as a
+consumer, so every block is published as it is read:
+
+    server = streamServer('127.0.0.1:5555', description)
+    server.start()
+    acquisition.addConsumer(server.publish)
+
+Every message is a frame: a 32 byte header (magic, kind, channels, step,
+blocks, samples or payload bytes, sequence number, acquisition index of the
+first sample) followed by its payload. A subscriber first gets a HELLO frame,
+the JSON description of the stream (channels, units, sample rate, dtype and
+the scaling of raw streams), then BLOCK frames of channels x samples in the
+stream dtype, and an END frame when the session stops. Sequence numbers
+count the blocks published and a BLOCK frame holds blocks of them from its
+sequence number on, so a subscriber sees which blocks it missed, and from
+the acquisition index where samples were lost before it.
+
+publish() never waits on a subscriber. Each subscriber has a bounded queue
+and its own sender thread; when a queue is full the block is dropped for
+that subscriber. With policy='drop' every block is sent as its own frame.
+With policy='downsample' the sender merges the blocks that queued up while
+it was busy into one frame of every step-th sample, step doubling while the
+subscriber falls behind and halving again once it catches up, so a slow
+subscriber gets fewer, larger frames. A subscriber that does not take a
+frame for stallTimeout seconds is disconnected.
+
+    python daq_stream.py listen 127.0.0.1:5555
+"""
+
+import argparse
+import json
+import os
+import queue
+import socket
+import stat
+import struct
+import threading
+import time
+
+import numpy as np
+
+from daq_recording import channelScaling
+
+
+MAGIC = b'PDQS'
+frameStruct = struct.Struct('<4sHHHHIQq')  # magic, kind, channels, step, blocks, samples or bytes, sequence, first sample
+HELLO, BLOCK, END = range(3)
+
+
+def parseAddress(address):
+    # 'host:port' for TCP, 'unix:path' for a Unix domain socket
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def encodeMessage(kind, message):
+    payload = json.dumps(message).encode('utf-8')
+    return frameStruct.pack(MAGIC, kind, 0, 0, 0, len(payload), 0, 0) + payload
+
+
+def encodeBlock(block, sequence, firstSample, step=1, blocks=1):
+    header = frameStruct.pack(MAGIC, BLOCK, block.shape[0], step, blocks, block.shape[1],
+                              sequence, firstSample)
+    return header + np.ascontiguousarray(block).tobytes()
+
+
+def mergeBlocks(items, step):
+    # one frame of every step-th sample of (block, sequence, firstSample)
+    # items that follow on from each other
+    block = items[0][0] if len(items) == 1 else np.concatenate([b for b, _, _ in items], axis=1)
+    sequence, firstSample = items[0][1], items[0][2]
+    # keep the samples on multiples of step across frames
+    offset = -firstSample % step
+    return encodeBlock(block[:, offset::step], sequence, firstSample + offset, step, len(items))
+
+
+def removeStaleSocket(path):
+    # a server that did not close cleanly leaves its socket file behind and
+    # bind() fails on it. Only a socket nobody is listening on is removed.
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError('Error, a stream server is already listening on {:s}'.format(path))
+
+
+class subscriber:
+    # One connection of a streamServer: a bounded queue and a thread
+    # sending it. The queue holds encoded frames, or with the downsample
+    # policy (block, sequence, firstSample) items that the sender merges.
+    # step is the current decimation.
+
+    def __init__(self, server, connection, address):
+        self.server = server
+        self.connection = connection
+        self.address = address
+        self.queue = queue.Queue(server.maxQueue)
+        self.step = 1
+        self.depthAtChange = 0
+        self.connected = True
+
+        self.sentFrames = 0
+        self.sentBlocks = 0
+        self.sentBytes = 0
+        self.droppedBlocks = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def offer(self, item):
+        # called from publish(), never blocks
+        depth = self.queue.qsize()
+        if self.server.policy == 'downsample':
+            # only step down again while the queue keeps growing, the
+            # frames already queued take a while to drain
+            if (depth >= self.server.maxQueue // 2 and depth > self.depthAtChange
+                    and self.step < self.server.maxStep):
+                self.step = self.step * 2
+                self.depthAtChange = depth
+            elif depth == 0 and self.step > 1:
+                self.step = self.step // 2
+                self.depthAtChange = 0
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.droppedBlocks = self.droppedBlocks + 1
+
+    def run(self):
+        try:
+            self.connection.settimeout(self.server.stallTimeout)
+            pending = []
+            while True:
+                item = pending.pop() if pending else self.queue.get()
+                if item is None:
+                    break
+                if isinstance(item, bytes):
+                    self.send(item)
+                    continue
+
+                # merge the blocks queued behind this one, up to a gap in
+                # the acquisition or the next message
+                items = [item]
+                while True:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if not isinstance(item, tuple) or item[2] != items[-1][2] + items[-1][0].shape[1]:
+                        pending.append(item)
+                        break
+                    items.append(item)
+                self.send(mergeBlocks(items, self.step))
+        except OSError:
+            # gone or stalled, socket.timeout is an OSError too
+            pass
+        self.connected = False
+        self.server.remove(self)
+        self.connection.close()
+
+    def send(self, frame):
+        self.connection.sendall(frame)
+        self.sentFrames = self.sentFrames + 1
+        # blocks in the frame, 0 for HELLO and END
+        self.sentBlocks = self.sentBlocks + frameStruct.unpack_from(frame)[4]
+        self.sentBytes = self.sentBytes + len(frame)
+
+    def close(self):
+        # ends the sender once everything queued so far is sent
+        try:
+            self.queue.put(None, timeout=self.server.stallTimeout)
+        except queue.Full:
+            self.connection.close()
+
+    def stats(self):
+        return {
+            'address': str(self.address),
+            'connected': self.connected,
+            'queueDepth': self.queue.qsize(),
+            'step': self.step,
+            'sentFrames': self.sentFrames,
+            'sentBlocks': self.sentBlocks,
+            'sentBytes': self.sentBytes,
+            'droppedBlocks': self.droppedBlocks,
+        }
+
+
+class streamServer(threading.Thread):
+    # Accepts subscribers on its own thread. description is the JSON
+    # sent to each of them first, with at least the channels, the sample
+    # rate and the dtype of the blocks.
+
+    policies = ('drop', 'downsample')
+
+    def __init__(self, address, description, maxQueue=64, policy='downsample',
+                 maxStep=64, stallTimeout=5.0):
+        threading.Thread.__init__(self, daemon=True)
+        assert policy in self.policies, 'Error, stream policy unknown, recieved {:s}'.format(policy)
+        self.address = address
+        self.description = dict(description, policy=policy)
+        self.maxQueue = maxQueue
+        self.policy = policy
+        self.maxStep = maxStep
+        self.stallTimeout = stallTimeout
+
+        # replaced rather than changed, so publish() can iterate without a lock
+        self.subscribers = ()
+        self.history = []
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.running = False
+
+        # daq_diagnostics.diagnostics for stage timing, if attached
+        self.diagnostics = None
+
+        family, socketAddress = parseAddress(address)
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            removeStaleSocket(socketAddress)
+        self.listener.bind(socketAddress)
+        self.listener.listen()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            try:
+                connection, address = self.listener.accept()
+            except OSError:
+                break
+            if not self.running:
+                connection.close()
+                break
+            if connection.family == socket.AF_INET:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = subscriber(self, connection, address)
+            client.queue.put(encodeMessage(HELLO, self.description))
+            with self.lock:
+                self.subscribers = self.subscribers + (client,)
+                self.history.append(client)
+            client.thread.start()
+
+    def remove(self, client):
+        with self.lock:
+            self.subscribers = tuple(s for s in self.subscribers if s is not client)
+
+    def publish(self, block, firstSample):
+        # acquisition consumer, costs one encode or one copy per block
+        # whatever the number of subscribers
+        start = time.perf_counter_ns()
+        subscribers = self.subscribers
+        if subscribers:
+            if self.policy == 'drop':
+                item = encodeBlock(block, self.sequence, firstSample)
+            else:
+                # the block is usually a view of the reader's buffer
+                item = (np.array(block), self.sequence, firstSample)
+            for client in subscribers:
+                client.offer(item)
+        self.sequence = self.sequence + 1
+        if self.diagnostics is not None:
+            self.diagnostics.record('publish', time.perf_counter_ns() - start)
+
+    def close(self):
+        # sends END to every subscriber and stops accepting new ones
+        self.running = False
+        end = encodeMessage(END, {'blocks': self.sequence})
+        subscribers = self.subscribers
+        for client in subscribers:
+            try:
+                client.queue.put(end, timeout=self.stallTimeout)
+            except queue.Full:
+                pass
+            client.close()
+        # close() alone leaves the socket bound while accept() is blocked
+        # on it, shutting it down wakes the accepting thread first
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        if self.is_alive():
+            self.join(self.stallTimeout)
+
+        # let the senders finish what is queued, or stall out
+        for client in subscribers:
+            client.thread.join(self.stallTimeout * 2)
+        family, socketAddress = parseAddress(self.address)
+        if family != socket.AF_INET:
+            try:
+                os.unlink(socketAddress)
+            except OSError:
+                pass
+
+    def stats(self):
+        # every subscriber of the session, connected or not
+        return {'blocks': self.sequence,
+                'subscribers': [client.stats() for client in self.history]}
+
+
+class streamClient:
+    # Subscriber end of a streamServer. read() returns (block, firstSample,
+    # sequence, step) for each frame, None once the stream has ended;
+    # sequence is that of the first block merged into the frame.
+    # missedBlocks counts the blocks the server dropped for us.
+
+    def __init__(self, address, timeout=None):
+        family, socketAddress = parseAddress(address)
+        if family == socket.AF_INET:
+            self.connection = socket.create_connection(socketAddress, timeout)
+        else:
+            self.connection = socket.socket(family, socket.SOCK_STREAM)
+            self.connection.settimeout(timeout)
+            self.connection.connect(socketAddress)
+        self.file = self.connection.makefile('rb')
+
+        kind, message = self.readFrame()
+        assert kind == HELLO, 'Error, stream did not start with a description'
+        self.description = message
+        self.dtype = np.dtype(message['dtype'])
+        self.scaling = None
+        if 'scaling' in message:
+            self.scaling = channelScaling(message['scaling']['coefficients'], message['slopes'])
+
+        self.lastSequence = None
+        self.missedBlocks = 0
+        self.ended = None
+
+    def readExactly(self, n):
+        data = self.file.read(n)
+        if len(data) < n:
+            raise EOFError('stream closed')
+        return data
+
+    def readFrame(self):
+        magic, kind, nChannels, step, blocks, n, sequence, firstSample = frameStruct.unpack(
+            self.readExactly(frameStruct.size))
+        assert magic == MAGIC, 'Error, not a pydaq stream'
+        if kind != BLOCK:
+            return kind, json.loads(self.readExactly(n).decode('utf-8'))
+        payload = self.readExactly(nChannels * n * self.dtype.itemsize)
+        block = np.frombuffer(payload, dtype=self.dtype).reshape(nChannels, n)
+        return kind, (block, firstSample, sequence, step, blocks)
+
+    def read(self):
+        if self.ended is not None:
+            return None
+        try:
+            kind, message = self.readFrame()
+        except EOFError:
+            self.ended = {}
+            return None
+        if kind == END:
+            self.ended = message
+            return None
+
+        sequence, blocks = message[2], message[4]
+        if self.lastSequence is not None:
+            self.missedBlocks = self.missedBlocks + sequence - self.lastSequence - 1
+        self.lastSequence = sequence + blocks - 1
+        return message[:4]
+
+    def values(self, block):
+        # block in sensor units, scaled if the stream is raw
+        if self.scaling is None:
+            return block
+        return self.scaling.apply(block)
+
+    def __iter__(self):
+        while True:
+            message = self.read()
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        self.file.close()
+        self.connection.close()
+
+
+def listen(address):
+    # prints the rate, step and missed blocks of a stream once a second
+    client = streamClient(address)
+    print(json.dumps(client.description))
+    samples = 0
+    last = time.perf_counter()
+    for block, firstSample, sequence, step in client:
+        samples = samples + block.shape[1] * step
+        now = time.perf_counter()
+        if now - last >= 1.0:
+            print('sequence {:10d}  sample {:12d}  {:10.1f} S/s  step {:3d}  missed {}'.format(
+                sequence, firstSample, samples / (now - last), step, client.missedBlocks),
+                flush=True)
+            samples = 0
+            last = now
+    print('stream ended: {}'.format(client.ended))
+    client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Subscribe to a pydaq stream')
+    commands = parser.add_subparsers(dest='command')
+    listenParser = commands.add_parser('listen', help='print the stream rate once a second')
+    listenParser.add_argument('address', help='host:port or unix:path')
+
+    args = parser.parse_args()
+    if args.command == 'listen':
+        listen(args.address)
+    else:
+        parser.print_help()
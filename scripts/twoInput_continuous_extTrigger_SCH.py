@@ -3,6 +3,9 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import nidaqmx
 import numpy as np
 from nidaqmx.stream_writers import AnalogSingleChannelWriter
+from nidaqmx.stream_readers import AnalogMultiChannelReader
+
+from daq_display import displayBuffer, blitter, decimate, axisScaler
 
 import tkinter as tk
 from tkinter import ttk
@@ -169,6 +172,10 @@ class voltageContinuousInput(tk.Frame):
         self.task.timing.cfg_samp_clk_timing(
             sampleRate, sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS, samps_per_chan=self.numberOfSamples*3) # in continuous_mode, samps per chan is the buffer size
         
+        # reads fill this buffer in place instead of allocating lists per block
+        self.reader = AnalogMultiChannelReader(self.task.in_stream)
+        self.readBuffer = np.zeros((2, self.numberOfSamples))
+        
         self.task.start()
         if cameraTrigger == 'yes':
             self.cameraTriggerStart()
@@ -185,7 +192,9 @@ class voltageContinuousInput(tk.Frame):
         # Check if task needs to update the graph
         samplesAvailable = self.task._in_stream.avail_samp_per_chan
         if(samplesAvailable >= self.numberOfSamples):
-            vals = self.task.read(self.numberOfSamples)
+            self.reader.read_many_sample(
+                self.readBuffer, number_of_samples_per_channel=self.numberOfSamples)
+            vals = self.readBuffer
             
             # self.graphDataFrame1.ax.cla()
             # self.graphDataFrame1.ax.set_title("Acquired Data")
@@ -402,12 +411,15 @@ class inputSettings(tk.LabelFrame):
 
 class graphData1(tk.Frame):
 
-    def __init__(self, parent, title="Channel"):
+    def __init__(self, parent, title="Channel", blit=True, max_points=1000,
+                 decimation='minmax'):
         super().__init__(parent)
         self.title = title
-        self.max_points = 1000  # Number of points to show at once
-        self.ydata = np.zeros(self.max_points)
-        self.xdata = np.arange(self.max_points)
+        self.max_points = max_points  # Number of points to show at once
+        self.blit = blit  # only redraw the lines between axis changes
+        self.decimation = decimation  # 'minmax', 'lttb' or None
+        self.buffer = displayBuffer(self.max_points)
+        self.scaler = axisScaler()
         self.create_widgets()
         self.init_plot()
 
@@ -420,37 +432,64 @@ class graphData1(tk.Frame):
         self.graph.get_tk_widget().pack()
 
     def init_plot(self):
-        self.line, = self.ax.plot(self.xdata, self.ydata, color='blue')
+        # older and newer part of the circular buffer, drawn end to end
+        (x0, y0), (x1, y1) = self.buffer.segments()
+        self.line, = self.ax.plot(x0, y0, color='blue')
+        self.lineNew, = self.ax.plot(x1, y1, color='blue')
         self.ax.set_title(self.title)
         self.ax.set_xlim(0, self.max_points)
         # self.ax.set_ylim(-10, 10)  # Adjust based on expected range
+        if self.blit:
+            self.blitter = blitter(self.graph, self.ax, [self.line, self.lineNew])
         self.graph.draw()
 
     def update_plot(self, new_data):
-        num_new = len(new_data)
-        if num_new >= self.max_points:
-            self.ydata[:] = new_data[-self.max_points:]  # just take the latest
+        self.append_data(new_data)
+        self.draw_plot()
+
+    def append_data(self, new_data):
+        self.buffer.append(new_data)
+
+    def draw_plot(self, idle=True):
+        # idle=False renders now, so the caller can time the draw
+        (x0, y0), (x1, y1) = self.buffer.segments()
+        
+        # no point handing matplotlib more than ~2 points per pixel column
+        pixels = self.ax.bbox.width
+        if self.decimation is not None and self.max_points > 2 * pixels:
+            x0, y0 = decimate(x0, y0, pixels * len(y0) / self.max_points, self.decimation)
+            x1, y1 = decimate(x1, y1, pixels * len(y1) / self.max_points, self.decimation)
+        
+        self.line.set_data(x0, y0)
+        self.lineNew.set_data(x1, y1)
+        
+        # rescale only when the quantized limits have to change
+        yLimits = self.scaler.update(*self.buffer.limits())
+        if yLimits is not None:
+            self.ax.set_ylim(*yLimits)
+        elif self.blit:
+            self.blitter.update()
+            return
+        
+        if idle:
+            self.graph.draw_idle()
         else:
-            self.ydata = np.roll(self.ydata, -num_new)
-            self.ydata[-num_new:] = new_data
-
-        self.line.set_ydata(self.ydata)
-        
-        self.ax.relim()
-        self.ax.autoscale_view(scalex=False, scaley=True)
-        self.graph.draw_idle()
+            self.graph.draw()
 
 
 
 
 class graphData2(tk.Frame):
 
-    def __init__(self, parent, title="Channel"):
+    def __init__(self, parent, title="Channel", blit=True, max_points=1000,
+                 decimation='minmax'):
         super().__init__(parent)
         self.title = title
-        self.max_points = 1000  # Number of points to show at once
-        self.ydata = np.zeros(self.max_points)
-        self.xdata = np.arange(self.max_points)
+        self.max_points = max_points  # Number of points to show at once
+        self.blit = blit  # only redraw the lines between axis changes
+        self.decimation = decimation  # 'minmax', 'lttb' or None
+        self.buffer = displayBuffer(self.max_points)
+        self.scaler = axisScaler()
         self.create_widgets()
         self.init_plot()
 
@@ -463,25 +502,49 @@ class graphData2(tk.Frame):
         self.graph.get_tk_widget().pack()
 
     def init_plot(self):
-        self.line, = self.ax.plot(self.xdata, self.ydata, color='blue')
+        # older and newer part of the circular buffer, drawn end to end
+        (x0, y0), (x1, y1) = self.buffer.segments()
+        self.line, = self.ax.plot(x0, y0, color='blue')
+        self.lineNew, = self.ax.plot(x1, y1, color='blue')
         self.ax.set_title(self.title)
         self.ax.set_xlim(0, self.max_points)
         # self.ax.set_ylim(-10, 10)  # Adjust based on expected range
+        if self.blit:
+            self.blitter = blitter(self.graph, self.ax, [self.line, self.lineNew])
         self.graph.draw()
 
     def update_plot(self, new_data):
-        num_new = len(new_data)
-        if num_new >= self.max_points:
-            self.ydata[:] = new_data[-self.max_points:]  # just take the latest
+        self.append_data(new_data)
+        self.draw_plot()
+
+    def append_data(self, new_data):
+        self.buffer.append(new_data)
+
+    def draw_plot(self, idle=True):
+        # idle=False renders now, so the caller can time the draw
+        (x0, y0), (x1, y1) = self.buffer.segments()
+        
+        # no point handing matplotlib more than ~2 points per pixel column
+        pixels = self.ax.bbox.width
+        if self.decimation is not None and self.max_points > 2 * pixels:
+            x0, y0 = decimate(x0, y0, pixels * len(y0) / self.max_points, self.decimation)
+            x1, y1 = decimate(x1, y1, pixels * len(y1) / self.max_points, self.decimation)
+        
+        self.line.set_data(x0, y0)
+        self.lineNew.set_data(x1, y1)
+        
+        # rescale only when the quantized limits have to change
+        yLimits = self.scaler.update(*self.buffer.limits())
+        if yLimits is not None:
+            self.ax.set_ylim(*yLimits)
+        elif self.blit:
+            self.blitter.update()
+            return
+        
+        if idle:
+            self.graph.draw_idle()
         else:
-            self.ydata = np.roll(self.ydata, -num_new)
-            self.ydata[-num_new:] = new_data
-
-        self.line.set_ydata(self.ydata)
-        
-        self.ax.relim()
-        self.ax.autoscale_view(scalex=False, scaley=True)
-        self.graph.draw_idle()
+            self.graph.draw()
 
 
 # class graphData1(tk.Frame):
@@ -1,14 +1,31 @@
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import nidaqmx
 import numpy as np
-from nidaqmx.stream_writers import AnalogSingleChannelWriter
 
 import tkinter as tk
 from tkinter import ttk
+import sys
 import time
 from datetime import date
 
+from daq_acquisition import channelConfig, createTask, deviceScaling, ringBuffer, acquisitionThread, eventAcquisition
+from daq_recording import (binaryRecorder, textRecorder, rotatingRecorder, recordingWriter,
+                           channelScaling, uniqueFileName)
+from daq_compressed import compressedRecorder
+from daq_stats import streamingStats
+from daq_display import displayScheduler, readoutUpdater, stackedPlot
+from daq_diagnostics import diagnostics
+from daq_shared import sharedAcquisition
+from daq_stream import streamServer
+from daq_headless import channelDict, fileExtensions
+from daq_simulated import simulatedTask, simulatedWriter
+
+try:
+    import nidaqmx
+    from nidaqmx.stream_writers import AnalogSingleChannelWriter
+except ImportError:
+    # no NI driver stack, only --simulate sessions can run
+    nidaqmx = None
 
 
 import matplotlib
@@ -26,10 +43,56 @@ class voltageContinuousInput(tk.Frame):
         self.master.iconbitmap("Voltage - Continuous Input.ico")
         self.master.geometry("1280x700")
 
+        # numeric readouts are refreshed at 5 Hz whatever the block rate
+        self.readouts = readoutUpdater(self.master, rate=5)
+
         self.create_widgets()
         self.pack()
         self.run = False
 
+        # ms between GUI refreshes, acquisition itself runs on its own thread
+        self.refreshInterval = 50
+        
+        # plots are redrawn at this rate whatever the block size
+        self.targetFps = 30
+        self.displayScheduler = displayScheduler(self.master, self.targetFps, self.drawPlots)
+        
+        # sample type of binary recordings ('float32' or 'float64')
+        self.recordingDtype = 'float32'
+        
+        # codec and level of 'compressed' recordings, None for the codec default
+        self.compressionCodec = 'zlib'
+        self.compressionLevel = None
+        
+        # roll long recordings over into numbered segments, listed in
+        # '<recording>.index.json', every so many seconds or bytes; None never rolls
+        self.segmentSeconds = None
+        self.segmentBytes = None
+        
+        # what the file writer does when its queue is full ('block', 'spill' or 'drop')
+        self.writerPolicy = 'spill'
+        
+        # run against daq_simulated instead of a device, for testing without hardware
+        self.simulate = '--simulate' in sys.argv
+        
+        # read and record the unscaled int16 codes, scaled only for the
+        # plots, the averages and when the recording is read back
+        self.rawData = '--raw' in sys.argv
+        self.scaling = None
+        
+        # run the task, reads and recording in a separate acquisition process
+        # and map its ring here, so the GUI can't stall or stop a recording
+        self.separateProcess = '--process' in sys.argv
+        self.session = None
+        
+        # publish every block to live subscribers, --stream host:port or unix:path
+        self.streamAddress = sys.argv[sys.argv.index('--stream') + 1] if '--stream' in sys.argv else None
+        self.server = None
+        
+        # on an overrun let the driver overwrite the oldest samples and carry
+        # on, the lost samples are logged as a gap, instead of stopping
+        self.overwriteOnOverrun = True
+
     def create_widgets(self):
         # The main frame is made up of three subframes
         self.channelSettingsFrame = channelSettings(
@@ -41,13 +104,14 @@ class voltageContinuousInput(tk.Frame):
         self.inputSettingsFrame.grid(
             row=1, column=1, pady=(10, 0), padx=(20, 20), ipady=10)
 
-        self.graphDataFrame1 = graphData1(self)
-        self.graphDataFrame1.grid(
-            row=0, rowspan=2,column=2, sticky='n', pady=(20, 0), ipady=10)
+        channelNames = self.channelSettingsFrame.channelNames()
+        self.graphDataFrame = graphData(self, channelNames)
+        self.graphDataFrame.grid(
+            row=0, rowspan=2, column=2, sticky='n', pady=(20, 0), ipady=10)
         
-        self.graphDataFrame2 = graphData2(self)
-        self.graphDataFrame2.grid(
-            row=1, rowspan=2, column=2, pady=(20, 0), ipady=10)
+        self.diagnosticsFrame = diagnosticsPanel(self, title='Diagnostics')
+        self.diagnosticsFrame.grid(
+            row=2, column=1, sticky='ew', pady=(10, 0), padx=(20, 20), ipady=5)
         
         self.lightFrame = lightIndicator(self, title='Recording')
         self.lightFrame.grid(
@@ -56,6 +120,22 @@ class voltageContinuousInput(tk.Frame):
         self.channelAverageFrame = averageData(self, title='Channel Moving Averages')
         self.channelAverageFrame.grid(
             row=1, rowspan=1, column=4, pady=(20, 0),padx=(20, 20), ipady=10)
+        self.readoutNames = []
+        self.setChannels(channelNames)
+        self.readouts.bind('samplesLost', self.lightFrame.samplesLostVar, format='{:d}')
+        self.readouts.start()
+
+    def setChannels(self, channelNames):
+        # rebuild the plots and readouts for a new channel list
+        if channelNames != self.graphDataFrame.titles:
+            self.graphDataFrame.set_channels(channelNames)
+        
+        for name in self.readoutNames:
+            self.readouts.unbind(name)
+        averageVars = self.channelAverageFrame.set_channels(channelNames)
+        self.readoutNames = ['channel{}Average'.format(i + 1) for i in range(len(channelNames))]
+        for name, variable in zip(self.readoutNames, averageVars):
+            self.readouts.bind(name, variable)
         
     def createFileName(self):
         today = date.today()
@@ -63,29 +143,59 @@ class voltageContinuousInput(tk.Frame):
         mrn = self.inputSettingsFrame.patientMRNEntry.get()
         directoryName = self.inputSettingsFrame.saveDirName.get()
         
-        self.filename = directoryName + "cannPressure_" + mrn + "_" + formatted_date + ".txt"
-
-        
-
-    def writeDataFile(self, vals):
-        chan1 = vals[0]
-        chan2 = vals[1]
-        
-        
-        with open(self.filename, 'a') as f:  
-            for count,(val1,val2) in enumerate(zip(chan1,chan2)):
-                line_num = self.sampleCount + count
-                f.write('{:g}, {:10.6f}, {:10.6f} \n'.format(line_num, val1, val2))
+        fileFormat = self.inputSettingsFrame.fileFormatEntry.get()
+        extension = fileExtensions[fileFormat]
+        
+        # a second session of the day gets _2, _3, ... rather than overwriting the first
+        self.filename = uniqueFileName(directoryName + "cannPressure_" + mrn + "_"
+                                       + formatted_date + extension)
+
+        
+
+    def createRecorder(self, channelNames, slopes, units, sampleRate):
+        # recordings stay open for the whole session
+        fileFormat = self.inputSettingsFrame.fileFormatEntry.get()
+        
+        def openRecorder(filename, firstSample=0, startTime=None, pyramidFactor=10):
+            if fileFormat == 'binary':
+                return binaryRecorder(filename, channelNames, slopes, units,
+                                      sampleRate, dtype=self.recordingDtype, startTime=startTime,
+                                      pyramidFactor=pyramidFactor, scaling=self.scaling,
+                                      firstSample=firstSample)
+            if fileFormat == 'compressed':
+                # chunks are compressed on the writer thread
+                recorder = compressedRecorder(filename, channelNames, slopes, units,
+                                              sampleRate, dtype=self.recordingDtype,
+                                              startTime=startTime, codec=self.compressionCodec,
+                                              level=self.compressionLevel,
+                                              pyramidFactor=pyramidFactor, scaling=self.scaling,
+                                              firstSample=firstSample)
+                recorder.diagnostics = self.diagnostics
+                return recorder
+            return textRecorder(filename, len(channelNames), scaling=self.scaling,
+                                firstSample=firstSample)
+        
+        if self.segmentSeconds or self.segmentBytes:
+            # segments are rolled on the writer thread
+            recorder = rotatingRecorder(self.filename, openRecorder, sampleRate,
+                                        segmentSeconds=self.segmentSeconds,
+                                        segmentBytes=self.segmentBytes)
+            recorder.diagnostics = self.diagnostics
+        else:
+            recorder = openRecorder(self.filename)
+        self.recorder = recorder
+        
+        # disk I/O happens on the writer thread, fed straight from acquisition
+        self.writer = recordingWriter(recorder, policy=self.writerPolicy)
+        self.writer.diagnostics = self.diagnostics
+        self.writer.start()
+        self.acquisition.addConsumer(self.writer.put)
     
     def averageData(self, vals):
-        chan1 = np.mean(vals[0])
-        chan2 = np.mean(vals[1])
-        
-        self.channelAverageFrame.channel1AverageValue.delete(0, 'end')
-        self.channelAverageFrame.channel1AverageValue.insert(0, '{:4.3f}'.format(chan1))
-        
-        self.channelAverageFrame.channel2AverageValue.delete(0, 'end')
-        self.channelAverageFrame.channel2AverageValue.insert(0, '{:4.3f}'.format(chan2))
+        # true moving average over the averaging window, updated per block
+        self.stats.update(vals)
+        for name, average in zip(self.readoutNames, self.stats.windowMean()):
+            self.readouts.set(name, average)
 
                 
     def cameraTriggerStart(self):
@@ -95,51 +205,25 @@ class voltageContinuousInput(tk.Frame):
         
         sampleRate = int(self.inputSettingsFrame.sampleRateEntry.get())
         
-        self.task_ao = nidaqmx.Task()
+        if self.simulate:
+            self.task_ao = simulatedTask()
+            sampleMode = 'CONTINUOUS'
+            writer = simulatedWriter
+        else:
+            assert nidaqmx is not None, 'Error, nidaqmx is not installed, use --simulate'
+            self.task_ao = nidaqmx.Task()
+            sampleMode = nidaqmx.constants.AcquisitionType.CONTINUOUS
+            writer = AnalogSingleChannelWriter
         self.task_ao.ao_channels.add_ao_voltage_chan('Dev1/ao0')
         self.task_ao.timing.cfg_samp_clk_timing(rate = int(sampleRate * buffer),
-                                           sample_mode = nidaqmx.constants.AcquisitionType.CONTINUOUS,
+                                           sample_mode = sampleMode,
                                            samps_per_chan = buffer)
         
-        self.ao_stream = AnalogSingleChannelWriter(self.task_ao.out_stream, auto_start=True)
+        self.ao_stream = writer(self.task_ao.out_stream, auto_start=True)
         wave = np.append(np.zeros(int(buffer / 2)), np.ones(int(buffer / 2))*5)
         
         self.ao_stream.write_many_sample(wave)
 
-    def scaleChan1(self):
-        sensorUnits = self.channelSettingsFrame.sensorUnitsEntry1.get()
-
-        maxVoltage1 = int(self.channelSettingsFrame.maxVoltageEntry1.get())
-        minVoltage1 = int(self.channelSettingsFrame.minVoltageEntry1.get())
-        
-        maxValue1 = int(self.channelSettingsFrame.maxSensorEntry1.get())
-        minValue1 = int(self.channelSettingsFrame.minSensorEntry1.get())
-        
-        voltageRange = maxVoltage1 - minVoltage1
-        sensorRange = maxValue1 - minValue1
-        slope = sensorRange / voltageRange
-
-        nidaqmx.scale.Scale.create_lin_scale('scaleChan1', slope, y_intercept=0.0,
-                                             scaled_units=sensorUnits)
-    
-    def scaleChan2(self):
-        sensorUnits = self.channelSettingsFrame.sensorUnitsEntry2.get()
-
-        maxVoltage1 = int(self.channelSettingsFrame.maxVoltageEntry2.get())
-        minVoltage1 = int(self.channelSettingsFrame.minVoltageEntry2.get())
-        
-        maxValue1 = int(self.channelSettingsFrame.maxSensorEntry2.get())
-        minValue1 = int(self.channelSettingsFrame.minSensorEntry2.get())
-        
-        voltageRange = maxVoltage1 - minVoltage1
-        sensorRange = maxValue1 - minValue1
-        slope = sensorRange / voltageRange
-
-        nidaqmx.scale.Scale.create_lin_scale('scaleChan2', slope, y_intercept=0.0,
-                                             scaled_units=sensorUnits)
-        
-        
-
     def startTask(self):
         
         # Prevent user from starting task a second time
@@ -148,90 +232,237 @@ class voltageContinuousInput(tk.Frame):
         # Shared flag to alert task if it should stop
         self.continueRunning = True
         
+        fileFormat = self.inputSettingsFrame.fileFormatEntry.get()
+        assert fileFormat in fileExtensions, 'Error, file format unknown, recieved {:s}'.format(fileFormat)
+        
         #create filename
         self.createFileName()
         print(self.filename)
 
         # Get task settings from the user
-        physicalChannel1 = self.channelSettingsFrame.physicalChannelEntry1.get()
-        maxVoltage1 = int(self.channelSettingsFrame.maxVoltageEntry1.get())
-        minVoltage1 = int(self.channelSettingsFrame.minVoltageEntry1.get())
-        
-        physicalChannel2 = self.channelSettingsFrame.physicalChannelEntry2.get()
-        maxVoltage2 = int(self.channelSettingsFrame.maxVoltageEntry2.get())
-        minVoltage2 = int(self.channelSettingsFrame.minVoltageEntry2.get())
+        channels = self.channelSettingsFrame.channels()
+        nChannels = len(channels)
+        self.setChannels([channel.name for channel in channels])
         
         sampleRate = int(self.inputSettingsFrame.sampleRateEntry.get())
+        self.sampleRate = sampleRate
+        readMode = self.inputSettingsFrame.readModeEntry.get()
+        assert (readMode == 'thread') or (readMode == 'event'), 'Error, read mode unknown, recieved {:s}'.format(readMode)
         # cameraTrigger = self.inputSettingsFrame.triggerFlagEntry.get()
         # assert (cameraTrigger == 'yes') or (cameraTrigger == 'no'), 'Error, camera trigger flag unknown, recieved {:s}'.format(cameraTrigger)
         
-        # create channel scales
-        self.scaleChan1()
-        self.scaleChan2()
-        
         # Have to share number of samples with runTask
         self.numberOfSamples = int(
             self.inputSettingsFrame.numberOfSamplesEntry.get())
 
-        # Create and start task
-        self.task = nidaqmx.Task()
-        self.task.ai_channels.add_ai_voltage_chan(
-            physicalChannel1, min_val=minVoltage1, max_val=maxVoltage1,
-            custom_scale_name='scaleChan1',
-            units=nidaqmx.constants.VoltageUnits(10065))
-        
-        self.task.ai_channels.add_ai_voltage_chan(
-            physicalChannel2, min_val=minVoltage2, max_val=maxVoltage2,
-            custom_scale_name='scaleChan2',
-            units=nidaqmx.constants.VoltageUnits(10065))
+        # stage timings and counters for this session, dumped when it stops
+        self.diagnostics = diagnostics()
+        self.displayScheduler.diagnostics = self.diagnostics
+        self.readouts.diagnostics = self.diagnostics
         
+        if self.separateProcess:
+            self.startSession(channels, sampleRate, readMode)
+        else:
+            self.startAcquisition(channels, sampleRate, readMode)
+        self.plotReader = self.ring.reader()
+        self.averageReader = self.ring.reader()
         
-        self.task.timing.cfg_samp_clk_timing(
-            sampleRate, sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS, samps_per_chan=self.numberOfSamples*3) # in continuous_mode, samps per chan is the buffer size
-        
-        self.task.start()
-        # if cameraTrigger == 'yes':
-        #     self.cameraTriggerStart()
+        averageWindow = float(self.inputSettingsFrame.averageWindowEntry.get())
+        self.stats = streamingStats(nChannels, max(int(averageWindow * sampleRate), 1))
         
         # could use start time, dt and number of samples to save time
         startTime = time.time()
         self.sampleCount = 0
 
         # spin off call to check
-        self.master.after(10, self.runTask)
+        self.runTaskDue = time.perf_counter() + self.refreshInterval / 1000
+        self.diagnosticsDue = time.perf_counter()
+        self.master.after(self.refreshInterval, self.runTask)
+        self.displayScheduler.start()
         
         self.lightFrame.set_light_color("green")
 
-    def runTask(self):
+    def startAcquisition(self, channels, sampleRate, readMode):
+        # Create and start task, one scaled AI channel per row of the table
+        self.task = createTask(channels, sampleRate, self.numberOfSamples * 3,
+                               simulate=self.simulate, overwrite=self.overwriteOnOverrun)
+        
+        # ring buffer between the acquisition thread and the GUI consumers,
+        # sized for ~10 s of data so a busy GUI never stalls the reads
+        ringCapacity = max(sampleRate * 10, self.numberOfSamples * 20)
+        self.ring = ringBuffer(len(channels), ringCapacity,
+                               dtype=np.int16 if self.rawData else np.float64)
+        self.scaling = None
+        if self.rawData:
+            self.scaling = channelScaling(deviceScaling(self.task),
+                                          [channel.slope() for channel in channels])
+        
+        # event callbacks have to be registered before the task starts
+        if readMode == 'event':
+            self.acquisition = eventAcquisition(
+                self.task, self.ring, self.numberOfSamples, sampleRate, raw=self.rawData)
+        else:
+            self.acquisition = acquisitionThread(
+                self.task, self.ring, self.numberOfSamples, sampleRate, raw=self.rawData)
+        self.acquisition.diagnostics = self.diagnostics
+        
+        self.createRecorder([channel.name for channel in channels],
+                            [channel.slope() for channel in channels],
+                            [channel.units for channel in channels], sampleRate)
+        
+        if self.streamAddress is not None:
+            self.startStream(channels, sampleRate)
+        
+        self.task.start()
+        # nothing reaches the writer before acquisition.start()
+        self.recorder.setStartTime(time.time())
+        # if cameraTrigger == 'yes':
+        #     self.cameraTriggerStart()
+        
+        self.acquisition.start()
+
+    def startStream(self, channels, sampleRate):
+        description = {
+            'channels': [channel.name for channel in channels],
+            'units': [channel.units for channel in channels],
+            'slopes': [channel.slope() for channel in channels],
+            'sampleRate': sampleRate,
+            'numberOfSamples': self.numberOfSamples,
+            'dtype': self.ring.data.dtype.str,
+        }
+        if self.scaling is not None:
+            description['scaling'] = self.scaling.description()
+        self.server = streamServer(self.streamAddress, description)
+        self.server.diagnostics = self.diagnostics
+        self.server.start()
+        self.acquisition.addConsumer(self.server.publish)
+
+    def startSession(self, channels, sampleRate, readMode):
+        # the acquisition process owns the task and the recording, the GUI
+        # only reads the shared ring and the counters published with it
+        self.session = sharedAcquisition({
+            'sampleRate': sampleRate,
+            'numberOfSamples': self.numberOfSamples,
+            'filename': self.filename,
+            'readMode': readMode,
+            'fileFormat': self.inputSettingsFrame.fileFormatEntry.get(),
+            'recordingDtype': self.recordingDtype,
+            'codec': self.compressionCodec,
+            'level': self.compressionLevel,
+            'writerPolicy': self.writerPolicy,
+            'segmentSeconds': self.segmentSeconds,
+            'segmentBytes': self.segmentBytes,
+            'simulate': self.simulate,
+            'overwrite': self.overwriteOnOverrun,
+            'raw': self.rawData,
+            'stream': self.streamAddress,
+            'channels': [channelDict(channel) for channel in channels],
+        })
+        print('Acquisition process {}, stop it with daq_shared.py stop {}'.format(
+            self.session.process.pid, self.session.name))
+        self.ring = self.session.ring
+        self.scaling = self.session.scaling
+        self.acquisition = self.session
+
+    def drawPlots(self):
+        # called by the display scheduler, takes every block since the last
+        # frame; the plot only needs the newest samples, skip the rest
+        latest = self.ring.writeCount
+        self.plotReader.skipTo(latest - self.graphDataFrame.max_points)
+        vals, firstSample = self.plotReader.read()
+        if vals.shape[1] == 0:
+            return False
+        if self.scaling is not None:
+            vals = self.scaling.apply(vals)
+        
+        self.graphDataFrame.append_data(vals)
+        self.graphDataFrame.draw_plot(idle=False)
+        return True
+
+    def consumeData(self):
+        # acquisition index, it keeps counting through lost samples
+        self.sampleCount = self.acquisition.position
+        samplesLost = self.acquisition.samplesLost
+        if self.session is None:
+            samplesLost = samplesLost + self.writer.droppedSamples
+        self.readouts.set('samplesLost', samplesLost)
+
+        vals, firstSample = self.averageReader.read()
+        if vals.shape[1] > 0:
+            if self.scaling is not None:
+                vals = self.scaling.apply(vals)
+            self.averageData(vals)
 
-        # Check if task needs to update the graph
-        samplesAvailable = self.task._in_stream.avail_samp_per_chan
-        if(samplesAvailable >= self.numberOfSamples):
-            vals = self.task.read(self.numberOfSamples)
-            
-            # self.graphDataFrame1.ax.cla()
-            # self.graphDataFrame1.ax.set_title("Acquired Data")
-            # self.graphDataFrame1.ax.plot(vals[0])
-            # self.graphDataFrame1.graph.draw()
-            self.graphDataFrame1.update_plot(vals[0])
-            self.graphDataFrame2.update_plot(vals[1])
-            
-            # self.graphDataFrame2.ax.cla()
-            # self.graphDataFrame2.ax.set_title("Acquired Data")
-            # self.graphDataFrame2.ax.plot(vals[1])
-            # self.graphDataFrame2.graph.draw()
+    def runTask(self):
+        
+        # how late Tk ran us, then the time to drain the statistics
+        start = time.perf_counter()
+        self.diagnostics.record('runTaskLate', int(max(start - self.runTaskDue, 0) * 1e9))
 
-            self.writeDataFile(vals)
-            self.averageData(vals)
-            self.sampleCount = self.sampleCount + self.numberOfSamples
+        # reads happen on the acquisition thread, drain what it has buffered
+        self.consumeData()
+        self.diagnostics.record('stats', int((time.perf_counter() - start) * 1e9))
+        
+        if start >= self.diagnosticsDue:
+            self.diagnosticsDue = start + 1.0
+            self.diagnosticsFrame.show(self.diagnostics)
 
+        if self.acquisition.error is not None:
+            print('Acquisition stopped: {}'.format(self.acquisition.error))
+            self.stopTask()
+        elif self.session is None and self.writer.error is not None:
+            # a failed writer records nothing more, stop rather than show green
+            print('Recording stopped: {}'.format(self.writer.error))
+            self.stopTask()
 
         # check if the task should sleep or stop
         if(self.continueRunning):
-            self.master.after(10, self.runTask)
+            self.runTaskDue = time.perf_counter() + self.refreshInterval / 1000
+            self.master.after(self.refreshInterval, self.runTask)
+        elif self.session is not None:
+            self.displayScheduler.stop()
+            self.session.stop(timeout=30)
+            self.consumeData()
+            self.drawPlots()
+            print('Acquisition process: lost {} samples in {} gaps, summary in {}.log'.format(
+                self.session.samplesLost, self.session.gaps, self.filename))
+            self.session.close()
+            self.session = None
+            self.diagnosticsFrame.show(self.diagnostics)
+            print(self.diagnostics.dump(self.filename + '.gui.diagnostics.json'))
+            self.inputSettingsFrame.startButton['state'] = 'enabled'
         else:
+            self.displayScheduler.stop()
+            self.acquisition.stop(timeout=self.numberOfSamples / self.sampleRate + 1)
             self.task.stop()
+            self.acquisition.unregister()
+            if self.server is not None:
+                self.server.close()
+                self.server = None
+            self.consumeData()
+            self.drawPlots()
+            print('Display: {frames} frames, draw time mean {drawTimeMeanMs:.1f} ms, '
+                  'max {drawTimeMaxMs:.1f} ms, {skippedFrames} skipped frames'.format(
+                      **self.displayScheduler.stats()))
+            print('Block latency (ms) last {latencyLastMs:.2f}, mean {latencyMeanMs:.2f}, '
+                  'p99 {latencyP99Ms:.2f}, max {latencyMaxMs:.2f}; '
+                  'CPU {cpuPercent:.1f}%; lost {samplesLost} samples in {gaps} gaps'.format(
+                  **self.acquisition.summary()))
             self.task.close()
+            self.writer.close()
+            print('Writer: {bytesWritten} bytes at {bytesPerSecond:.0f} B/s, '
+                  'max queue depth {maxQueueDepth}, worst stall {worstStall:.3f} s, '
+                  'spilled {spilledBlocks} blocks, dropped {droppedSamples} samples'.format(
+                      **self.writer.stats()))
+            if isinstance(self.recorder, rotatingRecorder):
+                print('Segments: {} listed in {}'.format(len(self.recorder.index['segments']),
+                                                         self.recorder.indexFilename))
+            elif isinstance(self.recorder, compressedRecorder):
+                print('Compression: {codec} level {level}, ratio {ratio:.2f}, '
+                      '{compressSeconds:.2f} s CPU at {compressMBps:.1f} MB/s'.format(
+                          **self.recorder.stats()))
+            self.diagnosticsFrame.show(self.diagnostics)
+            print(self.diagnostics.dump(self.filename + '.diagnostics.json'))
             # self.task_ao.stop()
             # self.task_ao.close()
             self.inputSettingsFrame.startButton['state'] = 'enabled'
@@ -244,125 +475,71 @@ class voltageContinuousInput(tk.Frame):
 
 class channelSettings(tk.LabelFrame):
 
+    # one row per analog input channel, up to maxChannels
+    columns = ["Name", "Physical Channel", "Max Voltage", "Min Voltage",
+               "Max Sensor Value", "Min Sensor Value", "Sensor Units"]
+    defaultChannels = [["Light", "Dev1/ai0", "5", "0", "5", "0", "PSI"],
+                       ["Pressure", "Dev1/ai1", "5", "-5", "5", "-5", "cmH20"]]
+    maxChannels = 16
+
     def __init__(self, parent, title):
         tk.LabelFrame.__init__(self, parent, text=title, labelanchor='n')
         self.parent = parent
         self.grid_columnconfigure(0, weight=1)
-        self.xPadding = (30, 30)
+        self.xPadding = (2, 2)
+        self.rows = []
         self.create_widgets()
 
     def create_widgets(self):
 
-        
-        # Channel 1
-        
-        self.physicalChannelLabel1 = ttk.Label(self, text="Physical Channel 1")
-        self.physicalChannelLabel1.grid(
-            row=0, column=0, sticky='w',padx=self.xPadding, pady=(10, 0))
-
-        self.physicalChannelEntry1 = ttk.Entry(self)
-        self.physicalChannelEntry1.insert(0, "Dev1/ai0")
-        self.physicalChannelEntry1.grid(row=1,column=0, sticky="ew", padx=self.xPadding)
-
-        self.maxVoltageLabel1 = ttk.Label(self, text="Max Voltage")
-        self.maxVoltageLabel1.grid(
-            row=2, column=0, sticky='w', padx=self.xPadding, pady=(5, 0))
-
-        self.maxVoltageEntry1 = ttk.Entry(self)
-        self.maxVoltageEntry1.insert(0, "5")
-        self.maxVoltageEntry1.grid(row=3, column=0, sticky="ew", padx=self.xPadding)
-
-        self.minVoltageLabel1 = ttk.Label(self, text="Min Voltage")
-        self.minVoltageLabel1.grid(
-            row=4, column=0, sticky='w', padx=self.xPadding, pady=(5, 0))
-
-        self.minVoltageEntry1 = ttk.Entry(self)
-        self.minVoltageEntry1.insert(0, "0")
-        self.minVoltageEntry1.grid(
-            row=5,column=0, sticky="ew", padx=self.xPadding)
-        
-        self.maxSensorLabel1 = ttk.Label(self, text="Max Sensor Value")
-        self.maxSensorLabel1.grid(
-            row=6, column=0, sticky='w', padx=self.xPadding, pady=(5, 0))
-
-        self.maxSensorEntry1 = ttk.Entry(self)
-        self.maxSensorEntry1.insert(0, "5")
-        self.maxSensorEntry1.grid(row=7, column=0, sticky="ew", padx=self.xPadding)
-
-        self.minSensorLabel1 = ttk.Label(self, text="Min Sensor Value")
-        self.minSensorLabel1.grid(
-            row=8, column=0, sticky='w', padx=self.xPadding, pady=(5, 0))
-
-        self.minSensorEntry1 = ttk.Entry(self)
-        self.minSensorEntry1.insert(0, "0")
-        self.minSensorEntry1.grid(
-            row=9,column=0, sticky="ew", padx=self.xPadding)
-        
-        self.sensorUnitsLabel1 = ttk.Label(self, text="Sensor Units")
-        self.sensorUnitsLabel1.grid(
-            row=10, column=0, sticky='w', padx=self.xPadding, pady=(5, 0))
-
-        self.sensorUnitsEntry1 = ttk.Entry(self)
-        self.sensorUnitsEntry1.insert(0, "PSI")
-        self.sensorUnitsEntry1.grid(
-            row=11,column=0, sticky="ew", padx=self.xPadding, pady=(0, 5))
-        
-
-
-        # Channel 2
-        
-        
-        self.physicalChannelLabel2 = ttk.Label(self, text="Physical Channel 2")
-        self.physicalChannelLabel2.grid(
-            row=0, column=1, sticky='w',padx=self.xPadding, pady=(10, 0))
-
-        self.physicalChannelEntry2 = ttk.Entry(self)
-        self.physicalChannelEntry2.insert(0, "Dev1/ai1")
-        self.physicalChannelEntry2.grid(row=1, column=1,sticky="ew", padx=self.xPadding)
-
-        self.maxVoltageLabel2 = ttk.Label(self, text="Max Voltage")
-        self.maxVoltageLabel2.grid(
-            row=2, column=1,sticky='w', padx=self.xPadding, pady=(5, 0))
-
-        self.maxVoltageEntry2 = ttk.Entry(self)
-        self.maxVoltageEntry2.insert(0, "5")
-        self.maxVoltageEntry2.grid(row=3,column=1, sticky="ew", padx=self.xPadding)
-
-        self.minVoltageLabel2 = ttk.Label(self, text="Min Voltage")
-        self.minVoltageLabel2.grid(
-            row=4, column=1, sticky='w', padx=self.xPadding, pady=(5, 0))
-
-        self.minVoltageEntry2 = ttk.Entry(self)
-        self.minVoltageEntry2.insert(0, "-5")
-        self.minVoltageEntry2.grid(
-            row=5, column=1, sticky="ew", padx=self.xPadding)
-        
-        self.maxSensorLabel2 = ttk.Label(self, text="Max Sensor Value")
-        self.maxSensorLabel2.grid(
-            row=6, column=1, sticky='w', padx=self.xPadding, pady=(5, 0))
-
-        self.maxSensorEntry2 = ttk.Entry(self)
-        self.maxSensorEntry2.insert(0, "5")
-        self.maxSensorEntry2.grid(row=7, column=1, sticky="ew", padx=self.xPadding)
-
-        self.minSensorLabel2 = ttk.Label(self, text="Min Sensor Value")
-        self.minSensorLabel2.grid(
-            row=8, column=1, sticky='w', padx=self.xPadding, pady=(5, 0))
-
-        self.minSensorEntry2 = ttk.Entry(self)
-        self.minSensorEntry2.insert(0, "-5")
-        self.minSensorEntry2.grid(
-            row=9,column=1, sticky="ew", padx=self.xPadding)
-        
-        self.sensorUnitsLabel2 = ttk.Label(self, text="Sensor Units")
-        self.sensorUnitsLabel2.grid(
-            row=10, column=1, sticky='w', padx=self.xPadding, pady=(5, 0))
-
-        self.sensorUnitsEntry2 = ttk.Entry(self)
-        self.sensorUnitsEntry2.insert(0, "cmH20")
-        self.sensorUnitsEntry2.grid(
-            row=11,column=1, sticky="ew", padx=self.xPadding, pady=(0, 5))
-        
+        for column, text in enumerate(self.columns):
+            label = ttk.Label(self, text=text, wraplength=70)
+            label.grid(row=0, column=column, sticky='w', padx=self.xPadding, pady=(10, 0))
+
+        for values in self.defaultChannels:
+            self.addChannel(values)
+
+        self.addButton = ttk.Button(self, text="Add Channel", command=self.addChannel)
+        self.addButton.grid(row=self.maxChannels + 1, column=0, columnspan=2, sticky='w',
+                            padx=self.xPadding, pady=(5, 0))
+
+        self.removeButton = ttk.Button(self, text="Remove Channel", command=self.removeChannel)
+        self.removeButton.grid(row=self.maxChannels + 1, column=5, columnspan=2, sticky='e',
+                               padx=self.xPadding, pady=(5, 0))
+
+    def addChannel(self, values=None):
+        n = len(self.rows)
+        if n >= self.maxChannels:
+            return
+        if values is None:
+            values = ["Channel {}".format(n + 1), "Dev1/ai{}".format(n),
+                      "5", "-5", "5", "-5", "V"]
+
+        entries = []
+        for column, value in enumerate(values):
+            entry = ttk.Entry(self, width=14 if column < 2 else 7)
+            entry.insert(0, value)
+            entry.grid(row=n + 1, column=column, sticky="ew", padx=self.xPadding)
+            entries.append(entry)
+        self.rows.append(entries)
+
+    def removeChannel(self):
+        if len(self.rows) > 1:
+            for entry in self.rows.pop():
+                entry.destroy()
+
+    def channelNames(self):
+        return [entries[0].get() for entries in self.rows]
+
+    def channels(self):
+        channels = []
+        for entries in self.rows:
+            name, physicalChannel, maxVoltage, minVoltage, maxSensor, minSensor, units = \
+                [entry.get() for entry in entries]
+            channels.append(channelConfig(
+                physicalChannel, float(minVoltage), float(maxVoltage),
+                float(minSensor), float(maxSensor), units, name=name))
+        return channels
         
 
 class inputSettings(tk.LabelFrame):
@@ -412,109 +589,87 @@ class inputSettings(tk.LabelFrame):
         self.patientMRNEntry.grid(
             row=3, column=0, columnspan=1, sticky='ew', padx=self.xPadding)
         
+        self.readModeLabel = ttk.Label(self, text="Read Mode (thread / event)")
+        self.readModeLabel.grid(
+            row=2, column=1, columnspan=1, sticky='w', padx=self.xPadding, pady=(10, 0))
+
+        self.readModeEntry = ttk.Entry(self)
+        self.readModeEntry.insert(0, "event")
+        self.readModeEntry.grid(
+            row=3, column=1, columnspan=1, sticky='ew', padx=self.xPadding)
+        
+
+        self.fileFormatLabel = ttk.Label(self, text="File Format (binary / compressed / text)")
+        self.fileFormatLabel.grid(
+            row=4, column=0, columnspan=1, sticky='w', padx=self.xPadding, pady=(10, 0))
+
+        self.fileFormatEntry = ttk.Entry(self)
+        self.fileFormatEntry.insert(0, "binary")
+        self.fileFormatEntry.grid(
+            row=5, column=0, columnspan=1, sticky='ew', padx=self.xPadding)
+
+        self.averageWindowLabel = ttk.Label(self, text="Average Window (s)")
+        self.averageWindowLabel.grid(
+            row=4, column=1, columnspan=1, sticky='w', padx=self.xPadding, pady=(10, 0))
+
+        self.averageWindowEntry = ttk.Entry(self)
+        self.averageWindowEntry.insert(0, "1")
+        self.averageWindowEntry.grid(
+            row=5, column=1, columnspan=1, sticky='ew', padx=self.xPadding)
 
         self.saveDirLabel = ttk.Label(self, text="Directory Name")
         self.saveDirLabel.grid(
-            row=4, column=0, columnspan=2, sticky='w', padx=self.xPadding, pady=(10, 0))
+            row=6, column=0, columnspan=2, sticky='w', padx=self.xPadding, pady=(10, 0))
 
         self.saveDirName = ttk.Entry(self)
         self.saveDirName.insert(0, "C://Users/mbarb1/pressure_can_data/")
-        self.saveDirName.grid(row=5, column=0, columnspan=2, sticky="ew", padx=self.xPadding)
+        self.saveDirName.grid(row=7, column=0, columnspan=2, sticky="ew", padx=self.xPadding)
 
         self.startButton = ttk.Button(
         self, text="Start Task", command=self.parent.startTask)
-        self.startButton.grid(row=6, column=0, sticky='w',
+        self.startButton.grid(row=8, column=0, sticky='w',
                               padx=self.xPadding, pady=(10, 0))
 
         self.stopButton = ttk.Button(
             self, text="Stop Task", command=self.parent.stopTask)
-        self.stopButton.grid(row=6, column=1, sticky='e',
+        self.stopButton.grid(row=8, column=1, sticky='e',
                              padx=self.xPadding, pady=(10, 0))
 
 
 
-class graphData1(tk.Frame):
+class graphData(tk.Frame):
 
-    def __init__(self, parent, title="Light"):
+    # one axes per channel, stacked in a single figure so every channel is
+    # drawn by one canvas draw or one blit
+    def __init__(self, parent, titles, blit=True, max_points=1000,
+                 decimation='minmax'):
         super().__init__(parent)
-        self.title = title
-        self.max_points = 1000  # Number of points to show at once
-        self.ydata = np.zeros(self.max_points)
-        self.xdata = np.arange(self.max_points)
-        self.create_widgets()
-        self.init_plot()
+        self.max_points = max_points  # Number of points to show at once
+        self.create_widgets(blit, decimation)
+        self.set_channels(titles)
 
-    def create_widgets(self):
-        self.graphTitle = ttk.Label(self, text=self.title)
-        self.graphTitle.pack()
-        self.fig = Figure(figsize=(6, 3), dpi=100, tight_layout=True)
-        self.ax = self.fig.add_subplot(1, 1, 1)
+    def create_widgets(self, blit, decimation):
+        self.fig = Figure(figsize=(6, 6), dpi=100, tight_layout=True)
         self.graph = FigureCanvasTkAgg(self.fig, self)
         self.graph.get_tk_widget().pack()
+        # the drawing is shared with daq_benchmark, which renders it off screen
+        self.plot = stackedPlot(self.fig, self.graph, self.max_points, blit, decimation)
 
-    def init_plot(self):
-        self.line, = self.ax.plot(self.xdata, self.ydata, color='blue')
-        self.ax.set_title(self.title)
-        self.ax.set_xlim(0, self.max_points)
-        # self.ax.set_ylim(-10, 10)  # Adjust based on expected range
-        self.graph.draw()
+    def set_channels(self, titles):
+        # rebuilds the axes, the plots start empty again
+        self.plot.setChannels(titles)
 
     def update_plot(self, new_data):
-        num_new = len(new_data)
-        if num_new >= self.max_points:
-            self.ydata[:] = new_data[-self.max_points:]  # just take the latest
-        else:
-            self.ydata = np.roll(self.ydata, -num_new)
-            self.ydata[-num_new:] = new_data
+        self.append_data(new_data)
+        self.draw_plot()
 
-        self.line.set_ydata(self.ydata)
-        
-        self.ax.relim()
-        self.ax.autoscale_view(scalex=False, scaley=True)
-        self.graph.draw_idle()
-
-
-
-
-class graphData2(tk.Frame):
+    def append_data(self, new_data):
+        # new_data is a (channels x samples) block
+        self.plot.append(new_data)
 
-    def __init__(self, parent, title="Pressure"):
-        super().__init__(parent)
-        self.title = title
-        self.max_points = 1000  # Number of points to show at once
-        self.ydata = np.zeros(self.max_points)
-        self.xdata = np.arange(self.max_points)
-        self.create_widgets()
-        self.init_plot()
-
-    def create_widgets(self):
-        self.graphTitle = ttk.Label(self, text=self.title)
-        self.graphTitle.pack()
-        self.fig = Figure(figsize=(6, 3), dpi=100, tight_layout=True)
-        self.ax = self.fig.add_subplot(1, 1, 1)
-        self.graph = FigureCanvasTkAgg(self.fig, self)
-        self.graph.get_tk_widget().pack()
-
-    def init_plot(self):
-        self.line, = self.ax.plot(self.xdata, self.ydata, color='blue')
-        self.ax.set_title(self.title)
-        self.ax.set_xlim(0, self.max_points)
-        # self.ax.set_ylim(-10, 10)  # Adjust based on expected range
-        self.graph.draw()
-
-    def update_plot(self, new_data):
-        num_new = len(new_data)
-        if num_new >= self.max_points:
-            self.ydata[:] = new_data[-self.max_points:]  # just take the latest
-        else:
-            self.ydata = np.roll(self.ydata, -num_new)
-            self.ydata[-num_new:] = new_data
-
-        self.line.set_ydata(self.ydata)
-        
-        self.ax.relim()
-        self.ax.autoscale_view(scalex=False, scaley=True)
-        self.graph.draw_idle()
+    def draw_plot(self, idle=True):
+        # idle=False renders now, so the caller can time the draw
+        self.plot.draw(idle)
 
 
 # class graphData1(tk.Frame):
@@ -552,27 +707,46 @@ class averageData(tk.Frame):
     def __init__(self, parent, title):
         tk.LabelFrame.__init__(self, parent, text=title, labelanchor='n')
         self.xPadding = (30,30)
-        self.create_widgets()
+        self.widgets = []
+        
+    def set_channels(self, titles):
+        # one readout per channel, returns their StringVars in channel order
+        for widget in self.widgets:
+            widget.destroy()
+        self.widgets = []
+        
+        averageVars = []
+        for i, title in enumerate(titles):
+            averageLabel = ttk.Label(self, text=title)
+            averageLabel.grid(
+            row=2 * i, column=0, sticky='w',padx=self.xPadding, pady=(10, 0))
+            
+            averageVar = tk.StringVar(self, value="0")
+            averageValue = ttk.Entry(self, textvariable=averageVar)
+            averageValue.grid(row=2 * i + 1,column=0, sticky="ew", padx=self.xPadding)
+            
+            self.widgets.extend([averageLabel, averageValue])
+            averageVars.append(averageVar)
+        return averageVars
         
-    def create_widgets(self): 
        
-        self.channel1AverageLabel = ttk.Label(self, text="Channel 1")
-        self.channel1AverageLabel.grid(
-        row=0, column=0, sticky='w',padx=self.xPadding, pady=(10, 0))
-
-        self.channel1AverageValue = ttk.Entry(self)
-        self.channel1AverageValue.insert(0, "0")
-        self.channel1AverageValue.grid(row=1,column=0, sticky="ew", padx=self.xPadding)
+class diagnosticsPanel(tk.LabelFrame):
+    def __init__(self, parent, title):
+        tk.LabelFrame.__init__(self, parent, text=title, labelanchor='n')
+        self.xPadding = (10, 10)
+        self.create_widgets()
         
-        self.channel2AverageLabel = ttk.Label(self, text="Channel 2")
-        self.channel2AverageLabel.grid(
-        row=2, column=0, sticky='w',padx=self.xPadding, pady=(10, 0))
-
-        self.channel2AverageValue = ttk.Entry(self)
-        self.channel2AverageValue.insert(0, "0")
-        self.channel2AverageValue.grid(row=3,column=0, sticky="ew", padx=self.xPadding)
+    def create_widgets(self):
         
-       
+        self.reportVar = tk.StringVar(self, value="")
+        self.reportLabel = ttk.Label(self, textvariable=self.reportVar,
+                                     font=('Courier', 8), justify='left')
+        self.reportLabel.grid(row=0, column=0, sticky='w', padx=self.xPadding, pady=(5, 0))
+        
+    def show(self, diagnostics):
+        self.reportVar.set(diagnostics.report())
+
+
 class lightIndicator(tk.Frame):
     def __init__(self, parent, title):
         tk.LabelFrame.__init__(self, parent, text=title, labelanchor='n')
@@ -584,16 +758,31 @@ class lightIndicator(tk.Frame):
         self.canvas = tk.Canvas(self, width=60, height=60, highlightthickness=0)
         self.canvas.grid(row=0, column=0, padx=self.xPadding, pady=(10, 0))
         self.light = self.canvas.create_oval(10, 10, 50 , 50, fill="gray")
+        self.color = "gray"
+        
+        self.samplesLostLabel = ttk.Label(self, text="Samples Lost")
+        self.samplesLostLabel.grid(
+        row=1, column=0, sticky='w',padx=self.xPadding, pady=(10, 0))
+
+        self.samplesLostVar = tk.StringVar(self, value="0")
+        self.samplesLostValue = ttk.Entry(self, textvariable=self.samplesLostVar, width=12)
+        self.samplesLostValue.grid(row=2,column=0, sticky="ew", padx=self.xPadding, pady=(0, 5))
         
     def set_light_color(self, color):
-        self.canvas.itemconfig(self.light, fill=color)
+        # skip the Tcl round trip when nothing changes
+        if color != self.color:
+            self.color = color
+            self.canvas.itemconfig(self.light, fill=color)
 
 
 
 
-# Creates the tk class and primary application "voltageContinuousInput"
-root = tk.Tk()
-app = voltageContinuousInput(root)
+# the acquisition process of --process re-imports this script, only the
+# GUI process may create the window
+if __name__ == '__main__':
+    # Creates the tk class and primary application "voltageContinuousInput"
+    root = tk.Tk()
+    app = voltageContinuousInput(root)
 
-# start the application
-app.mainloop()
+    # start the application
+    app.mainloop()
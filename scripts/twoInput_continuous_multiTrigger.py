@@ -3,6 +3,7 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import nidaqmx
 import numpy as np
 from nidaqmx.stream_writers import AnalogSingleChannelWriter
+from nidaqmx.stream_readers import AnalogMultiChannelReader
 
 import tkinter as tk
 from tkinter import ttk
@@ -169,6 +170,10 @@ class voltageContinuousInput(tk.Frame):
         self.task.timing.cfg_samp_clk_timing(
             sampleRate, sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS, samps_per_chan=self.numberOfSamples*3)
         
+        # reads fill this buffer in place instead of allocating lists per block
+        self.reader = AnalogMultiChannelReader(self.task.in_stream)
+        self.readBuffer = np.zeros((2, self.numberOfSamples))
+        
         self.task.start()
         if cameraTrigger == 'yes':
             self.cameraTriggerStart()
@@ -185,7 +190,9 @@ class voltageContinuousInput(tk.Frame):
         # Check if task needs to update the graph
         samplesAvailable = self.task._in_stream.avail_samp_per_chan
         if(samplesAvailable >= self.numberOfSamples):
-            vals = self.task.read(self.numberOfSamples)
+            self.reader.read_many_sample(
+                self.readBuffer, number_of_samples_per_channel=self.numberOfSamples)
+            vals = self.readBuffer
             
             self.graphDataFrame1.ax.cla()
             self.graphDataFrame1.ax.set_title("Acquired Data")